@@ -172,10 +172,10 @@ class AlignService (Service):
         raise NotImplementedError(
             "_postProcess() method for AlignService must be overridden")
 
-    def run(self):
-        """AlignService starts to run. """
-        logging.info(self.name + ": Align reads to references using " +
-                     "{prog}.".format(prog=self.progName))
+    def prepare(self):
+        """Prepare inputs for the aligner and register a temporary file
+        for the aligner's output (fileNames.alignerSamOut) unless it has
+        been specified."""
         # Prepare inputs for the aligner.
         self._fileNames.queryFileName = self._preProcess(
             self._fileNames.inputFileName,
@@ -188,9 +188,14 @@ class AlignService (Service):
         outFormat = getFileFormat(self._fileNames.outputFileName)
         suffix = ".bam" if (outFormat == FILE_FORMATS.BAM or
                             outFormat == FILE_FORMATS.XML) else ".sam"
-        self._fileNames.alignerSamOut = self._tempFileManager.\
-            RegisterNewTmpFile(suffix=suffix)
+        if self._fileNames.alignerSamOut is None:
+            self._fileNames.alignerSamOut = self._tempFileManager.\
+                RegisterNewTmpFile(suffix=suffix)
 
+    def align(self):
+        """Align reads after prepare() is done."""
+        logging.info(self.name + ": Align reads to references using " +
+                     "{prog}.".format(prog=self.progName))
         # Generate and execute cmd.
         try:
             output, errCode, errMsg = self._execute()
@@ -201,3 +206,8 @@ class AlignService (Service):
         self._postProcess()
 
         return output, errCode, errMsg
+
+    def run(self):
+        """AlignService starts to run. """
+        self.prepare()
+        return self.align()
@@ -36,6 +36,8 @@
 from __future__ import absolute_import
 from pbalign.alignservice.align import AlignService
 from pbalign.utils.fileutil import FILE_FORMATS, real_upath, getFileFormat
+from pbalign.utils.indexcache import openIndexCache
+from pbalign.utils.progutil import Availability, Execute
 import logging
 
 
@@ -322,10 +324,52 @@ class BlasrService(AlignService):
             Output:
                 string, a file which can be used by blasr.
         """
+        # Use a cached suffix array of the reference if none is available.
+        if self._fileNames.sawriterFileName is None or \
+                self._fileNames.sawriterFileName == "":
+            self._fileNames.sawriterFileName = \
+                self._cachedSuffixArray(referenceFile)
+
         # For blasr, nothing needs to be done, return the input PacBio
         # PULSE/BASE/FOFN reads directly.
         return inputFileName
 
+    def _cachedSuffixArray(self, referenceFile):
+        """Return a suffix array of referenceFile from the index cache,
+        build it with sawriter if it is not cached yet. Return None if
+        the index cache is disabled or sawriter is not available.
+            Input:
+                referenceFile: a FASTA reference file.
+            Output:
+                path to a sawriter suffix array file, or None
+        """
+        self._indexCache = openIndexCache(self._options)
+        if self._indexCache is None or referenceFile is None:
+            return None
+        if not Availability("sawriter"):
+            logging.warning(self.name + ": sawriter is not available, " +
+                            "suffix array will be created on the fly.")
+            return None
+
+        # The lookup table prefix length must not exceed minMatch.
+        blt = 8
+        if (self._options.minAnchorSize is not None and
+                self._options.minAnchorSize != ""):
+            blt = max(1, min(blt, int(self._options.minAnchorSize)))
+
+        def build(outFile):
+            """Build a suffix array of referenceFile as outFile."""
+            Execute(self.name, "sawriter {out} {ref} -blt {blt}".format(
+                out=outFile, ref=referenceFile, blt=blt))
+
+        key = "{h}.blt{blt}.sa".format(
+            h=self._indexCache.contentHash(referenceFile), blt=blt)
+        saFile = self._indexCache.fetch(key, build)
+        logging.info(self.name + ": Use cached suffix array " + saFile)
+        return saFile
+
     def _postProcess(self):
         """ Postprocess after alignment is done. """
         logging.debug(self.name + ": Postprocess after alignment is done. ")
+        if getattr(self, "_indexCache", None) is not None:
+            self._indexCache.release()
@@ -35,10 +35,17 @@
 
 from __future__ import absolute_import
 from pbalign.alignservice.fastabasedalign import FastaBasedAlignService
-from os import path
-from pbcore.util.Process import backticks
+from os import path, mkdir
+from pbalign.utils.progutil import Run
+from pbalign.utils.indexcache import openIndexCache
+from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS
+from pbalign.utils.scheduler import StageScheduler
 import logging
 
+# Basename of bowtie2 index files within the index cache, which does not
+# depend on the name of the reference file.
+BT2_CACHED_BASENAME = "reference"
+
 
 def bt2BaseName(tempDir, refFile):
     """Return basename of bowtie2 index files.
@@ -167,25 +174,31 @@ class BowtieService(FastaBasedAlignService):
 
         return options
 
-    def _bt2BuildIndex(self, tempDir, referenceFile):
+    def _bt2BuildIndex(self, tempDir, referenceFile, nproc=1,
+                       refBaseName=None):
         """Build bt2 index files.
 
             Input:
                 tempDir      : a temporary directory for saving bowtie2
                                index files.
                 referenceFile: the reference sequence file.
+                nproc        : number of threads to build index files.
+                refBaseName  : basename of bowtie2 index files, default is
+                               bt2BaseName(tempDir, referenceFile).
             Output:
                 list of strings, bowtie2 index files.
 
         """
-        refBaseName = bt2BaseName(tempDir, referenceFile)
-        cmdStr = "bowtie2-build -q -f {0} {1}".\
-            format(referenceFile, refBaseName)
+        if refBaseName is None:
+            refBaseName = bt2BaseName(tempDir, referenceFile)
+        cmdStr = "bowtie2-build -q -f --threads {2} {0} {1}".\
+            format(referenceFile, refBaseName, max(1, int(nproc)))
 
         logging.info(self.name + ": Build bowtie2 index files.")
         logging.debug(self.name + ": Call {0}".format(cmdStr))
 
-        _output, errCode, errMsg = backticks(cmdStr)
+        result = Run(self.name, cmdStr)
+        errCode, errMsg = result.errCode, result.errMsg
         if (errCode != 0):
             logging.error(self.name + ": Failed to build bowtie2 " +
                           "index files.\n" + errMsg)
@@ -199,7 +212,8 @@ class BowtieService(FastaBasedAlignService):
 
         For bowtie2, we need to
         (1) index the reference sequences,
-        (2) convert the input PULSE/BASE/FOFN file to FASTA.
+        (2) convert the input PULSE/BASE/FOFN file to FASTA,
+        which run concurrently if nproc > 1.
             Input:
                 inputFilieName : a PacBio BASE/PULSE/FOFN file.
                 referenceFile  : a FASTA reference file.
@@ -212,16 +226,49 @@ class BowtieService(FastaBasedAlignService):
                 String, a FASTA file which can be used by bowtie2.
 
         """
-        # Build bt2 index files and return files that have been built.
-        indexFiles = self._bt2BuildIndex(tempFileManager.defaultRootDir,
-                                         referenceFile)
+        nproc = self._options.nproc if self._options.nproc else 1
+        # Leave one processor to convert reads while the index is built.
+        convert = getFileFormat(inputFileName) != FILE_FORMATS.FASTA
+        indexNproc = nproc - 1 if convert and nproc > 1 else nproc
+        self._indexCache = openIndexCache(self._options)
+
+        def buildIndex():
+            """Build bt2 index files or fetch them from the index cache."""
+            if self._indexCache is not None:
+                # Use bt2 index files cached by reference content, build
+                # them if they are not cached yet.
+                def build(indexDir):
+                    """Build bt2 index files within indexDir."""
+                    mkdir(indexDir)
+                    self._bt2BuildIndex(
+                        indexDir, referenceFile, indexNproc,
+                        path.join(indexDir, BT2_CACHED_BASENAME))
+
+                indexDir = self._indexCache.fetch(
+                    "{h}.bt2".format(h=self._indexCache.contentHash(
+                        referenceFile)), build)
+                self._refBaseName = path.join(indexDir, BT2_CACHED_BASENAME)
+                logging.info(self.name + ": Use cached bowtie2 index files " +
+                             self._refBaseName)
+                return []
+            # Build bt2 index files and return files that have been built.
+            self._refBaseName = bt2BaseName(tempFileManager.defaultRootDir,
+                                            referenceFile)
+            return self._bt2BuildIndex(tempFileManager.defaultRootDir,
+                                       referenceFile, indexNproc)
+
+        scheduler = StageScheduler(nproc)
+        scheduler.add("bowtie2-build", buildIndex, nproc=indexNproc)
+        scheduler.add("pls2fasta", lambda: self._pls2fasta(
+            inputFileName, regionTable, noSplitSubreads))
+        results = scheduler.run()
 
         # Register bt2 index files in the temporary file manager.
-        for indexFile in indexFiles:
+        for indexFile in results["bowtie2-build"]:
             tempFileManager.RegisterExistingTmpFile(indexFile, own=True)
 
         # Return a FASTA file that can be used by bowtie2 directly.
-        return self._pls2fasta(inputFileName, regionTable, noSplitSubreads)
+        return results["pls2fasta"]
 
     def _toCmd(self, options, fileNames, tempFileManager):
         """Return a bowtie2 command line to run in bash.
@@ -250,8 +297,10 @@ class BowtieService(FastaBasedAlignService):
         if options.seed is not None and options.seed != "":
             cmdStr += " --seed {seed} ".format(seed=options.seed)
 
-        refBaseName = bt2BaseName(tempFileManager.defaultRootDir,
-                                  fileNames.targetFileName)
+        refBaseName = getattr(self, "_refBaseName", None)
+        if refBaseName is None:
+            refBaseName = bt2BaseName(tempFileManager.defaultRootDir,
+                                      fileNames.targetFileName)
         cmdStr += "-x {refBase} -f {queryFile} -S {outFile} ".\
             format(refBase=refBaseName,
                    queryFile=fileNames.queryFileName,
@@ -262,3 +311,5 @@ class BowtieService(FastaBasedAlignService):
     def _postProcess(self):
         """Postprocess after alignment is done."""
         logging.debug("Preprocess after alignment is done. ")
+        if getattr(self, "_indexCache", None) is not None:
+            self._indexCache.release()
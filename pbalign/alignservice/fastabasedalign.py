@@ -37,7 +37,7 @@ align."""
 from __future__ import absolute_import
 from pbalign.alignservice.align import AlignService
 from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS
-from pbcore.util.Process import backticks
+from pbalign.utils.progutil import Run
 import logging
 
 
@@ -76,7 +76,8 @@ class FastaBasedAlignService(AlignService):
                      format(inFile=inputFileName))
         logging.debug(self.name + ": Call \"{cmd}\"".format(cmd=cmdStr))
 
-        _output, errCode, errMsg = backticks(cmdStr)
+        result = Run(self.name, cmdStr)
+        errCode, errMsg = result.errCode, result.errMsg
         if errCode != 0:
             errMsg += "Failed to convert {i} to {o}.".format(
                       i=inputFileName, o=outFastaFile)
@@ -34,13 +34,15 @@
 # Author: Yuan Li
 
 from __future__ import absolute_import
-from os import path
+from os import path, mkdir, remove
 from pbalign.alignservice.fastabasedalign import FastaBasedAlignService
 from pbalign.utils.fileutil import isExist
-from pbcore.util.Process import backticks
-from time import sleep
+from pbalign.utils.indexcache import FileLock, openIndexCache
+from pbalign.utils.scheduler import StageScheduler
+from pbalign.utils.progutil import Run
 from random import randint
 import logging
+import shutil
 
 
 class GMAPService(FastaBasedAlignService):
@@ -195,19 +197,62 @@ class GMAPService(FastaBasedAlignService):
 
         return cmdStr
 
-    def _releaseLock(self, dbLock):
-        """Release dbLock."""
-        _o, errCode, _m = backticks("rm -f {dbLock}".format(dbLock=dbLock))
-        if errCode == 0:
-            logging.debug(self.name + ": Release the lock for DB creation.")
-        else:
-            raise RuntimeError(self.name + ": Failed to release lock " +
-                               dbLock + ". Please delete the lock manually.")
+    def _gmapBuild(self, dbRoot, dbName, referenceFile):
+        """Build gmap database dbName under dbRoot for referenceFile."""
+        logging.info(self.name + ": Create GMAP DB for {inFa}.".format(
+            inFa=referenceFile))
+        cmdStr = "gmap_build -k 12 --db={dbName} --dir={dbRoot} {inFa}".\
+            format(dbName=dbName, dbRoot=dbRoot, inFa=referenceFile)
+        logging.debug(self.name + ": Call {cmdStr}".format(cmdStr=cmdStr))
+        result = Run(self.name, cmdStr)
+        errCode, errMsg = result.errCode, result.errMsg
+        if (errCode != 0):
+            logging.error(self.name + ": Failed to build GMAP db.\n" +
+                          errMsg)
+            raise RuntimeError(errMsg)
+
+    def _gmapCreateRepositoryDB(self, dbRoot, dbName, referenceFile):
+        """
+        Create gmap database dbName under the root of a reference
+        repository if it does not exist or is incomplete. Concurrent
+        pbalign calls hold an exclusive fcntl lock on {dbName}.lock,
+        which is released by the kernel even if a build crashes, so
+        waiting calls wake up as soon as the build is done.
+        A marker file {dbName}.done is written under the lock after the
+        DB has been built. A DB without the marker, e.g., one whose build
+        crashed or one built by an earlier pbalign version, is removed and
+        built again.
+        """
+        dbPath = path.join(dbRoot, dbName)
+        dbDone = dbPath + ".done"
+        lock = FileLock(dbPath + ".lock")
+        if not lock.acquire(blocking=False):
+            logging.info(self.name + ": Waiting for GMAP database to be " +
+                         "created for {inFa}".format(inFa=referenceFile))
+            lock.acquire()
+        try:
+            if isExist(dbPath) and isExist(dbDone):
+                # gmap_db already exists
+                logging.info(self.name + ": GMAP database {dbPath} found".
+                             format(dbPath=dbPath))
+                return
+
+            if isExist(dbPath):
+                logging.warning(self.name + ": Remove incomplete GMAP " +
+                                "database {dbPath}".format(dbPath=dbPath))
+                shutil.rmtree(dbPath)
+            if isExist(dbDone):
+                remove(dbDone)
+
+            self._gmapBuild(dbRoot, dbName, referenceFile)
+            open(dbDone, 'w').close()
+        finally:
+            lock.release()
 
     def _gmapCreateDB(self, referenceFile, isWithinRepository, tempRootDir):
         """
         Create gmap database for reference sequences if no DB exists.
-        Wait for gmap DB to be created if gmap_db.lock exists.
+        Wait for gmap DB to be created if it is being built by others.
         return (gmap_DB_root_path, gmap_DB_name).
         """
         # Determine dbRoot according to whether the reference file is wihtin
@@ -222,55 +267,30 @@ class GMAPService(FastaBasedAlignService):
             # --------reference.info.xml
             dbRoot = path.split(path.dirname(referenceFile))[0]
             dbName = "gmap_db"
-        else: # Otherwise, create gmap_db under the tempRootDir, and give the
-            # gmap DB a random name
-            dbRoot = tempRootDir
-            dbName = "gmap_db_{sfx}".format(sfx=randint(100000, 1000000))
-
-        dbPath = path.join(dbRoot, dbName)
-        dbLock = dbPath + ".lock"
-        # Check if DB already exists
-        if isExist(dbPath) and not isExist(dbLock):
-            # gmap_db already exists
-            logging.info(self.name + ": GMAP database {dbPath} found".format(
-                         dbPath=dbPath))
+            self._gmapCreateRepositoryDB(dbRoot, dbName, referenceFile)
             return (dbRoot, dbName)
 
-        # Check if DB is being created by other pbalign calls
-        while isExist(dbLock):
-            logging.info(self.name + ": Waiting for GMAP database to be " + \
-                         "created for {inFa}".format(inFa=referenceFile))
-            sleep(10)
-
-        # Create DB if it does not exist
-        if not isExist(dbPath):
-            # Touch the lock file
-            _output, errCode, errMsg = backticks("touch {dbLock}".format(
-                dbLock=dbLock))
-            logging.debug(self.name + ": Create a lock when GMAP DB is " +
-                          "being built.")
-            if (errCode != 0):
-                logging.error(self.name + ": Failed to create {dbLock}.\n" +
-                              errMsg)
-                self._releaseLock(dbLock)
-                raise RuntimeError(errMsg)
-
-            logging.info(self.name + ": Create GMAP DB for {inFa}.".format(
-                inFa=referenceFile))
-            cmdStr = "gmap_build -k 12 --db={dbName} --dir={dbRoot} {inFa}".\
-                format(dbName=dbName, dbRoot=dbRoot, inFa=referenceFile)
-            _output, errCode, errMsg = backticks(cmdStr)
-            logging.debug(self.name + ": Call {cmdStr}".format(cmdStr=cmdStr))
-            if (errCode != 0):
-                logging.error(self.name + ": Failed to build GMAP db.\n" +
-                              errMsg)
-                self._releaseLock(dbLock)
-                raise RuntimeError(errMsg)
-
-            # Delete the lock file to notify others pbalign who are waiting
-            # for this DB to be created.
-            self._releaseLock(dbLock)
+        # Otherwise, use gmap_db in the index cache, named by content of
+        # the reference file.
+        dbName = "gmap_db"
+        self._indexCache = openIndexCache(self._options)
+        if self._indexCache is not None:
+            def build(dbRoot):
+                """Build gmap_db within dbRoot."""
+                mkdir(dbRoot)
+                self._gmapBuild(dbRoot, dbName, referenceFile)
+
+            dbRoot = self._indexCache.fetch("{h}.gmap".format(
+                h=self._indexCache.contentHash(referenceFile)), build)
+            logging.info(self.name + ": Use cached GMAP database " +
+                         path.join(dbRoot, dbName))
+            return (dbRoot, dbName)
 
+        # If the index cache is disabled, create gmap_db under the
+        # tempRootDir, and give the gmap DB a random name.
+        dbRoot = tempRootDir
+        dbName = "gmap_db_{sfx}".format(sfx=randint(100000, 1000000))
+        self._gmapBuild(dbRoot, dbName, referenceFile)
         return (dbRoot, dbName)
 
     def _preProcess(self, inputFileName, referenceFile, regionTable,
@@ -279,7 +299,8 @@ class GMAPService(FastaBasedAlignService):
 
         For gmap, we need to
         (1) create indices for reference sequences,
-        (2) convert the input PULSE/BASE/FOFN file to FASTA.
+        (2) convert the input PULSE/BASE/FOFN file to FASTA,
+        which run concurrently if nproc > 1.
             Input:
                 inputFileName  : a PacBio BASE/PULSE/FOFN file.
                 referenceFile  : a FASTA reference file.
@@ -289,19 +310,29 @@ class GMAPService(FastaBasedAlignService):
             Output:
                 String, a FASTA read file which can be used by gmap.
         """
-        # Create a gmap database, update gmap DB root path and db name.
-        (self.dbRoot, self.dbName) = self._gmapCreateDB(referenceFile,
-                isWithinRepository, tempFileManager.defaultRootDir)
-
-        # DO NOT delete gmap_db if it is within a reference repository;
-        # otherwise, delete it.
-        if not isWithinRepository:
+        # Create a gmap database and convert reads to FASTA concurrently,
+        # update gmap DB root path and db name.
+        self._indexCache = None
+        scheduler = StageScheduler(self._options.nproc)
+        scheduler.add("gmap_build", lambda: self._gmapCreateDB(
+            referenceFile, isWithinRepository,
+            tempFileManager.defaultRootDir))
+        scheduler.add("pls2fasta", lambda: self._pls2fasta(
+            inputFileName, regionTable, noSplitSubreads))
+        results = scheduler.run()
+        (self.dbRoot, self.dbName) = results["gmap_build"]
+
+        # DO NOT delete gmap_db if it is within a reference repository or
+        # the index cache; otherwise, delete it.
+        if not isWithinRepository and self._indexCache is None:
             tempFileManager.RegisterExistingTmpFile(path.join(self.dbRoot,
                 self.dbName), own=True, isDir=True)
 
         # Return a FASTA file that can be used by gmap as query directly.
-        return self._pls2fasta(inputFileName, regionTable, noSplitSubreads)
+        return results["pls2fasta"]
 
     def _postProcess(self):
         """ Postprocess after alignment is done. """
         logging.debug(self.name + ": Postprocess after alignment is done. ")
+        if getattr(self, "_indexCache", None) is not None:
+            self._indexCache.release()
@@ -30,7 +30,8 @@
 ###############################################################################
 
 """This script defines BamPostService, which
-   * calls 'samtools sort' to sort out.bam, and
+   * calls 'samtools sort' to sort out.bam, or 'samtools merge' to merge
+     sorted shards into out.bam, and
    * calls 'samtools index' to make out.bai index, and
    * calls 'makePbi.py' to make out.pbi index file.
 """
@@ -39,8 +40,21 @@
 
 from __future__ import absolute_import, division, print_function
 import logging
+from os import path
 from pbalign.service import Service
-from pbalign.utils.progutil import Execute
+from pbalign.utils.progutil import Execute, Start, Wait
+from pbalign.utils.stageprofile import profileStage
+from pbalign.utils.runmanifest import runStage
+from pbalign.utils.scheduler import StageScheduler
+from pbalign.utils.resourceplanner import SortPlan, \
+    DEFAULT_SORT_MEMORY_PER_THREAD
+from pbalign.utils.toolregistry import getToolRegistry
+
+
+def samtoolsVersion():
+    """Return the version of samtools as a tuple of integers, probed once,
+    assuming 0.1.19 which has no --version if it is unknown."""
+    return getToolRegistry().versionTuple("samtools", default=(0, 1, 19))
 
 
 class BamPostService(Service):
@@ -59,10 +73,24 @@ class BamPostService(Service):
     def cmd(self):
         return ""
 
-    def __init__(self, filenames, nproc=1):
+    def __init__(self, filenames, nproc=1, makePbi=True, profiler=None,
+                 manifest=None, sortedShards=None, sortPlan=None):
         """Initialize a BamPostService object.
             Input - unsortedBamFile: a filtered, unsorted bam file
                     refFasta : a reference fasta file
+                    makePbi : whether or not to make *.pbi, which requires
+                              a PacBio BAM file
+                    profiler: a StageProfiler to measure sort and index
+                              (bai, or bai+pbi which run concurrently)
+                              stages, or None
+                    manifest: a RunManifest to skip sort, bai and pbi
+                              stages which have finished, or None
+                    sortedShards: a list of coordinate-sorted bam files
+                              to merge into the sorted bam file, instead
+                              of sorting the unsorted bam file, or None
+                    sortPlan: a SortPlan of threads, memory and temp dir
+                              of samtools sort, or None to use
+                              max(1, nproc/4) threads with 768M each
             Output - sortedBamFile: sorted BAM file
                      outBaiFile: index BAI file
         """
@@ -74,47 +102,61 @@ class BamPostService(Service):
         self.outBaiFile = filenames.outBaiFileName
         self.outPbiFile = filenames.outPbiFileName
         self.nproc = int(nproc)
+        self.makePbi = makePbi
+        self.profiler = profiler
+        self.manifest = manifest
+        self.sortedShards = sortedShards
+        self.sortPlan = sortPlan
 
-    def _sortbam(self, unsortedBamFile, sortedBamFile, nproc):
-        """Sort unsortedBamFile and output sortedBamFile."""
+    def _sortCmd(self, unsortedBamFile, sortedBamFile, nproc):
+        """Return a command to sort unsortedBamFile into sortedBamFile."""
         if not sortedBamFile.endswith(".bam"):
             raise ValueError("sorted bam file name %s must end with .bam" %
                              sortedBamFile)
         sortedPrefix = sortedBamFile[0:-4]
-        cmd = 'samtools --version||true'
-        _samtoolsversion = ["0","1","19"]
-        try:
-            _out, _code, _msg = Execute(self.name, cmd)
-            if "samtools" in _out[0]:
-                _samtoolsversion = str(_out[0][8:]).strip().split('.')
-            else:
-                pass
-        except Exception:
-            pass
-        _stvmajor = int(_samtoolsversion[0])
-        sort_nproc = max(1, nproc//4)
+        _stvmajor = samtoolsVersion()[0]
+        plan = self.sortPlan
+        if plan is None:
+            plan = SortPlan(max(1, nproc//4), DEFAULT_SORT_MEMORY_PER_THREAD)
+        # Spill temp files to the planned directory.
+        tmpPrefix = sortedPrefix if plan.tmpDir is None else \
+            path.join(plan.tmpDir, path.basename(sortedPrefix))
         if _stvmajor >= 1:
-            cmd = 'samtools sort --threads {t} -m 768M -o {sortedBamFile} {unsortedBamFile}'.format(
-                t=sort_nproc, sortedBamFile=sortedBamFile, unsortedBamFile=unsortedBamFile)
+            cmd = 'samtools sort --threads {t} -m {m} -T {prefix} -o {sortedBamFile} {unsortedBamFile}'.format(
+                t=plan.threads, m=plan.memoryOption, prefix=tmpPrefix,
+                sortedBamFile=sortedBamFile, unsortedBamFile=unsortedBamFile)
         else:
-            cmd = 'samtools sort --threads {t} -m 768M {unsortedBamFile} {prefix}'.format(
-                t=sort_nproc, unsortedBamFile=unsortedBamFile, prefix=sortedPrefix)
-        Execute(self.name, cmd)
+            cmd = 'samtools sort --threads {t} -m {m} {unsortedBamFile} {prefix}'.format(
+                t=plan.threads, m=plan.memoryOption,
+                unsortedBamFile=unsortedBamFile, prefix=sortedPrefix)
+        return cmd
+
+    def _sortbam(self, unsortedBamFile, sortedBamFile, nproc):
+        """Sort unsortedBamFile and output sortedBamFile."""
+        Execute(self.name, self._sortCmd(unsortedBamFile, sortedBamFile, nproc))
+
+    def startSort(self):
+        """Start sorting the unsorted bam file in the background, while it
+        is still being written (e.g., to a FIFO), and return the sorting
+        process, which should be passed to run()."""
+        cmd = self._sortCmd(unsortedBamFile=self.unsortedBamFile,
+                            sortedBamFile=self.outBamFile,
+                            nproc=self.nproc)
+        return Start(self.name, cmd, stdout=None)
+
+    def _waitSort(self, sortProcess):
+        """Wait for a sorting process started by startSort() to finish."""
+        _errCode, errMsg = Wait(sortProcess)
+        if sortProcess.returncode != 0:
+            errMsg = "%s: sorting or merging returned a non-zero exit " \
+                     "status %d\n" \
+                     "ERROR: %s" % (self.name, sortProcess.returncode, errMsg)
+            logging.error(errMsg)
+            raise RuntimeError(errMsg)
 
     def _makebai(self, sortedBamFile, outBaiFile):
         """Build *.bai index file."""
-        cmd = 'samtools --version'
-        _samtoolsversion = ["0","1","19"]
-        try:
-            _out, _code, _msg = Execute(self.name, cmd)
-            if "samtools" in _out[0]:
-                _samtoolsversion = str(_out[0][8:]).strip().split('.')
-            else:
-                pass
-        except Exception:
-            pass
-        _stvmajor = int(_samtoolsversion[0])
-        _stvminor = int(_samtoolsversion[1])
+        _stvmajor, _stvminor = samtoolsVersion()[0:2]
         if _stvmajor == 1 and _stvminor == 2:
             # only for 1.2
             cmd = "samtools index {sortedBamFile}".format(
@@ -129,12 +171,50 @@ class BamPostService(Service):
         cmd = "pbindex %s" % sortedBamFile
         Execute(self.name, cmd)
 
-    def run(self):
-        """ Run the BAM post-processing service. """
+    def _mergeCmd(self, sortedBamFile):
+        """Return a command to merge coordinate-sorted shards into
+        sortedBamFile."""
+        return "samtools merge -f -c -p --threads {t} {o} {i}".format(
+            t=max(0, self.nproc - 1), o=sortedBamFile,
+            i=" ".join(self.sortedShards))
+
+    def _mergebam(self):
+        """Merge coordinate-sorted shards into the sorted bam file."""
+        Execute(self.name, self._mergeCmd(self.outBamFile))
+
+    def run(self, sortProcess=None):
+        """ Run the BAM post-processing service.
+            Input:
+                sortProcess: a sorting process returned by startSort(), or
+                             None to sort the unsorted bam file now.
+        """
         logging.info(self.name + ": Sort and build index for a bam file.")
-        self._sortbam(unsortedBamFile=self.unsortedBamFile,
-                      sortedBamFile=self.outBamFile,
-                      nproc=self.nproc)
-        self._makebai(sortedBamFile=self.outBamFile,
-                      outBaiFile=self.outBaiFile)
-        self._makepbi(sortedBamFile=self.outBamFile)
+        if self.sortedShards is not None:
+            with profileStage(self.profiler, "merge"):
+                runStage(self.manifest, "merge", self.sortedShards,
+                         [self.outBamFile], self._mergebam)
+        else:
+            with profileStage(self.profiler, "sort"):
+                if sortProcess is None:
+                    runStage(self.manifest, "sort", [self.unsortedBamFile],
+                             [self.outBamFile],
+                             lambda: self._sortbam(
+                                 unsortedBamFile=self.unsortedBamFile,
+                                 sortedBamFile=self.outBamFile,
+                                 nproc=self.nproc))
+                else:
+                    self._waitSort(sortProcess)
+
+        # Build *.bai and *.pbi concurrently, both read the sorted bam.
+        scheduler = StageScheduler(self.nproc)
+        scheduler.add("bai", lambda: runStage(
+            self.manifest, "bai", [self.outBamFile], [self.outBaiFile],
+            lambda: self._makebai(sortedBamFile=self.outBamFile,
+                                  outBaiFile=self.outBaiFile)))
+        if self.makePbi:
+            scheduler.add("pbi", lambda: runStage(
+                self.manifest, "pbi", [self.outBamFile], [self.outPbiFile],
+                lambda: self._makepbi(sortedBamFile=self.outBamFile)))
+        with profileStage(self.profiler,
+                          "bai+pbi" if self.makePbi else "bai"):
+            scheduler.run()
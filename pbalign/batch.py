@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines `pbalign batch`, which aligns many inputs listed in
+a manifest against one reference in a single invocation.
+
+    pbalign batch [pbalign options] manifest.tsv reference summary.json
+
+Each line of the manifest is an input and an output separated by white
+space; blank lines and lines starting with # are ignored, and relative
+paths are relative to the manifest. The reference is resolved once, all
+inputs share one index cache, so that a suffix array is built only once,
+and inputs are aligned in worker processes sharing the --nproc budget.
+Workers are not daemonic, so that an input may still be split into
+--shards or aligned to reference partitions in processes of its own.
+A JSON summary of all inputs is written to summary.json.
+"""
+
+from __future__ import absolute_import
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import time
+from Queue import Empty
+from copy import copy
+from multiprocessing import Process, Queue
+from os import path
+
+from pbalign.pbalignfiles import PBAlignFiles
+
+
+def readManifest(fileName):
+    """Read a batch manifest.
+    Input:
+        fileName: a manifest of input and output pairs, one pair per line
+    Output:
+        a list of (input, output) absolute paths
+    """
+    baseDir = path.dirname(path.abspath(fileName))
+    pairs, outputs = [], set()
+    with open(fileName, 'r') as reader:
+        for lineNo, line in enumerate(reader, 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                errMsg = "{f}:{n}: expected an input and an output.".format(
+                    f=fileName, n=lineNo)
+                logging.error(errMsg)
+                raise ValueError(errMsg)
+            inFile, outFile = [path.abspath(path.join(baseDir, f))
+                               for f in fields]
+            if outFile in outputs:
+                errMsg = "{f}:{n}: output {o} is listed twice.".format(
+                    f=fileName, n=lineNo, o=outFile)
+                logging.error(errMsg)
+                raise ValueError(errMsg)
+            outputs.add(outFile)
+            pairs.append((inFile, outFile))
+    if len(pairs) == 0:
+        errMsg = "Manifest {f} lists no inputs.".format(f=fileName)
+        logging.error(errMsg)
+        raise ValueError(errMsg)
+    return pairs
+
+
+def batchArgs(args, pairs, referencePath, indexCacheDir=None):
+    """Return pbalign options of each input of a batch and the number
+    of worker processes, so that all workers share args.nproc.
+    Input:
+        args         : pbalign options of the batch
+        pairs        : a list of (input, output) files
+        referencePath: the resolved reference path
+        indexCacheDir: index cache dir shared by all inputs, or None
+    Output:
+        a tuple of (a list of pbalign options, number of workers)
+    """
+    nproc = max(1, int(args.nproc))
+    nWorkers = min(len(pairs), nproc)
+    jobArgs = []
+    for inFile, outFile in pairs:
+        jobArg = copy(args)
+        jobArg.inputFileName = inFile
+        jobArg.referencePath = referencePath
+        jobArg.outputFileName = outFile
+        jobArg.nproc = nproc // nWorkers
+        if indexCacheDir is not None:
+            jobArg.indexCacheDir = indexCacheDir
+        if args.unaligned is not None:
+            jobArg.unaligned = path.splitext(outFile)[0] + "." + \
+                path.basename(args.unaligned)
+        jobArgs.append(jobArg)
+    return jobArgs, nWorkers
+
+
+def _alignInput(args):
+    """Align an input of a batch in a worker process, and return a dict
+    describing the result instead of raising, so that a failed input does
+    not stop the others."""
+    from pbalign.pbalignrunner import args_runner
+    startTime = time.time()
+    result = {"input": args.inputFileName, "output": args.outputFileName,
+              "exitCode": None, "error": None}
+    try:
+        result["exitCode"] = args_runner(args)
+    except SystemExit as e:
+        result["exitCode"] = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        logging.exception("Failed to align " + args.inputFileName)
+        result["exitCode"], result["error"] = 1, str(e)
+    result["seconds"] = round(time.time() - startTime, 3)
+    return result
+
+
+def _runInput(alignFunc, index, args, results):
+    """Align an input in a worker process and put (index, result) to the
+    results queue."""
+    results.put((index, alignFunc(args)))
+
+
+def alignInProcesses(alignFunc, jobArgs, nWorkers):
+    """Align inputs in at most nWorkers processes at a time. Unlike workers
+    of multiprocessing.Pool, these processes are not daemonic, so that
+    alignFunc may start processes of its own.
+    Input:
+        alignFunc: function aligning an input given its pbalign options
+        jobArgs  : a list of pbalign options, one per input
+        nWorkers : maximum number of concurrent processes
+    Output:
+        a list of results of alignFunc, in the order of jobArgs
+    """
+    queue = Queue()
+    results = [None] * len(jobArgs)
+    pending = list(reversed(list(enumerate(jobArgs))))
+    running = {}
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < nWorkers:
+                index, jobArg = pending.pop()
+                proc = Process(target=_runInput,
+                               args=(alignFunc, index, jobArg, queue))
+                proc.start()
+                running[index] = proc
+            try:
+                index, result = queue.get(timeout=1)
+            except Empty:
+                # A worker which exits abnormally never puts a result.
+                for index, proc in running.items():
+                    if proc.exitcode not in (None, 0):
+                        logging.error("Worker aligning {i} exited with "
+                                      "code {c}.".format(
+                                          i=jobArgs[index].inputFileName,
+                                          c=proc.exitcode))
+                        results[index] = {
+                            "input": jobArgs[index].inputFileName,
+                            "output": jobArgs[index].outputFileName,
+                            "exitCode": 1, "seconds": None,
+                            "error": "worker exited with code {c}".format(
+                                c=proc.exitcode)}
+                        del running[index]
+                continue
+            if index in running:
+                results[index] = result
+                running.pop(index).join()
+    finally:
+        for proc in running.values():
+            proc.terminate()
+            proc.join()
+    return results
+
+
+def runBatch(args, alignFunc=_alignInput):
+    """Align all inputs of a batch manifest and write a summary.
+    Input:
+        args     : pbalign options, where inputFileName is the manifest
+                   and outputFileName is the JSON summary
+        alignFunc: function aligning an input given its pbalign options
+    Output:
+        0 if all inputs are aligned, otherwise 1
+    """
+    startTime = time.time()
+    pairs = readManifest(args.inputFileName)
+    # Resolve the reference once, before starting any worker.
+    refFiles = PBAlignFiles()
+    refFiles.SetReferencePath(args.referencePath)
+
+    # Share an index cache between inputs of this batch if none is given.
+    tmpCacheDir = None
+    if getattr(args, "indexCacheDir", None) is None:
+        tmpCacheDir = tempfile.mkdtemp(dir=args.tmpDir,
+                                       prefix="batch_index_")
+    try:
+        jobArgs, nWorkers = batchArgs(args, pairs, refFiles.referencePath,
+                                      tmpCacheDir)
+        logging.info("Align {n} inputs using {w} processes.".format(
+            n=len(jobArgs), w=nWorkers))
+        if nWorkers == 1:
+            results = [alignFunc(jobArg) for jobArg in jobArgs]
+        else:
+            results = alignInProcesses(alignFunc, jobArgs, nWorkers)
+    finally:
+        if tmpCacheDir is not None:
+            shutil.rmtree(tmpCacheDir, ignore_errors=True)
+
+    nFailed = sum(1 for r in results if r["exitCode"] != 0)
+    summary = {"reference": refFiles.referencePath,
+               "inputs": results,
+               "failed": nFailed,
+               "seconds": round(time.time() - startTime, 3)}
+    with open(args.outputFileName, 'w') as writer:
+        json.dump(summary, writer, indent=2, sort_keys=True)
+    if nFailed > 0:
+        logging.error("{f} of {n} inputs failed, see {s}.".format(
+            f=nFailed, n=len(results), s=args.outputFileName))
+        return 1
+    return 0
+
+
+def main(argv=sys.argv[1:]):
+    """Main of `pbalign batch`."""
+    from pbalign.options import get_contract_parser
+    parser = get_contract_parser().arg_parser.parser
+    parser.prog = "pbalign batch"
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s [%(levelname)s] %(message)s")
+    return runBatch(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines FilterEngine, which filters alignments of a SAM/BAM
+file in-process with pysam, computes alignment metrics of a batch of records
+with numpy, applies filtering criteria and the multiple hit policy, and
+writes a SAM or BAM file directly."""
+
+from __future__ import absolute_import, division
+import logging
+from collections import defaultdict
+
+import numpy as np
+import pysam
+
+from pbalign.hitpolicy import alignmentScores, pickHits
+from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS, isExist
+
+# Number of alignment records to filter at a time.
+BATCH_SIZE = 10000
+
+# pysam CIGAR operations.
+(CMATCH, CINS, CDEL, CREF_SKIP, CSOFT_CLIP, CHARD_CLIP, CPAD, CEQUAL,
+ CDIFF) = range(9)
+
+
+def referenceMismatches(record, reference):
+    """Count mismatches within M operations of a record by comparing its
+    bases with the reference, a pysam.FastaFile. Return None if the
+    record has no bases or its reference sequence is not found."""
+    query = record.query_sequence
+    if query is None:
+        return None
+    refName = record.reference_name
+    if refName not in reference.references:
+        refName = refName.split()[0]
+        if refName not in reference.references:
+            return None
+    target = reference.fetch(refName, record.reference_start,
+                             record.reference_end).upper()
+    query = query.upper()
+    qPos, rPos, mismatches = 0, 0, 0
+    for op, length in record.cigartuples:
+        if op == CMATCH:
+            mismatches += sum(1 for q, r in zip(query[qPos:qPos + length],
+                                                target[rPos:rPos + length])
+                              if q != r)
+        if op in (CMATCH, CINS, CSOFT_CLIP, CEQUAL, CDIFF):
+            qPos += length
+        if op in (CMATCH, CDEL, CREF_SKIP, CEQUAL, CDIFF):
+            rPos += length
+    return mismatches
+
+
+def alignmentMetrics(records, reference=None):
+    """Compute alignment metrics of a batch of records from their CIGAR
+    strings and NM tags.
+        Input:
+            records  : a list of pysam.AlignedSegment objects.
+            reference: a pysam.FastaFile to count mismatches within M
+                       operations of records without NM tags, or None.
+        Output:
+            a dict of numpy arrays, one value per record, of
+            'matches', 'mismatches', 'insertions', 'deletions',
+            'alignedLength' (aligned read length),
+            'similarity' (percent matches of alignment columns),
+            'accuracy' (percent of the aligned read without errors) and
+            'unknown' (whether mismatches within M operations are not
+            known, in which case similarity and accuracy are NaN).
+    """
+    n = len(records)
+    rows, ops, lens = [], [], []
+    nms = np.full(n, -1, dtype=np.int64)
+    for i, record in enumerate(records):
+        cigar = record.cigartuples or ()
+        rows.extend([i] * len(cigar))
+        for op, length in cigar:
+            ops.append(op)
+            lens.append(length)
+        if record.has_tag("NM"):
+            nms[i] = record.get_tag("NM")
+
+    counts = np.zeros((n, 9), dtype=np.int64)
+    np.add.at(counts, (np.array(rows, dtype=np.int64),
+                       np.array(ops, dtype=np.int64)),
+              np.array(lens, dtype=np.int64))
+
+    insertions = counts[:, CINS]
+    deletions = counts[:, CDEL]
+    # Mismatches within M operations are NM minus indels. Without NM,
+    # they are counted against the reference, or are unknown.
+    mMismatches = np.clip(nms - insertions - deletions, 0, counts[:, CMATCH])
+    unknown = (nms < 0) & (counts[:, CMATCH] > 0)
+    mMismatches[nms < 0] = 0
+    if reference is not None:
+        for i in np.flatnonzero(unknown):
+            nMismatches = referenceMismatches(records[i], reference)
+            if nMismatches is not None:
+                mMismatches[i] = nMismatches
+                unknown[i] = False
+    mismatches = counts[:, CDIFF] + mMismatches
+    matches = counts[:, CEQUAL] + counts[:, CMATCH] - mMismatches
+    alignedLength = matches + mismatches + insertions
+    errors = mismatches + insertions + deletions
+
+    columns = np.maximum(matches + errors, 1)
+    similarity = 100.0 * matches / columns
+    accuracy = 100.0 * (1.0 - errors / np.maximum(alignedLength, 1))
+    similarity[unknown] = np.nan
+    accuracy[unknown] = np.nan
+    return {'matches': matches, 'mismatches': mismatches,
+            'insertions': insertions, 'deletions': deletions,
+            'alignedLength': alignedLength, 'similarity': similarity,
+            'accuracy': accuracy, 'unknown': unknown}
+
+
+def readAdapterGff(gffFile):
+    """Read adapter annotations from a GFF file, and return a dict of
+    reference name to a tuple of numpy arrays (starts, ends) of 0-based,
+    half-open adapter intervals sorted by start."""
+    intervals = defaultdict(list)
+    with open(gffFile, 'r') as reader:
+        for line in reader:
+            if line.startswith('#') or line.strip() == "":
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5:
+                continue
+            intervals[fields[0]].append((int(fields[3]) - 1, int(fields[4])))
+    adapters = {}
+    for refName, ivs in intervals.iteritems():
+        ivs.sort()
+        adapters[refName] = (np.array([iv[0] for iv in ivs]),
+                             np.array([iv[1] for iv in ivs]))
+    return adapters
+
+
+def queryGroupedBatches(records, batchSize):
+    """Yield lists of about batchSize records from a query-grouped record
+    iterator, never splitting hits of a query into two lists."""
+    batch = []
+    for record in records:
+        if len(batch) >= batchSize and \
+                record.query_name != batch[-1].query_name:
+            yield batch
+            batch = []
+        batch.append(record)
+    if len(batch) > 0:
+        yield batch
+
+
+class FilterEngine(object):
+    """Filter alignments by percent similarity, accuracy, aligned length and
+    score, then apply a multiple hit policy to hits of each query."""
+    def __init__(self, minPctSimilarity=None, minPctAccuracy=None,
+                 minLength=None, scoreCutoff=None, scoreSign=-1,
+                 hitPolicy="all", seed=None, adapters=None,
+                 referenceFile=None, batchSize=BATCH_SIZE):
+        """Initialize a FilterEngine object.
+            Input:
+                minPctSimilarity: minimum percent similarity
+                minPctAccuracy  : minimum percent accuracy
+                minLength       : minimum aligned read length
+                scoreCutoff     : the worst score to output an alignment
+                scoreSign       : score sign of the aligner, can be -1 or 1
+                hitPolicy       : a multiple hit policy
+                seed            : seed of the random number generators
+                adapters        : adapter intervals returned by
+                                  readAdapterGff(), hits entirely within
+                                  adapters are removed.
+                referenceFile   : a reference FASTA file to count
+                                  mismatches of hits without NM tags.
+                                  Without it, such hits with M operations
+                                  fail similarity and accuracy criteria.
+                batchSize       : number of records to filter at a time
+        """
+        if scoreSign not in [1, -1]:
+            errMsg = "Score sign {s} is neither 1 nor -1.".format(s=scoreSign)
+            logging.error(errMsg)
+            raise ValueError(errMsg)
+        self.minPctSimilarity = minPctSimilarity
+        self.minPctAccuracy = minPctAccuracy
+        self.minLength = minLength
+        self.scoreCutoff = scoreCutoff
+        self.scoreSign = scoreSign
+        self.hitPolicy = hitPolicy
+        self.seed = seed
+        self.adapters = adapters
+        self.referenceFile = referenceFile
+        self.batchSize = batchSize
+        self._reference = None
+        self._warnedUnknown = False
+
+    @classmethod
+    def fromOptions(cls, options, scoreSign, adapterGffFile=None,
+                    referenceFile=None):
+        """Create a FilterEngine from pbalign options."""
+        minPctSimilarity, minPctAccuracy = None, None
+        if options.maxDivergence is not None:
+            maxDivergence = int(options.maxDivergence if options.maxDivergence
+                                > 1.0 else (options.maxDivergence * 100))
+            minPctSimilarity = 100 - maxDivergence
+
+        if options.minAccuracy is not None:
+            minPctAccuracy = int(options.minAccuracy if options.minAccuracy
+                                 > 1.0 else (options.minAccuracy * 100))
+
+        adapters = None
+        if options.filterAdapterOnly is True and isExist(adapterGffFile):
+            adapters = readAdapterGff(adapterGffFile)
+
+        return cls(minPctSimilarity=minPctSimilarity,
+                   minPctAccuracy=minPctAccuracy,
+                   minLength=options.minLength,
+                   scoreCutoff=options.scoreCutoff,
+                   scoreSign=scoreSign,
+                   hitPolicy=options.hitPolicy if options.hitPolicy
+                   is not None else "all",
+                   seed=options.seed,
+                   adapters=adapters,
+                   referenceFile=referenceFile)
+
+    def passes(self, records, metrics, scores):
+        """Return a numpy boolean array indicating whether each record
+        satisfies all filtering criteria."""
+        mask = np.array([not record.is_unmapped for record in records],
+                        dtype=bool)
+        # Hits of unknown similarity and accuracy (NaN) fail criteria.
+        with np.errstate(invalid='ignore'):
+            if self.minPctSimilarity is not None:
+                mask &= metrics['similarity'] >= self.minPctSimilarity
+            if self.minPctAccuracy is not None:
+                mask &= metrics['accuracy'] >= self.minPctAccuracy
+        if self.minLength is not None:
+            mask &= metrics['alignedLength'] >= int(self.minLength)
+        if self.scoreCutoff is not None:
+            mask &= scores * self.scoreSign >= \
+                int(self.scoreCutoff) * self.scoreSign
+        if self.adapters is not None:
+            mask &= ~self._adapterOnly(records)
+        return mask
+
+    def _adapterOnly(self, records):
+        """Return a numpy boolean array indicating whether each record is
+        aligned entirely within an adapter."""
+        adapterOnly = np.zeros(len(records), dtype=bool)
+        for i, record in enumerate(records):
+            if record.is_unmapped:
+                continue
+            ivs = self.adapters.get(record.reference_name)
+            if ivs is None:
+                ivs = self.adapters.get(record.reference_name.split()[0])
+            if ivs is None:
+                continue
+            starts, ends = ivs
+            j = np.searchsorted(starts, record.reference_start,
+                                side='right') - 1
+            adapterOnly[i] = j >= 0 and \
+                ends[:j+1].max() >= record.reference_end
+        return adapterOnly
+
+    def selectHits(self, records, scores):
+        """Apply the multiple hit policy to hits of a query, update their
+        primary/secondary flags and return the selected records."""
+        return pickHits(records, scores, self.hitPolicy, self.scoreSign,
+                        self.seed)
+
+    def filterBatch(self, records):
+        """Filter a batch of records which contains all hits of its
+        queries, and return the records to output."""
+        metrics = alignmentMetrics(records, self._reference)
+        scores = alignmentScores(records)
+        mask = self.passes(records, metrics, scores)
+        if not self._warnedUnknown and metrics['unknown'].any() and \
+                (self.minPctSimilarity is not None or
+                 self.minPctAccuracy is not None):
+            self._warnedUnknown = True
+            logging.warning("FilterEngine: Hits with M operations but "
+                            "without NM tags can not be checked against "
+                            "similarity or accuracy criteria, and are "
+                            "removed.")
+
+        output = []
+        groupStart = 0
+        for i in xrange(1, len(records) + 1):
+            if i == len(records) or \
+                    records[i].query_name != records[groupStart].query_name:
+                keep = [j for j in xrange(groupStart, i) if mask[j]]
+                output.extend(self.selectHits([records[j] for j in keep],
+                                              scores[keep]))
+                groupStart = i
+        return output
+
+    def _openReference(self):
+        """Open the reference FASTA file, which pysam indexes if it has no
+        .fai index, or leave it closed if it can not be opened."""
+        if self.referenceFile is None or not isExist(self.referenceFile):
+            return
+        try:
+            self._reference = pysam.FastaFile(self.referenceFile)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning("FilterEngine: Could not open reference {r}: "
+                            "{e}".format(r=self.referenceFile, e=e))
+
+    def run(self, inFile, outFile):
+        """Filter alignments of a query-grouped SAM/BAM file, and write
+        selected alignments to a SAM/BAM file.
+            Input:
+                inFile : a SAM/BAM file in which hits of a query are
+                         adjacent, e.g., an aligner's output
+                outFile: an output SAM/BAM file
+            Output:
+                (number of input records, number of output records)
+        """
+        mode = "wb" if getFileFormat(outFile) == FILE_FORMATS.BAM else "w"
+        nIn, nOut = 0, 0
+        self._openReference()
+        reader = pysam.AlignmentFile(inFile, "r", check_sq=False)
+        try:
+            writer = pysam.AlignmentFile(outFile, mode, template=reader)
+            try:
+                for batch in queryGroupedBatches(reader, self.batchSize):
+                    nIn += len(batch)
+                    for record in self.filterBatch(batch):
+                        writer.write(record)
+                        nOut += 1
+            finally:
+                writer.close()
+        finally:
+            reader.close()
+            if self._reference is not None:
+                self._reference.close()
+                self._reference = None
+        logging.info("FilterEngine: {o} out of {i} alignments passed.".
+                     format(o=nOut, i=nIn))
+        return nIn, nOut
+
@@ -29,19 +29,18 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ###############################################################################
 
-"""This script defines FilterService, which calls samFilter to remove aligments
-in an input SAM file according to filtering criteria."""
+"""This script defines FilterService, which uses FilterEngine to remove
+aligments in an input SAM/BAM file according to filtering criteria."""
 
 # Author: Yuan Li
 
 from __future__ import absolute_import
 import logging
 from pbalign.service import Service
-from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS, isExist
+from pbalign.filterengine import FilterEngine
 
 class FilterService(Service):
-    """ Call samFilter to filter low quality hits and apply multiple hits
-    policy. """
+    """ Filter low quality hits and apply multiple hits policy. """
     @property
     def name(self):
         """Name of filter service."""
@@ -50,7 +49,16 @@ class FilterService(Service):
     @property
     def progName(self):
         """Program to call."""
-        return "samFilter"
+        return "FilterEngine"
+
+    @property
+    def availability(self):
+        """FilterEngine runs in-process, it is always available."""
+        return True
+
+    def checkAvailability(self):
+        """FilterEngine runs in-process, it is always available."""
+        pass
 
     def __init__(self, inSamFile, refFile, outSamFile,
                  alignerName, scoreSign, options,
@@ -81,9 +89,18 @@ class FilterService(Service):
                            self.scoreSign,  self.options,
                            self.adapterGffFile)
 
+    @property
+    def inlineFiltered(self):
+        """Whether alignments have been filtered by the aligner."""
+        # blasr supports in-line alignment filteration,
+        # no need to filter again.
+        return self.alignerName == "blasr" and \
+            not self.options.filterAdapterOnly
+
     def _toCmd(self, inSamFile, refFile, outSamFile,
             alignerName, scoreSign, options, adapterGffFile):
-        """ Generate a samFilter command line from options.
+        """ Generate a command line to link alignments that have been
+            filtered by the aligner to the output file.
             Input:
                 inSamFile : the input SAM file
                 refFile   : the reference FASTA file
@@ -92,60 +109,27 @@ class FilterService(Service):
                 scoreSign : score sign, can be -1 or 1
                 options   : argument options
             Output:
-                a command-line string
+                a command-line string, or None if alignments need to be
+                filtered by FilterEngine.
         """
-        # blasr supports in-line alignment filteration,
-        # no need to call samFilter at all.
-        if alignerName == "blasr" and \
-            not self.options.filterAdapterOnly:
-            cmdStr = "rm -f {outFile} && ln -s {inFile} {outFile}".format(
-                    inFile=inSamFile, outFile=outSamFile)
-            return cmdStr
-
-        # if aligner is not blasr, call samFilter instead
-        cmdStr = self.progName + \
-            " {inSamFile} {refFile} {outSamFile} ".format(
-                inSamFile=inSamFile,
-                refFile=refFile,
-                outSamFile=outSamFile)
-
-        if options.maxDivergence is not None:
-            maxDivergence = int(options.maxDivergence if options.maxDivergence
-                                > 1.0 else (options.maxDivergence * 100))
-            cmdStr += " -minPctSimilarity {0}".format(100 - maxDivergence)
-
-        if options.minAccuracy is not None:
-            minAccuracy = int(options.minAccuracy if options.minAccuracy > 1.0
-                              else (options.minAccuracy * 100))
-            cmdStr += " -minAccuracy {0}".format(minAccuracy)
-
-        if options.minLength is not None:
-            cmdStr += " -minLength {0}".format(options.minLength)
-
-        if options.seed is not None:
-            cmdStr += " -seed {0}".format(options.seed)
-
-        if scoreSign in [1, -1]:
-            cmdStr += " -scoreSign {0}".format(scoreSign)
-        else:
-            logging.error("{0}'s score sign is neither 1 nor -1.".format(
-                alignerName))
-
-        if options.scoreCutoff is not None:
-            cmdStr += " -scoreCutoff {0}".format(options.scoreCutoff)
-
-        if options.hitPolicy is not None:
-            cmdStr += " -hitPolicy {0}".format(options.hitPolicy)
-
-        if options.filterAdapterOnly is True and \
-            isExist(adapterGffFile):
-            cmdStr += " -filterAdapterOnly {gffFile}".format(
-                    gffFile=adapterGffFile)
-
+        if not self.inlineFiltered:
+            return None
+        cmdStr = "rm -f {outFile} && ln -s {inFile} {outFile}".format(
+                inFile=inSamFile, outFile=outSamFile)
         return cmdStr
 
+    @property
+    def engine(self):
+        """A FilterEngine object created from filtering criteria."""
+        return FilterEngine.fromOptions(self.options, self.scoreSign,
+                                        self.adapterGffFile, self.refFile)
+
     def run(self):
         """ Run the filter service. """
+        if self.inlineFiltered:
+            return self._execute()
+
         logging.info(self.name + ": Filter alignments using {0}.".
                      format(self.progName))
-        return self._execute()
+        self.engine.run(self.inSamFile, self.outSamFile)
+        return "", 0, ""
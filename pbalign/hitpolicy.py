@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines functions for applying multiple hit policies to hits
+of queries, including a streaming stage which k-way merges query-grouped
+alignment files (e.g., alignments against partitions of a reference) and
+applies a hit policy to all hits of each query, holding hits of only one
+query in memory at a time."""
+
+from __future__ import absolute_import, division
+import heapq
+import logging
+import math
+import random
+import time
+import zlib
+from itertools import groupby
+
+import numpy as np
+import pysam
+
+
+def alignmentScores(records):
+    """Return aligner scores of records as a numpy array, which are
+    read from AS tags, or NM tags (edit distance) if AS is missing."""
+    scores = np.zeros(len(records), dtype=np.int64)
+    for i, record in enumerate(records):
+        if record.has_tag("AS"):
+            scores[i] = record.get_tag("AS")
+        elif record.has_tag("NM"):
+            scores[i] = record.get_tag("NM")
+    return scores
+
+
+# Hit policies which pick hits at random.
+RANDOM_HIT_POLICIES = ("random", "randombest")
+
+
+def queryRandom(queryName, seed):
+    """Return a random number generator of a query, which is determined by
+    the query name and seed, so that hit selection does not depend on the
+    order in which queries are processed. Seed None or 0 means that the
+    current system time is used as --seed 0 does, so selections are then
+    not reproducible."""
+    if seed is None or int(seed) == 0:
+        seed = int(time.time() * 1000)
+    return random.Random((zlib.crc32(queryName.encode('utf-8')) &
+                          0xffffffff) ^ int(seed))
+
+
+def selectHits(scores, positions, hitPolicy, rng):
+    """Select hits of a query according to a multiple hit policy.
+        Input:
+            scores   : a numpy array of hit scores, the larger the better
+                       (i.e., aligner scores multiplied by score sign).
+            positions: a list of (reference id, reference start) of hits.
+            hitPolicy: one of HITPOLICY_CANDIDATES.
+            rng      : a random number generator of the query, only used
+                       by RANDOM_HIT_POLICIES, otherwise it can be None.
+        Output:
+            a sorted list of indices of the selected hits.
+    """
+    if len(scores) == 0:
+        return []
+    if hitPolicy == "all":
+        return range(len(scores))
+    if hitPolicy == "random":
+        return [rng.randrange(len(scores))]
+    best = [int(i) for i in np.flatnonzero(scores == scores.max())]
+    if hitPolicy == "allbest":
+        return best
+    elif hitPolicy == "randombest":
+        return [best[rng.randrange(len(best))]]
+    elif hitPolicy == "leftmost":
+        return [min(best, key=lambda i: positions[i])]
+    errMsg = "Unsupported hit policy {p}.".format(p=hitPolicy)
+    logging.error(errMsg)
+    raise ValueError(errMsg)
+
+
+def pickHits(records, scores, hitPolicy, scoreSign, seed, maxHits=None):
+    """Apply a multiple hit policy to hits of a query, keep at most
+    maxHits best hits, and mark the best selected hit as the primary
+    alignment and the others as secondary.
+        Input:
+            records  : a list of pysam.AlignedSegment, hits of a query.
+            scores   : a numpy array of aligner scores of records.
+            hitPolicy: one of HITPOLICY_CANDIDATES.
+            scoreSign: score sign of the aligner, can be -1 or 1.
+            seed     : seed of the random number generators.
+            maxHits  : maximum number of hits to keep, None means no limit.
+        Output:
+            a list of selected records, in their input order.
+    """
+    if len(records) == 0:
+        return []
+    scores = np.asarray(scores) * scoreSign
+    # Seeding a generator for every query is only worth it if it is used.
+    rng = queryRandom(records[0].query_name, seed) \
+        if hitPolicy in RANDOM_HIT_POLICIES else None
+    positions = [(r.reference_id, r.reference_start) for r in records]
+    selected = list(selectHits(scores, positions, hitPolicy, rng))
+    if maxHits is not None and 0 < int(maxHits) < len(selected):
+        selected = sorted(sorted(selected, key=lambda i: -scores[i])
+                          [0:int(maxHits)])
+
+    primary = None
+    for i in sorted(selected, key=lambda i: -scores[i]):
+        if not records[i].is_supplementary:
+            primary = i
+            break
+    for i in selected:
+        if not records[i].is_supplementary:
+            records[i].is_secondary = i != primary
+    return [records[i] for i in selected]
+
+
+def strnumCmp(a, b):
+    """Compare two query names in the same way as samtools sort -n does,
+    i.e., digit runs are compared by numeric value."""
+    i, j, na, nb = 0, 0, len(a), len(b)
+    while i < na and j < nb:
+        if a[i].isdigit() and b[j].isdigit():
+            while i < na and a[i] == '0':
+                i += 1
+            while j < nb and b[j] == '0':
+                j += 1
+            while i < na and j < nb and a[i].isdigit() and a[i] == b[j]:
+                i += 1
+                j += 1
+            da = i < na and a[i].isdigit()
+            db = j < nb and b[j].isdigit()
+            if da and db:
+                k = 0
+                while i + k < na and j + k < nb and \
+                        a[i + k].isdigit() and b[j + k].isdigit():
+                    k += 1
+                if i + k < na and a[i + k].isdigit():
+                    return 1
+                if j + k < nb and b[j + k].isdigit():
+                    return -1
+                return cmp(a[i], b[j])
+            elif da:
+                return 1
+            elif db:
+                return -1
+            elif i != j:
+                # Same numbers with different numbers of leading zeros.
+                return 1 if i < j else -1
+        else:
+            if a[i] != b[j]:
+                return cmp(a[i], b[j])
+            i += 1
+            j += 1
+    return 1 if i < na else -1 if j < nb else 0
+
+
+class QueryKey(object):
+    """A sort key of query names, ordered as by samtools sort -n."""
+    __slots__ = ['name']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __lt__(self, other):
+        return strnumCmp(self.name, other.name) < 0
+
+    def __eq__(self, other):
+        return self.name == other.name
+
+    def __ne__(self, other):
+        return self.name != other.name
+
+
+def queryGroups(records):
+    """Yield (query name, list of records) of a query-grouped record
+    iterator."""
+    for name, group in groupby(records, key=lambda r: r.query_name):
+        yield name, list(group)
+
+
+def mergeQueryGroups(streams):
+    """K-way merge query-grouped record streams whose queries are in the
+    order of samtools sort -n, and yield (query name, records) with hits
+    of a query from all streams.
+        Input:
+            streams: a list of iterators of pysam.AlignedSegment
+        Output:
+            an iterator of (query name, [(stream index, record)])
+    """
+    heap, iters, lastKeys = [], [], []
+    for index, stream in enumerate(streams):
+        iters.append(queryGroups(stream))
+        lastKeys.append(None)
+
+    def push(index):
+        """Push the next query group of a stream onto the heap."""
+        for name, records in iters[index]:
+            key = QueryKey(name)
+            if lastKeys[index] is not None and not lastKeys[index] < key:
+                errMsg = "Alignments are not grouped and sorted by " + \
+                         "query name, found {a} after {b}.".format(
+                             a=name, b=lastKeys[index].name)
+                logging.error(errMsg)
+                raise ValueError(errMsg)
+            lastKeys[index] = key
+            heapq.heappush(heap, (key, index, records))
+            return
+
+    for index in range(len(iters)):
+        push(index)
+
+    while heap:
+        key, index, records = heapq.heappop(heap)
+        hits = [(index, r) for r in records]
+        push(index)
+        while heap and heap[0][0] == key:
+            _key, other, records = heapq.heappop(heap)
+            hits.extend([(other, r) for r in records])
+            push(other)
+        yield key.name, hits
+
+
+def mergeHeaders(headers, refNames=None):
+    """Merge SAM/BAM headers, taking the union of @SQ, @RG and @PG lines.
+        Input:
+            headers : a list of header dicts (i.e., AlignmentHeader.to_dict())
+            refNames: names of references in their original order, @SQ
+                      lines are emitted in this order if it is given.
+                      References not in refNames follow in the order
+                      they are first seen.
+        Output:
+            (a merged header dict,
+             a list of dicts which map old reference ids of each header
+             to reference ids of the merged header)
+    """
+    merged = {'HD': dict(headers[0].get('HD', {'VN': '1.5'})),
+              'SQ': [], 'RG': [], 'PG': []}
+    merged['HD']['SO'] = 'unknown'
+    tids, tidMaps = {}, []
+    seenRGs, seenPGs = set(), set()
+    for header in headers:
+        tidMap = {}
+        for oldTid, sq in enumerate(header.get('SQ', [])):
+            if sq['SN'] in tids:
+                length = merged['SQ'][tids[sq['SN']]]['LN']
+                if length != sq['LN']:
+                    errMsg = "Reference {n} has different lengths {a} " \
+                             "and {b}.".format(n=sq['SN'], a=length,
+                                               b=sq['LN'])
+                    logging.error(errMsg)
+                    raise ValueError(errMsg)
+            else:
+                tids[sq['SN']] = len(merged['SQ'])
+                merged['SQ'].append(dict(sq))
+            tidMap[oldTid] = tids[sq['SN']]
+        tidMaps.append(tidMap)
+        for tag, seen in (('RG', seenRGs), ('PG', seenPGs)):
+            for line in header.get(tag, []):
+                if line['ID'] not in seen:
+                    seen.add(line['ID'])
+                    merged[tag].append(dict(line))
+        for comment in header.get('CO', []):
+            merged.setdefault('CO', []).append(comment)
+    if refNames is not None:
+        rank = dict((name, i) for i, name in enumerate(refNames))
+        order = sorted(range(len(merged['SQ'])),
+                       key=lambda i: (rank.get(merged['SQ'][i]['SN'],
+                                               len(rank)), i))
+        newTids = dict((old, new) for new, old in enumerate(order))
+        merged['SQ'] = [merged['SQ'][i] for i in order]
+        tidMaps = [dict((old, newTids[tid])
+                        for old, tid in oldMap.iteritems())
+                   for oldMap in tidMaps]
+    for tag in ('RG', 'PG'):
+        if len(merged[tag]) == 0:
+            del merged[tag]
+    return merged, tidMaps
+
+
+def mergedMapQVs(mapQVs, scores, scoreSign):
+    """Recompute mapping qualities of hits of a query merged from several
+    reference partitions. The aligner of each partition only saw hits
+    within its own partition, so a hit which is unique within its
+    partition may be ambiguous among the merged hits. Each of the n hits
+    with the best score is correct with probability 1/n, i.e. its mapping
+    quality is at most -10*log10(1 - 1/n); other hits get 0.
+        Input:
+            mapQVs   : mapping qualities of hits reported by the aligner.
+            scores   : alignment scores of hits.
+            scoreSign: score sign of the aligner, can be -1 or 1.
+        Output:
+            a list of mapping qualities of hits.
+    """
+    scores = np.asarray(scores) * scoreSign
+    isBest = scores == scores.max()
+    nBest = int(isBest.sum())
+    cap = 255 if nBest == 1 else \
+        int(round(-10 * math.log10(1 - 1.0 / nBest)))
+    return [min(int(mapQV), cap) if best else 0
+            for mapQV, best in zip(mapQVs, isBest)]
+
+
+def mergeHits(inFiles, outFile, hitPolicy, scoreSign, seed, maxHits=None,
+              refNames=None):
+    """Merge hits of each query from SAM/BAM files sorted by query name
+    (samtools sort -n), recompute mapping qualities of queries with hits
+    from more than one file (see mergedMapQVs), apply a multiple hit
+    policy to them, and write selected hits to a SAM/BAM file.
+        Input:
+            inFiles  : a list of query name sorted SAM/BAM files.
+            outFile  : an output SAM/BAM file.
+            hitPolicy: one of HITPOLICY_CANDIDATES.
+            scoreSign: score sign of the aligner, can be -1 or 1.
+            seed     : seed of the random number generators.
+            maxHits  : maximum number of hits per query.
+            refNames : names of references in their original order.
+        Output:
+            (number of queries, number of output hits)
+    """
+    readers = [pysam.AlignmentFile(f, "r", check_sq=False) for f in inFiles]
+    try:
+        header, tidMaps = mergeHeaders([r.header.to_dict() for r in readers],
+                                       refNames)
+        mode = "wb" if outFile.endswith(".bam") else "w"
+        writer = pysam.AlignmentFile(outFile, mode, header=header)
+        # Records whose reference ids differ in the merged header are
+        # rebuilt with the merged header, which resolves references by name.
+        rebind = [any(old != new for old, new in tidMap.iteritems())
+                  for tidMap in tidMaps]
+        nQueries, nHits = 0, 0
+        try:
+            for _name, hits in mergeQueryGroups(readers):
+                records, sources = [], set()
+                for index, record in hits:
+                    if record.is_unmapped:
+                        continue
+                    if rebind[index]:
+                        record = pysam.AlignedSegment.from_dict(
+                            record.to_dict(), writer.header)
+                    records.append(record)
+                    sources.add(index)
+                nQueries += 1
+                scores = alignmentScores(records)
+                if len(sources) > 1:
+                    mapQVs = mergedMapQVs(
+                        [r.mapping_quality for r in records],
+                        scores, scoreSign)
+                    for record, mapQV in zip(records, mapQVs):
+                        record.mapping_quality = mapQV
+                for record in pickHits(records, scores,
+                                       hitPolicy, scoreSign, seed, maxHits):
+                    writer.write(record)
+                    nHits += 1
+        finally:
+            writer.close()
+    finally:
+        for reader in readers:
+            reader.close()
+    logging.info("Merged {h} hits of {q} queries from {n} files.".format(
+        h=nHits, q=nQueries, n=len(inFiles)))
+    return nQueries, nHits
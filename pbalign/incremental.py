@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines functions for incremental alignment, which aligns
+only movies of an input SubreadSet that are not yet in an existing
+AlignmentSet, and then updates the AlignmentSet with the new alignments.
+
+Movies are identified by movie names (PU) of @RG header lines. An input
+BAM is new if none of its movies are aligned, and already aligned if all
+of them are; a BAM with both aligned and new movies can not be aligned
+incrementally, since its aligned movies would be aligned twice.
+"""
+
+from __future__ import absolute_import
+import logging
+from os import path
+
+import pysam
+from pbcore.io import openDataFile
+from pbcore.io.dataset.DataSetMembers import ExternalResources
+
+from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS, real_ppath
+
+
+def bamMovieNames(bamFile):
+    """Return the set of movie names of read groups of a BAM file."""
+    reader = pysam.AlignmentFile(bamFile, 'rb', check_sq=False)
+    try:
+        readGroups = reader.header.to_dict().get('RG', [])
+    finally:
+        reader.close()
+    movies = set(rg['PU'] for rg in readGroups if 'PU' in rg)
+    if len(movies) == 0:
+        errMsg = "Could not find movie names in read groups of " + bamFile
+        logging.error(errMsg)
+        raise ValueError(errMsg)
+    return movies
+
+
+def datasetBams(fileName):
+    """Return BAM files of a BAM file or a dataset XML file."""
+    fileName = real_ppath(fileName)
+    if getFileFormat(fileName) == FILE_FORMATS.BAM:
+        return [fileName]
+    if getFileFormat(fileName) == FILE_FORMATS.XML:
+        return [path.abspath(f) for f in
+                openDataFile(fileName).toExternalFiles()]
+    errMsg = "Incremental alignment requires a BAM or dataset XML file, " + \
+             "not {0}.".format(fileName)
+    logging.error(errMsg)
+    raise ValueError(errMsg)
+
+
+def checkReference(existingBams, refLengths):
+    """Check that existing alignments are aligned to the reference, i.e.,
+    their @SQ lines have the same names and lengths as the reference.
+    Input:
+        existingBams: BAM files of an existing AlignmentSet
+        refLengths  : a list of (contig name, length) of the reference
+    """
+    refLengths = [(name, int(length)) for name, length in refLengths]
+    for bamFile in existingBams:
+        reader = pysam.AlignmentFile(bamFile, 'rb', check_sq=False)
+        try:
+            bamLengths = zip(reader.references, reader.lengths)
+        finally:
+            reader.close()
+        if bamLengths != refLengths:
+            errMsg = "Existing alignments {f} are not aligned to the " \
+                     "reference, their @SQ lines differ.".format(f=bamFile)
+            logging.error(errMsg)
+            raise ValueError(errMsg)
+
+
+def planIncrement(existingBams, inputBams):
+    """Find input BAM files with movies which are not aligned yet.
+    Input:
+        existingBams: BAM files of an existing AlignmentSet
+        inputBams   : BAM files of an input SubreadSet
+    Output:
+        a list of input BAM files of new movies
+    """
+    alignedMovies = set()
+    for bamFile in existingBams:
+        alignedMovies |= bamMovieNames(bamFile)
+
+    newBams = []
+    for bamFile in inputBams:
+        movies = bamMovieNames(bamFile)
+        aligned = movies & alignedMovies
+        if len(aligned) == 0:
+            newBams.append(bamFile)
+        elif aligned != movies:
+            errMsg = "Input {f} has both aligned movies ({a}) and new " \
+                     "movies ({n}).".format(
+                         f=bamFile, a=", ".join(sorted(aligned)),
+                         n=", ".join(sorted(movies - aligned)))
+            logging.error(errMsg)
+            raise ValueError(errMsg)
+    logging.info("Incremental alignment: {n} of {t} input BAM files have "
+                 "new movies.".format(n=len(newBams), t=len(inputBams)))
+    return newBams
+
+
+def writeNewMovies(inputFileName, newBams, outFile):
+    """Write a copy of the input dataset, which only keeps its external
+    resources of newBams, to outFile, and return outFile. Filters, metadata
+    and the name of the input dataset are kept."""
+    dataSet = openDataFile(real_ppath(inputFileName))
+    newBams = set(path.realpath(f) for f in newBams)
+    newMovies = dataSet.copy()
+    newMovies.newUuid()
+    resources = list(newMovies.externalResources)
+    newMovies.externalResources = ExternalResources()
+    for resource, fileName in zip(resources, dataSet.toExternalFiles()):
+        if path.realpath(fileName) in newBams:
+            newMovies.externalResources.append(resource)
+    newMovies.updateCounts()
+    newMovies.write(outFile)
+    return outFile
@@ -84,6 +84,8 @@ DEFAULT_METRICS = ("DeletionQV", "DeletionTag", "InsertionQV",
 # Default values of arguments
 DEFAULT_OPTIONS = {"regionTable": None,
                    "configFile": None,
+                   "existingAlignments": None,
+                   "incrementalMerge": False,
                    # Choose an aligner
                    "algorithm": ALGORITHM_CANDIDATES[0],
                    # Aligner options
@@ -111,6 +113,16 @@ DEFAULT_OPTIONS = {"regionTable": None,
                    "metrics": str(",".join(DEFAULT_METRICS)),
                    # Miscellaneous options
                    "nproc": 8,
+                   "shards": 1,
+                   "maxShardMinutes": None,
+                   "maxReferenceMemory": None,
+                   "partitionWorkers": 1,
+                   "streaming": False,
+                   "stageStats": False,
+                   "resume": False,
+                   "maxMemory": None,
+                   "indexCacheDir": None,
+                   "indexCacheSize": 100,
                    "seed": 1,
                    "tmpDir": "/tmp"}
 
@@ -152,6 +164,26 @@ def constructOptionParser(parser, C=Constants, ccs_mode=False):
                         action="store",
                         help=helpstr)
 
+    helpstr = "Specify an existing AlignmentSet of the same reference.\n" + \
+              "Only movies of the input which are not in it are\n" + \
+              "aligned, and the output AlignmentSet references both\n" + \
+              "its BAM files and the BAM file of the new movies."
+    input_group.add_argument("--existingAlignments",
+                        dest="existingAlignments",
+                        default=DEFAULT_OPTIONS["existingAlignments"],
+                        type=str,
+                        action="store",
+                        help=helpstr)
+
+    helpstr = "With --existingAlignments, merge existing alignments\n" + \
+              "and alignments of new movies into a single sorted BAM\n" + \
+              "file, instead of referencing existing BAM files."
+    input_group.add_argument("--incrementalMerge",
+                        dest="incrementalMerge",
+                        default=DEFAULT_OPTIONS["incrementalMerge"],
+                        action="store_true",
+                        help=helpstr)
+
     # Chose an aligner.
     align_group = parser.add_argument_group("Alignment options")
     helpstr = "Select an aligorithm from {0}.\n".format(ALGORITHM_CANDIDATES)
@@ -236,6 +268,48 @@ def constructOptionParser(parser, C=Constants, ccs_mode=False):
                         action="store",
                         help=helpstr)
 
+    helpstr = "Split the input into this many ZMW-range shards, and align\n" + \
+              "them in parallel processes, each using nproc/shards\n" + \
+              "threads. Input must be a dataset, a BAM or a FOFN file."
+    align_group.add_argument("--shards",
+                        type=int,
+                        dest="shards",
+                        default=DEFAULT_OPTIONS["shards"],
+                        action="store",
+                        help=helpstr)
+
+    helpstr = "Split the input into more shards than --shards if needed,\n" + \
+              "so that the estimated time to align a shard, based on\n" + \
+              "its number of bases, does not exceed this many minutes."
+    align_group.add_argument("--maxShardMinutes",
+                        type=float,
+                        dest="maxShardMinutes",
+                        default=DEFAULT_OPTIONS["maxShardMinutes"],
+                        action="store",
+                        help=helpstr)
+
+    helpstr = "Partition the reference into groups of contigs, such that\n" + \
+              "the aligner's estimated memory for a partition does not\n" + \
+              "exceed this many gigabytes, align reads to partitions\n" + \
+              "separately and merge hits of each read with --hitPolicy\n" + \
+              "and --maxHits. Can not be used with --shards or --unaligned."
+    align_group.add_argument("--maxReferenceMemory",
+                        type=float,
+                        dest="maxReferenceMemory",
+                        default=DEFAULT_OPTIONS["maxReferenceMemory"],
+                        action="store",
+                        help=helpstr)
+
+    helpstr = "Number of reference partitions to align to in parallel,\n" + \
+              "which share --nproc threads. Default value is {0}.".\
+              format(DEFAULT_OPTIONS["partitionWorkers"])
+    align_group.add_argument("--partitionWorkers",
+                        type=int,
+                        dest="partitionWorkers",
+                        default=DEFAULT_OPTIONS["partitionWorkers"],
+                        action="store",
+                        help=helpstr)
+
     align_group.add_argument("--algorithmOptions",
                         type=str,
                         dest="algorithmOptions",
@@ -426,6 +500,70 @@ def constructOptionParser(parser, C=Constants, ccs_mode=False):
                         action="store",
                         help=helpstr)
 
+    helpstr = "Stream blasr's BAM output through a named pipe into\n" + \
+              "samtools sort, instead of writing and re-reading an\n" + \
+              "intermediate BAM file. Only applies to blasr with BAM\n" + \
+              "or dataset XML output, when the input is not sharded\n" + \
+              "and --filterAdapterOnly is not set."
+    misc_group.add_argument("--streaming",
+                        dest="streaming",
+                        default=DEFAULT_OPTIONS["streaming"],
+                        action="store_true",
+                        help=helpstr)
+
+    helpstr = "Write wall time, CPU time and peak memory of each stage,\n" + \
+              "and input bases and throughput, to a JSON file named\n" + \
+              "after the output file with the extension .stats.json."
+    misc_group.add_argument("--stageStats",
+                        dest="stageStats",
+                        default=DEFAULT_OPTIONS["stageStats"],
+                        action="store_true",
+                        help=helpstr)
+
+    helpstr = "Keep intermediate files of this run in a work directory\n" + \
+              "next to the output file, and skip stages which finished\n" + \
+              "in an earlier run with the same inputs and options, if\n" + \
+              "their outputs are still valid. Disables --streaming."
+    misc_group.add_argument("--resume",
+                        dest="resume",
+                        default=DEFAULT_OPTIONS["resume"],
+                        action="store_true",
+                        help=helpstr)
+
+    helpstr = "Maximum memory in gigabytes pbalign may use, shared by\n" + \
+              "aligners and samtools sort. Threads, memory per thread\n" + \
+              "and the temp directory of samtools sort are planned\n" + \
+              "within it, the cgroup memory limit and CPU quota, and\n" + \
+              "available memory. Default is no limit besides those."
+    misc_group.add_argument("--maxMemory",
+                        dest="maxMemory",
+                        type=float,
+                        action="store",
+                        default=DEFAULT_OPTIONS["maxMemory"],
+                        help=helpstr)
+
+    helpstr = "Specify a directory for caching aligner indexes (e.g.,\n" + \
+              "suffix arrays) of references, shared between runs.\n" + \
+              "Default is the PBALIGN_CACHE_DIR environment variable,\n" + \
+              "no indexes are cached if neither is specified."
+    misc_group.add_argument("--indexCacheDir",
+                        dest="indexCacheDir",
+                        type=str,
+                        action="store",
+                        default=DEFAULT_OPTIONS["indexCacheDir"],
+                        help=helpstr)
+
+    helpstr = "Maximum size in gigabytes of the index cache. Least\n" + \
+              "recently used indexes are evicted when it is exceeded.\n" + \
+              "Zero disables the cache. Default value is {0}.".\
+              format(DEFAULT_OPTIONS["indexCacheSize"])
+    misc_group.add_argument("--indexCacheSize",
+                        dest="indexCacheSize",
+                        type=float,
+                        action="store",
+                        default=DEFAULT_OPTIONS["indexCacheSize"],
+                        help=helpstr)
+
     helpstr = "Specify a directory for saving temporary files.\n"
     misc_group.add_argument("--tmpDir",
                         dest="tmpDir",
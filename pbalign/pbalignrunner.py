@@ -45,12 +45,16 @@ import logging
 import time
 import sys
 import shutil
-from os import readlink
+import signal
+from copy import copy
+from multiprocessing import Pool
+from os import readlink, mkdir, mkfifo, remove, path
+import os
 
 from pbcommand.cli import pbparser_runner
 from pbcommand.utils import setup_log
 from pbcore.util.ToolRunner import PBToolRunner
-from pbcore.io import (AlignmentSet, ConsensusAlignmentSet)
+from pbcore.io import (AlignmentSet, ConsensusAlignmentSet, openDataFile)
 
 from pbalign.__init__ import get_version
 from pbalign.options import (ALGORITHM_CANDIDATES, get_contract_parser,
@@ -60,9 +64,158 @@ from pbalign.alignservice.bowtie import BowtieService
 from pbalign.alignservice.gmap import GMAPService
 from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS, real_ppath
 from pbalign.utils.tempfileutil import TempFileManager
+from pbalign.utils.shardutil import splitInputFile, mergeShardOutputs
+from pbalign.utils.shardplanner import maxBasesForWallTime
+from pbalign.utils.refpartition import partitionReference, contigLengths
+from pbalign.utils.progutil import Execute, FeedFifo
+from pbalign.utils.stageprofile import StageProfiler
+from pbalign.utils.runmanifest import RunManifest, runStage
+from pbalign.hitpolicy import mergeHits
+from pbalign.incremental import datasetBams, checkReference, planIncrement, \
+    writeNewMovies
 from pbalign.pbalignfiles import PBAlignFiles
 from pbalign.filterservice import FilterService
 from pbalign.bampostservice import BamPostService
+from pbalign.utils.resourceplanner import planSort, alignerFootprint
+
+
+def createAlignService(name, args, fileNames, tempFileManager):
+    """
+    Create and return an AlignService by algorithm name.
+    Input:
+        name           : an algorithm name such as blasr
+        fileNames      : an PBAlignFiles object
+        args           : pbalign options
+        tempFileManager: a temporary file manager
+    Output:
+        an object of AlignService subclass (such as BlasrService).
+    """
+    if name not in ALGORITHM_CANDIDATES:
+        errMsg = "ERROR: unrecognized algorithm {algo}".format(algo=name)
+        logging.error(errMsg)
+        raise ValueError(errMsg)
+
+    service = None
+    if name == "blasr":
+        service = BlasrService(args, fileNames, tempFileManager)
+    elif name == "bowtie":
+        service = BowtieService(args, fileNames, tempFileManager)
+    elif name == "gmap":
+        service = GMAPService(args, fileNames, tempFileManager)
+    else:
+        errMsg = "Service for {algo} is not implemented.".\
+                 format(algo=name)
+        logging.error(errMsg)
+        raise ValueError(errMsg)
+
+    service.checkAvailability()
+    return service
+
+
+def _mapInPool(func, items, nWorkers):
+    """Return [func(item) for item in items], computed in nWorkers worker
+    processes. If any call fails, or the caller is interrupted, e.g., by
+    SystemExit on SIGTERM, the workers are terminated and the error is
+    raised."""
+    pool = Pool(processes=nWorkers)
+    try:
+        results = pool.map(func, items, chunksize=1)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def _alignShard(shard):
+    """Align and filter reads of a shard in a worker process, and return
+    the filtered SAM/BAM file of this shard.
+        Input:
+            shard: a tuple of (args, sawriterFileName, regionTable,
+                   sortedBamFile, sortPlan), where args are pbalign options
+                   of this shard, in which inputFileName is the shard
+                   input, outputFileName is the shard output, and tmpDir
+                   is the shard temp dir. If sortedBamFile is not None,
+                   filtered hits are sorted by coordinate into
+                   sortedBamFile following sortPlan, a SortPlan, and
+                   sortedBamFile is returned instead.
+    """
+    args, sawriterFileName, regionTable, sortedBamFile, sortPlan = shard
+    fileNames = PBAlignFiles()
+    # Temporary files of this shard are removed by the parent process,
+    # which owns args.tmpDir.
+    alnService = createAlignService(args.algorithm, args, fileNames,
+                                    TempFileManager())
+    # Keep --sa and --regionTable resolved by the parent process.
+    if sawriterFileName is not None:
+        fileNames.sawriterFileName = sawriterFileName
+    if regionTable is not None:
+        fileNames.regionTable = regionTable
+    alnService.run()
+
+    fileNames.filteredSam = args.outputFileName
+    FilterService(fileNames.alignerSamOut,
+                  fileNames.targetFileName,
+                  fileNames.filteredSam,
+                  args.algorithm,
+                  alnService.scoreSign,
+                  args,
+                  fileNames.adapterGffFileName).run()
+    if sortedBamFile is None:
+        return fileNames.filteredSam
+    return _sortShard(args, fileNames.filteredSam, sortedBamFile, sortPlan)
+
+
+def _sortShard(args, filteredBamFile, sortedBamFile, sortPlan):
+    """Sort filtered hits of a shard by coordinate into sortedBamFile with
+    the shard's own share of processors and memory in sortPlan, a
+    SortPlan, so that sorted shards only have to be merged, and return
+    sortedBamFile. args are pbalign options of this shard, in which tmpDir
+    is the shard temp dir."""
+    # The planned temp dir may be shared by other runs, so temp files are
+    # named after the unique shards dir of this run, e.g.,
+    # shardsXYZ.shard0.sort.
+    runName = path.basename(path.dirname(path.abspath(args.tmpDir)))
+    Execute("ShardSort",
+            "samtools sort --threads {t} -m {m} -T {p} -o {o} {i}".format(
+                t=sortPlan.threads, m=sortPlan.memoryOption,
+                p=path.join(sortPlan.tmpDir or args.tmpDir,
+                            "{r}.{s}.sort".format(
+                                r=runName,
+                                s=path.basename(args.tmpDir))),
+                o=sortedBamFile, i=filteredBamFile))
+    return sortedBamFile
+
+def _alignPartition(partition):
+    """Align and filter reads to a reference partition in a worker process,
+    and return a BAM file of the filtered hits sorted by query name.
+        Input:
+            partition: a tuple of (args, regionTable, sortPlan), where args
+                       are pbalign options of this partition, in which
+                       referencePath is the partition FASTA file,
+                       outputFileName is the partition output, and tmpDir
+                       is the partition temp dir, and sortPlan is a
+                       SortPlan of this partition's share of threads and
+                       memory to sort its hits by query name.
+    """
+    args, regionTable, sortPlan = partition
+    # The suffix array of the whole reference can not be used.
+    filtered = _alignShard((args, None, regionTable, None, None))
+    sortedBam = path.join(args.tmpDir, "sortedbyname.bam")
+    # Temp files are named after the unique partitions dir of this run,
+    # e.g., partitionsXYZ.partition0.sort, as in _sortShard.
+    runName = path.basename(path.dirname(path.abspath(args.tmpDir)))
+    Execute("PartitionSort",
+            "samtools sort -n --threads {t} -m {m} -T {p} -o {o} {i}".format(
+                t=sortPlan.threads, m=sortPlan.memoryOption,
+                p=path.join(sortPlan.tmpDir or args.tmpDir,
+                            "{r}.{s}.sort".format(
+                                r=runName,
+                                s=path.basename(args.tmpDir))),
+                o=sortedBam, i=filtered))
+    return sortedBam
 
 class PBAlignRunner(PBToolRunner):
 
@@ -87,6 +240,8 @@ class PBAlignRunner(PBToolRunner):
         super(PBAlignRunner, self).__init__(desc)
         self._output_dataset_type = output_dataset_type
         self._alnService = None
+        self._existingBams = None
+        self._inputFileName = None
         self._filterService = None
         self.fileNames = PBAlignFiles()
         self._tempFileManager = TempFileManager()
@@ -112,26 +267,7 @@ class PBAlignRunner(PBToolRunner):
         Output:
             an object of AlignService subclass (such as BlasrService).
         """
-        if name not in ALGORITHM_CANDIDATES:
-            errMsg = "ERROR: unrecognized algorithm {algo}".format(algo=name)
-            logging.error(errMsg)
-            raise ValueError(errMsg)
-
-        service = None
-        if name == "blasr":
-            service = BlasrService(args, fileNames, tempFileManager)
-        elif name == "bowtie":
-            service = BowtieService(args, fileNames, tempFileManager)
-        elif name == "gmap":
-            service = GMAPService(args, fileNames, tempFileManager)
-        else:
-            errMsg = "Service for {algo} is not implemented.".\
-                     format(algo=name)
-            logging.error(errMsg)
-            raise ValueError(errMsg)
-
-        service.checkAvailability()
-        return service
+        return createAlignService(name, args, fileNames, tempFileManager)
 
     def _makeSane(self, args, fileNames):
         """
@@ -153,12 +289,28 @@ class PBAlignRunner(PBToolRunner):
             errMsg = "pbalign no longer supports CMP.H5 Output in 3.0."
             raise IOError(errMsg)
 
-        if outFormat == FILE_FORMATS.BAM or outFormat == FILE_FORMATS.XML:
+        if outFormat == FILE_FORMATS.XML:
             if args.algorithm != "blasr":
-                errMsg = "Must choose blasr in order to output a bam file."
+                errMsg = "Must choose blasr in order to output a dataset xml."
                 raise ValueError(errMsg)
-            if args.filterAdapterOnly:
-                errMsg = "-filterAdapter does not work when out format is BAM."
+
+        if args.existingAlignments is not None:
+            if outFormat != FILE_FORMATS.XML:
+                errMsg = "--existingAlignments requires a dataset xml " + \
+                         "output."
+                raise ValueError(errMsg)
+        elif args.incrementalMerge:
+            errMsg = "--incrementalMerge requires --existingAlignments."
+            raise ValueError(errMsg)
+
+        if args.maxReferenceMemory is not None:
+            if int(args.shards) > 1 or args.maxShardMinutes is not None:
+                errMsg = "--maxReferenceMemory can not be used with " + \
+                         "--shards or --maxShardMinutes."
+                raise ValueError(errMsg)
+            if args.unaligned is not None:
+                errMsg = "--maxReferenceMemory can not be used with " + \
+                         "--unaligned."
                 raise ValueError(errMsg)
 
     def _parseArgs(self):
@@ -189,7 +341,10 @@ class PBAlignRunner(PBToolRunner):
             logging.info("OutputService: Genearte the output SAM file.")
             logging.debug("OutputService: Move %s as %s", inSam, outFile)
             try:
-                shutil.move(readlink(real_ppath(inSam)), real_ppath(outFile))
+                inSam = real_ppath(inSam)
+                if path.islink(inSam):
+                    inSam = readlink(inSam)
+                shutil.move(inSam, real_ppath(outFile))
             except shutil.Error as e:
                 output, errCode, errMsg = "", 1, "Exited with error: " + str(e)
                 logging.error(errMsg)
@@ -202,28 +357,322 @@ class PBAlignRunner(PBToolRunner):
             logging.info("OutputService: Generating the output XML file %s %s",
                          inSam, outFile)
             # Create {out}.xml, given {out}.bam
-            outBam = str(outFile[0:-3]) + "bam"
-            aln = None
-            # FIXME This should really be more automatic
-            if readType == "CCS":
-                self._output_dataset_type = ConsensusAlignmentSet
-            aln = self._output_dataset_type(real_ppath(outBam))
-            for res in aln.externalResources:
-                res.reference = refFile
-            aln.write(outFile)
+            outBams = [real_ppath(str(outFile[0:-3]) + "bam")]
+            if self._existingBams is not None and \
+                    not self.args.incrementalMerge:
+                # Reference existing alignments besides new ones.
+                outBams = self._existingBams + outBams
+            self._writeAlignmentSet(outBams, refFile, outFile, readType)
 
         return output, errCode, errMsg
 
+    def _writeAlignmentSet(self, bamFiles, refFile, outFile, readType=None):
+        """Write an AlignmentSet of bamFiles aligned to refFile to outFile.
+        Input:
+            bamFiles: a list of sorted and indexed BAM files
+            refFile : the reference file. (e.g. fileName.targetFileName)
+            outFile : the output dataset XML file
+            readType: standard or cDNA or CCS (can be None if not specified)
+        """
+        # FIXME This should really be more automatic
+        if readType == "CCS":
+            self._output_dataset_type = ConsensusAlignmentSet
+        aln = self._output_dataset_type(*bamFiles)
+        for res in aln.externalResources:
+            res.reference = refFile
+        aln.write(outFile)
+
+    def _planIncrement(self):
+        """Align only movies of the input which are not in
+        --existingAlignments, by replacing the input with a dataset of
+        its BAM files of new movies. Return False if there are none."""
+        self._existingBams = datasetBams(self.args.existingAlignments)
+        if path.realpath(real_ppath(self.fileNames.outBamFileName)) in \
+                [path.realpath(f) for f in self._existingBams]:
+            errMsg = "Output {o} would overwrite existing alignments.".\
+                     format(o=self.fileNames.outBamFileName)
+            logging.error(errMsg)
+            raise ValueError(errMsg)
+        checkReference(self._existingBams,
+                       contigLengths(self.fileNames.targetFileName))
+        newBams = planIncrement(self._existingBams,
+                                datasetBams(self.fileNames.inputFileName))
+        if len(newBams) == 0:
+            return False
+        if self.args.resume:
+            # Keep the path fixed, so that options of a resumed run are
+            # the same.
+            newMovies = path.join(self._workDir(), "newMovies.xml")
+        else:
+            newMovies = self._tempFileManager.RegisterNewTmpFile(
+                suffix=".xml")
+        newMovies = writeNewMovies(self.fileNames.inputFileName, newBams,
+                                   newMovies)
+        self.args.inputFileName = newMovies
+        self.fileNames.SetInputFile(newMovies)
+        return True
+
+    def _workDir(self):
+        """Return the work dir next to the output file, which keeps
+        intermediate files of --resume, and create it if necessary."""
+        workDir = path.splitext(self.fileNames.outputFileName)[0] + \
+            ".pbalign_work"
+        if not path.isdir(workDir):
+            mkdir(workDir)
+        return workDir
+
+    def _splitInput(self, nShards, maxBases, inputs):
+        """Split the input into shards and return the shard files. With
+        --resume, shards are kept in the work dir, listed in shards.fofn,
+        and reused as long as inputs and the shards have not changed.
+            Input:
+                nShards : the number of shards.
+                maxBases: maximum number of bases of a shard, or None.
+                inputs  : files the shards are made from.
+        """
+        if self._manifest is None:
+            return splitInputFile(self.fileNames.inputFileName, nShards,
+                                  self._tempFileManager.RegisterNewTmpFile(
+                                      isDir=True, prefix="shards"),
+                                  maxBases)
+
+        shardDir = path.join(self._manifest.workDir, "shards")
+        shardFofn = path.join(self._manifest.workDir, "shards.fofn")
+        shardInputs = []
+        if path.exists(shardFofn):
+            # Keep the order of shards, unlike getFilesFromFOFN.
+            with open(shardFofn, 'r') as reader:
+                shardInputs = [line.strip() for line in reader
+                               if line.strip() != ""]
+        if self._manifest.isDone("split", inputs, [shardFofn] + shardInputs):
+            logging.info("Resume: reuse {n} shards in {d}.".format(
+                n=len(shardInputs), d=shardDir))
+            return shardInputs
+
+        self._manifest.invalidate("split")
+        if path.isdir(shardDir):
+            shutil.rmtree(shardDir)
+        mkdir(shardDir)
+        shardInputs = splitInputFile(self.fileNames.inputFileName, nShards,
+                                     shardDir, maxBases)
+        with open(shardFofn, 'w') as writer:
+            writer.write("\n".join(shardInputs) + "\n")
+        self._manifest.markDone("split", inputs, [shardFofn] + shardInputs)
+        return shardInputs
+
+    def _sortFiltered(self):
+        """Sort filtered hits by coordinate into a temporary BAM file,
+        which can be merged with existing alignments, and return it."""
+        sortedBam = self._tempFileManager.RegisterNewTmpFile(
+            suffix=".sorted.bam")
+        sortPlan = self._planSort(dataFile=self.fileNames.filteredSam)
+        with self._profiler.stage("sort"):
+            Execute("IncrementalSort",
+                    "samtools sort --threads {t} -m {m} -T {p} -o {o} {i}".
+                    format(t=sortPlan.threads, m=sortPlan.memoryOption,
+                           p=path.join(sortPlan.tmpDir or
+                                       path.dirname(sortedBam),
+                                       path.basename(sortedBam) + ".sort"),
+                           o=sortedBam, i=self.fileNames.filteredSam))
+        return sortedBam
+
+    def _planSort(self, dataFile=None, reservedBytes=0, nSorts=1):
+        """Return a SortPlan of samtools sort within --nproc, --maxMemory
+        and limits of this host and cgroup.
+        Input:
+            dataFile     : the BAM file to sort, or None if unknown.
+            reservedBytes: memory used by aligners running at the same time.
+            nSorts       : number of sorts running at the same time.
+        """
+        dataBytes = path.getsize(dataFile) \
+            if dataFile is not None and path.isfile(dataFile) else None
+        tmpDirs = [self._tempFileManager.defaultRootDir]
+        if self.fileNames.outBamFileName is not None:
+            tmpDirs.append(path.dirname(path.abspath(
+                self.fileNames.outBamFileName)))
+        return planSort(self.args.nproc, self.args.maxMemory,
+                        reservedBytes=reservedBytes, dataBytes=dataBytes,
+                        tmpDirs=tmpDirs, nSorts=nSorts)
+
+    def _alignShards(self, shardInputs, suffix, sortedShards=None,
+                     alignFunc=_alignShard):
+        """Align and filter shards in parallel, then merge filtered shards
+        into self.fileNames.filteredSam, or sort each shard by coordinate
+        into sortedShards, which are merged by BamPostService.
+        Input:
+            shardInputs : a list of shard input files.
+            suffix      : suffix of filtered shard files, .bam or .sam.
+            sortedShards: a list of sorted BAM files, one per shard, or
+                          None to merge unsorted shards.
+            alignFunc   : a function which aligns a shard in a worker
+                          process, see _alignShard.
+        """
+        nShards = len(shardInputs)
+        # There might be more shards than --shards to fit a time limit.
+        nWorkers = max(1, min(nShards, int(self.args.shards)))
+        logging.info("Align {n} shards using {w} processes.".format(
+            n=nShards, w=nWorkers))
+        # Shards are sorted while other shards are still being aligned.
+        shardNproc = max(1, int(self.args.nproc) // nWorkers)
+        sortPlan = None
+        if sortedShards is not None:
+            sortPlan = self._planSort(
+                reservedBytes=(nWorkers - 1) * alignerFootprint(
+                    self.fileNames.targetFileName, shardNproc),
+                nSorts=nWorkers)
+        shards = []
+        for i, shardInput in enumerate(shardInputs):
+            shardDir = path.join(path.dirname(shardInput),
+                                 "shard{0}".format(i))
+            # Shards kept for --resume may have a dir of a failed run.
+            if path.isdir(shardDir):
+                shutil.rmtree(shardDir)
+            mkdir(shardDir)
+            shardArgs = copy(self.args)
+            shardArgs.inputFileName = shardInput
+            shardArgs.outputFileName = path.join(shardDir,
+                                                 "filtered" + suffix)
+            shardArgs.tmpDir = shardDir
+            shardArgs.nproc = shardNproc
+            if self.args.unaligned is not None:
+                shardArgs.unaligned = path.join(shardDir, "unaligned")
+            shards.append((shardArgs, self.fileNames.sawriterFileName,
+                           self.fileNames.regionTable,
+                           None if sortedShards is None
+                           else sortedShards[i], sortPlan))
+
+        with self._profiler.stage("align+filter"):
+            shardOutputs = _mapInPool(alignFunc, shards, nWorkers)
+
+        if sortedShards is None:
+            with self._profiler.stage("merge"):
+                mergeShardOutputs(shardOutputs, self.fileNames.filteredSam,
+                                  self.args.nproc)
+
+        # Concatenate names of unaligned reads of all shards.
+        if self.args.unaligned is not None:
+            with open(real_ppath(self.args.unaligned), 'w') as writer:
+                for shardArgs, _sa, _rgn, _sorted, _plan in shards:
+                    if path.exists(shardArgs.unaligned):
+                        with open(shardArgs.unaligned, 'r') as reader:
+                            shutil.copyfileobj(reader, writer)
+
+    def _alignPartitions(self, partitionFastas, suffix):
+        """Align and filter reads to reference partitions, then merge hits
+        of each read from all partitions into self.fileNames.filteredSam,
+        applying --hitPolicy and --maxHits across partitions.
+        Input:
+            partitionFastas: a list of partition FASTA files.
+            suffix         : suffix of filtered partition files.
+        """
+        nWorkers = max(1, min(len(partitionFastas),
+                              int(self.args.partitionWorkers)))
+        logging.info("Align to {n} reference partitions using {w} "
+                     "processes.".format(n=len(partitionFastas), w=nWorkers))
+        partNproc = max(1, int(self.args.nproc) // nWorkers)
+        # Partitions are sorted while other partitions are still being
+        # aligned.
+        sortPlan = self._planSort(
+            reservedBytes=(nWorkers - 1) * max(
+                alignerFootprint(fastaFile, partNproc)
+                for fastaFile in partitionFastas),
+            nSorts=nWorkers)
+        partitions = []
+        for i, fastaFile in enumerate(partitionFastas):
+            partDir = path.join(path.dirname(fastaFile),
+                                "partition{0}".format(i))
+            mkdir(partDir)
+            partArgs = copy(self.args)
+            partArgs.referencePath = fastaFile
+            partArgs.outputFileName = path.join(partDir, "filtered" + suffix)
+            partArgs.tmpDir = partDir
+            partArgs.nproc = partNproc
+            # Keep all hits, the hit policy is applied to hits of a read
+            # from all partitions.
+            partArgs.hitPolicy = "all"
+            partitions.append((partArgs, self.fileNames.regionTable,
+                               sortPlan))
+
+        with self._profiler.stage("align+filter"):
+            sortedOutputs = _mapInPool(_alignPartition, partitions, nWorkers)
+
+        with self._profiler.stage("merge"):
+            refNames = [name for name, _length in
+                        contigLengths(self.fileNames.targetFileName)]
+            mergeHits(sortedOutputs, self.fileNames.filteredSam,
+                      self.args.hitPolicy, self._alnService.scoreSign,
+                      self.args.seed, self.args.maxHits, refNames)
+
+    def _writeStageStats(self):
+        """Write {out}.stats.json reporting stages of this run if
+        --stageStats is specified."""
+        if self.args.stageStats:
+            self._profiler.setInput(*self._inputStats())
+            self._profiler.write(path.splitext(real_ppath(
+                self.fileNames.outputFileName))[0] + ".stats.json")
+
+    def _inputStats(self):
+        """Return (number of bases, number of reads) of the input file, or
+        (None, None) if they can not be counted."""
+        fileName = real_ppath(self.fileNames.inputFileName)
+        try:
+            inFormat = getFileFormat(fileName)
+            if inFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML]:
+                ds = openDataFile(fileName)
+                return ds.totalLength, ds.numRecords
+            elif inFormat == FILE_FORMATS.FASTA:
+                bases, reads = 0, 0
+                with open(fileName, 'r') as reader:
+                    for line in reader:
+                        if line.startswith('>'):
+                            reads += 1
+                        else:
+                            bases += len(line.strip())
+                return bases, reads
+        except Exception as e:
+            logging.warning("Could not count input bases: " + str(e))
+        return None, None
+
     def _cleanUp(self, realDelete=False):
         """ Clean up temporary files and intermediate results. """
         logging.debug("Clean up temporary files and directories.")
         self._tempFileManager.CleanUp(realDelete)
 
+    def _alignAndSortStreaming(self):
+        """
+        Replace the aligner's temporary output file with a FIFO, start
+        samtools sort reading from it in the background, run blasr to
+        write into it, and finally make bai and pbi for the sorted BAM.
+        """
+        with self._profiler.stage("preprocess"):
+            self._alnService.prepare()
+        fifo = self.fileNames.alignerSamOut
+        remove(fifo)
+        mkfifo(fifo)
+        logging.info("Stream aligned reads to samtools sort through {f}.".
+                     format(f=fifo))
+
+        # No filtering is required, sort the aligner's output directly.
+        self.fileNames.filteredSam = fifo
+        # samtools sort runs at the same time as the aligner.
+        sortPlan = self._planSort(reservedBytes=alignerFootprint(
+            self.fileNames.targetFileName, self.args.nproc))
+        postService = BamPostService(filenames=self.fileNames,
+                                     nproc=self.args.nproc,
+                                     profiler=self._profiler,
+                                     sortPlan=sortPlan)
+        sortProcess = postService.startSort()
+        # samtools sort is killed if the aligner fails or pbalign exits.
+        with self._profiler.stage("align+sort"):
+            FeedFifo("Streaming", sortProcess, fifo, self._alnService.align)
+        postService.run(sortProcess=sortProcess)
+
     def run(self):
         """
         The main function, it is called by PBToolRunner.start().
         """
         startTime = time.time()
+        self._profiler = StageProfiler()
         logging.info("pbalign version: %s", get_version())
         #logging.debug("Original arguments: " + str(self._argumentList))
 
@@ -236,38 +685,168 @@ class PBAlignRunner(PBToolRunner):
         # Make sane.
         self._makeSane(self.args, self.fileNames)
 
-        # Run align service.
-        self._alnService.run()
+        # Only align movies which are not in existing alignments yet,
+        # which replaces the input, so keep the original one.
+        self._inputFileName = self.fileNames.inputFileName
+        if self.args.existingAlignments is not None and \
+                not self._planIncrement():
+            logging.info("All movies of the input are aligned already.")
+            with self._profiler.stage("output"):
+                self._writeAlignmentSet(self._existingBams,
+                                        self.fileNames.targetFileName,
+                                        self.fileNames.outputFileName,
+                                        self.args.readType)
+            self._writeStageStats()
+            self._cleanUp(False if (hasattr(self.args, "keepTmpFiles") and
+                                    self.args.keepTmpFiles is True) else True)
+            return 0
 
         # Create a temporary filtered SAM/BAM file as output for FilterService.
         outFormat = getFileFormat(self.fileNames.outputFileName)
         suffix = ".bam" if outFormat in \
                 [FILE_FORMATS.BAM, FILE_FORMATS.XML] else ".sam"
-        self.fileNames.filteredSam = self._tempFileManager.\
-            RegisterNewTmpFile(suffix=suffix)
-
-        # Call filter service on SAM or BAM file.
-        self._filterService = FilterService(self.fileNames.alignerSamOut,
-                                            self.fileNames.targetFileName,
-                                            self.fileNames.filteredSam,
-                                            self.args.algorithm,
-                                            #self._alnService.name,
-                                            self._alnService.scoreSign,
-                                            self.args,
-                                            self.fileNames.adapterGffFileName)
-        self._filterService.run()
+
+        # Keep intermediate files in a work dir next to the output file,
+        # in order to resume from them.
+        self._manifest = None
+        if self.args.resume:
+            workDir = self._workDir()
+            # Stages depend on the original input rather than the dataset
+            # of its new movies, which is written again by every run.
+            options = copy(self.args)
+            options.inputFileName = self._inputFileName
+            self._manifest = RunManifest(workDir, options)
+            self._tempFileManager.RegisterExistingTmpFile(workDir, own=True,
+                                                          isDir=True)
+            self.fileNames.filteredSam = path.join(workDir,
+                                                   "filtered" + suffix)
+            self.fileNames.alignerSamOut = path.join(workDir,
+                                                     "aligned" + suffix)
+        else:
+            self.fileNames.filteredSam = self._tempFileManager.\
+                RegisterNewTmpFile(suffix=suffix)
+
+        # Input files of alignment stages.
+        alignInputs = [real_ppath(self._inputFileName),
+                       self.fileNames.targetFileName]
+        if self._existingBams is not None:
+            alignInputs.extend(self._existingBams)
+        if self.fileNames.regionTable is not None:
+            alignInputs.append(self.fileNames.regionTable)
+
+        # Partition the reference if it does not fit in memory.
+        partitionFastas = [self.fileNames.targetFileName]
+        if self.args.maxReferenceMemory is not None:
+            with self._profiler.stage("split"):
+                partitionFastas = partitionReference(
+                    self.fileNames.targetFileName,
+                    self.args.maxReferenceMemory,
+                    self._tempFileManager.RegisterNewTmpFile(
+                        isDir=True, prefix="partitions"))
+
+        # Split the input into shards if more than one shard is required.
+        shardInputs = [self.fileNames.inputFileName]
+        nShards = max(1, int(self.args.shards))
+        if nShards > 1 or self.args.maxShardMinutes is not None:
+            maxBases = maxBasesForWallTime(self.args.maxShardMinutes,
+                                           int(self.args.nproc) // nShards)
+            with self._profiler.stage("split"):
+                shardInputs = self._splitInput(nShards, maxBases,
+                                               alignInputs)
+
+        # blasr filters hits in-line, so its BAM output can be sorted
+        # as it is being written.
+        streaming = (self.args.streaming and not self.args.resume and
+                     not self.args.incrementalMerge and
+                     len(shardInputs) == 1 and
+                     len(partitionFastas) == 1 and
+                     self.args.algorithm == "blasr" and
+                     not self.args.filterAdapterOnly and
+                     outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML])
+
+        # Sort BAM shards by coordinate in their workers, so that they
+        # only have to be merged instead of sorting all hits again.
+        sortedShards = None
+        if len(shardInputs) > 1 and len(partitionFastas) == 1 and \
+                outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML]:
+            sortedDir = path.dirname(shardInputs[0]) \
+                if self._manifest is None else self._manifest.workDir
+            sortedShards = [path.join(sortedDir, "sorted{0}.bam".format(i))
+                            for i in range(len(shardInputs))]
+
+        if len(partitionFastas) > 1:
+            # Align to partitions, filter and merge hits of each read.
+            runStage(self._manifest, "align+filter", alignInputs,
+                     [self.fileNames.filteredSam],
+                     lambda: self._alignPartitions(partitionFastas, suffix))
+        elif len(shardInputs) > 1:
+            # Align, filter and merge shards, which are resumed only if
+            # the shards have not been split again.
+            runStage(self._manifest, "align+filter",
+                     alignInputs + shardInputs,
+                     sortedShards or [self.fileNames.filteredSam],
+                     lambda: self._alignShards(shardInputs, suffix,
+                                               sortedShards))
+        elif streaming:
+            # Align, sort and make index through a named pipe.
+            self._alignAndSortStreaming()
+        else:
+            # Run align service. Inputs are prepared even if the align
+            # stage is resumed, since filtering needs them too.
+            with self._profiler.stage("preprocess"):
+                self._alnService.prepare()
+
+            def align():
+                """Align reads."""
+                with self._profiler.stage("align"):
+                    self._alnService.align()
+            runStage(self._manifest, "align", alignInputs,
+                     [self.fileNames.alignerSamOut], align)
+
+            # Call filter service on SAM or BAM file.
+            self._filterService = FilterService(
+                self.fileNames.alignerSamOut,
+                self.fileNames.targetFileName,
+                self.fileNames.filteredSam,
+                self.args.algorithm,
+                #self._alnService.name,
+                self._alnService.scoreSign,
+                self.args,
+                self.fileNames.adapterGffFileName)
+            with self._profiler.stage("filter"):
+                runStage(self._manifest, "filter",
+                         [self.fileNames.alignerSamOut],
+                         [self.fileNames.filteredSam],
+                         self._filterService.run)
+
+        # Merge existing alignments with sorted new alignments.
+        if self._existingBams is not None and self.args.incrementalMerge:
+            if sortedShards is None:
+                sortedShards = [self._sortFiltered()]
+            sortedShards = self._existingBams + sortedShards
 
         # Sort bam before output
-        if outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML]:
+        if outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML] and \
+                not streaming:
             # Sort/make index for BAM output.
-            BamPostService(filenames=self.fileNames, nproc=self.args.nproc).run()
+            # Only PacBio BAM files produced by blasr can have pbi.
+            BamPostService(filenames=self.fileNames, nproc=self.args.nproc,
+                           makePbi=(self.args.algorithm == "blasr"),
+                           profiler=self._profiler,
+                           manifest=self._manifest,
+                           sortedShards=sortedShards,
+                           sortPlan=self._planSort(
+                               dataFile=self.fileNames.filteredSam)).run()
 
         # Output all hits in SAM, BAM.
-        self._output(
-            inSam=self.fileNames.filteredSam,
-            refFile=self.fileNames.targetFileName,
-            outFile=self.fileNames.outputFileName,
-            readType=self.args.readType)
+        with self._profiler.stage("output"):
+            self._output(
+                inSam=self.fileNames.filteredSam,
+                refFile=self.fileNames.targetFileName,
+                outFile=self.fileNames.outputFileName,
+                readType=self.args.readType)
+
+        self._writeStageStats()
 
         # Delete temporay files anyway to make
         self._cleanUp(False if (hasattr(self.args, "keepTmpFiles") and
@@ -297,9 +876,24 @@ resolved_tool_contract_runner = functools.partial(
 resolved_tool_contract_runner_ccs = functools.partial(
     _resolved_tool_contract_runner, ConsensusAlignmentSet)
 
+def _exitOnSignal(signum, _frame):
+    """Exit on SIGTERM, so that running external commands are killed
+    instead of being left behind."""
+    logging.error("Received signal {0}, exit.".format(signum))
+    raise SystemExit(128 + signum)
+
 def main(argv=sys.argv, get_parser_func=get_contract_parser,
          contract_runner_func=resolved_tool_contract_runner):
-    """Main, supporting both args runner and tool contract runner."""
+    """Main, supporting both args runner and tool contract runner,
+    `pbalign serve` which runs jobs submitted on a Unix socket, and
+    `pbalign batch` which aligns inputs listed in a manifest."""
+    signal.signal(signal.SIGTERM, _exitOnSignal)
+    if len(argv) > 1 and argv[1] == "serve":
+        from pbalign.server import main as serve_main
+        return serve_main(argv[2:])
+    if len(argv) > 1 and argv[1] == "batch":
+        from pbalign.batch import main as batch_main
+        return batch_main(argv[2:])
     return pbparser_runner(
         argv=argv[1:],
         parser=get_parser_func(),
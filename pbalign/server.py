@@ -0,0 +1,573 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class PBAlignServer, a long-lived `pbalign serve`
+daemon which accepts alignment jobs on a local Unix socket and runs them
+through a bounded pool of workers.
+
+Each request is a line of JSON, for example
+    {"input": "/data/a.subreads.bam", "reference": "/refs/amp1.fasta",
+     "output": "/data/a.aligned.bam", "options": ["--nproc", "4"],
+     "client": "lims", "wait": true}
+and each response is a line of JSON with the job id, its state and, once
+finished, its exit code. Jobs are queued per client and dequeued round
+robin, so that one client submitting hundreds of jobs can not starve
+others. All jobs share the server's --indexCacheDir, so that suffix
+arrays are built once, and recently used references and their cached
+indexes are kept page-cache warm. Only the user running the server may
+connect to the socket, since jobs run with that user's permissions.
+"""
+
+from __future__ import absolute_import
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from os import path
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from pbalign.utils.fileutil import checkReferencePath
+from pbalign.utils.indexcache import IndexCache, INDEX_CACHE_DIR_ENV
+from pbalign.utils.progutil import Run
+
+# Number of bytes read at a time when warming a file.
+_WARM_CHUNK_BYTES = 1 << 22
+
+# Maximum size of a request line.
+_MAX_REQUEST_BYTES = 1 << 20
+
+# Options of a job whose values are paths.
+_PATH_OPTIONS = ("--regionTable", "--configFile", "--pulseFile",
+                 "--existingAlignments", "--unaligned", "--indexCacheDir",
+                 "--tmpDir", "--log-file")
+
+
+def runPBAlignJob(argv, timeout=None):
+    """Run pbalign with argv in a child process.
+    Input:
+        argv   : pbalign arguments, excluding the program name
+        timeout: seconds after which the job is killed, or None
+    Output:
+        an ExecResult of the child process
+    """
+    cmd = [sys.executable, "-m", "pbalign.pbalignrunner"] + list(argv)
+    return Run("pbalign job", cmd, timeout=timeout, logStderr=False)
+
+
+def _dirFiles(dirName):
+    """Return all files under a directory."""
+    return [path.join(root, fn)
+            for root, _dirs, fns in os.walk(dirName) for fn in fns]
+
+
+def _indexFiles(fileName):
+    """Return a file and its index files named after it, such as
+    ref.fasta.fai and ref.fasta.sa of ref.fasta. Other references sharing
+    a prefix, such as ref2.fasta, are not included."""
+    dirName, baseName = path.split(fileName)
+    return [path.join(dirName, fn) for fn in os.listdir(dirName or ".")
+            if (fn == baseName or fn.startswith(baseName + ".")) and
+            path.isfile(path.join(dirName, fn))]
+
+
+def _optionValue(argv, option):
+    """Return the value of the last option in argv, given either as
+    '--option value' or '--option=value', or None if it is absent."""
+    value = None
+    for i, arg in enumerate(argv):
+        if arg == option and i + 1 < len(argv):
+            value = argv[i + 1]
+        elif arg.startswith(option + "="):
+            value = arg[len(option) + 1:]
+    return value
+
+
+def _resolvePathOptions(options, cwd):
+    """Return options, with relative values of path options, given either
+    as '--option value' or '--option=value', resolved against cwd."""
+    resolved = []
+    for i, arg in enumerate(options):
+        if i > 0 and options[i - 1] in _PATH_OPTIONS:
+            arg = path.abspath(path.join(cwd, arg))
+        else:
+            option, sep, value = arg.partition("=")
+            if sep and option in _PATH_OPTIONS:
+                arg = option + "=" + path.abspath(path.join(cwd, value))
+        resolved.append(arg)
+    return resolved
+
+
+def _referenceFiles(refPath, indexCacheDir=None):
+    """Return files which a job aligning to a reference loads, i.e.,
+    files of the reference resolved the way pbalign does (all files of a
+    reference repository, or a FASTA or ReferenceSet XML file, the FASTA
+    file it refers to and their index files), and indexes of the FASTA
+    file cached in indexCacheDir, such as <sha1>.blt8.sa, <sha1>.bt2 and
+    <sha1>.gmap."""
+    refPath, fastaFile, saFile, _isWithinRepository, _gff = \
+        checkReferencePath(refPath)
+    if path.isdir(refPath):
+        files = _dirFiles(refPath)
+    else:
+        files = _indexFiles(refPath) + _indexFiles(fastaFile)
+        if saFile is not None and path.isfile(saFile):
+            files.append(saFile)
+
+    if indexCacheDir is None or indexCacheDir == "":
+        indexCacheDir = os.environ.get(INDEX_CACHE_DIR_ENV)
+    if indexCacheDir is not None and indexCacheDir != "" and \
+            path.isdir(indexCacheDir):
+        # Only look up entries, which are never fetched nor evicted here.
+        indexCache = IndexCache(indexCacheDir, 0)
+        for entry in indexCache.entriesOf(fastaFile):
+            files.extend(_dirFiles(entry) if path.isdir(entry) else [entry])
+    return sorted(set(files))
+
+
+def warmFile(fileName):
+    """Read a file through, so that it is loaded into the page cache.
+    Return the number of bytes read."""
+    nBytes = 0
+    with open(fileName, 'rb') as reader:
+        while True:
+            chunk = reader.read(_WARM_CHUNK_BYTES)
+            if not chunk:
+                break
+            nBytes += len(chunk)
+    return nBytes
+
+
+class ReferenceWarmer(object):
+    """Keep the most recently used references page-cache warm. Workers only
+    mark references as used; a thread reads files of the maxReferences most
+    recently used references through every interval seconds, and as soon
+    as a new reference is used, so that pages evicted since are loaded
+    again without delaying jobs."""
+    def __init__(self, maxReferences, interval=60):
+        self.maxReferences = int(maxReferences)
+        self.interval = float(interval)
+        self._refs = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def references(self):
+        """Return warm references, the least recently used first."""
+        with self._lock:
+            return list(self._refs.keys())
+
+    def touch(self, refPath, indexCacheDir=None):
+        """Mark a reference and its indexes cached in indexCacheDir as
+        used, without reading them. Return True if the reference was not
+        among the recently used ones."""
+        refPath = path.abspath(refPath)
+        with self._lock:
+            new = refPath not in self._refs
+            self._refs.pop(refPath, None)
+            self._refs[refPath] = indexCacheDir
+            while len(self._refs) > self.maxReferences:
+                self._refs.popitem(last=False)
+        if new:
+            self._wakeup.set()
+        return new
+
+    def warm(self):
+        """Read files of recently used references through. Return the
+        number of bytes read."""
+        with self._lock:
+            refs = list(self._refs.items())
+        nBytes = 0
+        for refPath, indexCacheDir in refs:
+            try:
+                nBytes += sum(warmFile(fn) for fn in
+                              _referenceFiles(refPath, indexCacheDir))
+            except (IOError, OSError) as e:
+                logging.warning("Could not warm reference {r}: {e}".format(
+                    r=refPath, e=e))
+        logging.debug("Warmed {n} references ({b} bytes).".format(
+            n=len(refs), b=nBytes))
+        return nBytes
+
+    def _run(self):
+        """Warm references until stopped."""
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped:
+                return
+            self.warm()
+
+    def start(self):
+        """Start warming references in a thread."""
+        self._thread = threading.Thread(target=self._run,
+                                        name="pbalign-warmer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread, waiting for a warming in progress to finish."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class FairQueue(object):
+    """A queue of jobs which are dequeued round robin over clients."""
+    def __init__(self):
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def put(self, client, item):
+        """Enqueue an item of a client."""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Queue is closed.")
+            self._queues.setdefault(client, deque()).append(item)
+            self._cond.notify()
+
+    def get(self):
+        """Dequeue an item of the next client, blocking until there is one.
+        Return None if the queue is closed."""
+        with self._cond:
+            while not self._queues and not self._closed:
+                self._cond.wait(1)
+            if not self._queues:
+                return None
+            client, items = self._queues.popitem(last=False)
+            item = items.popleft()
+            if items:
+                # Move the client to the end of the round.
+                self._queues[client] = items
+            return item
+
+    def close(self):
+        """Close the queue, so that get() returns None once it is empty."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def drain(self):
+        """Close the queue and remove all items still queued, so that get()
+        returns None at once. Return the removed items."""
+        with self._cond:
+            items = [item for q in self._queues.values() for item in q]
+            self._queues.clear()
+            self._closed = True
+            self._cond.notify_all()
+            return items
+
+
+class Job(object):
+    """An alignment job submitted to a PBAlignServer."""
+    def __init__(self, jobId, client, reference, argv):
+        self.jobId = jobId
+        self.client = client
+        self.reference = reference
+        self.argv = argv
+        self.state = "queued"
+        self.exitCode = None
+        self.errMsg = None
+        self.seconds = None
+        self.done = threading.Event()
+
+    def toDict(self):
+        """Return a dict describing the job."""
+        return {"id": self.jobId, "client": self.client,
+                "state": self.state, "exitCode": self.exitCode,
+                "errMsg": self.errMsg, "seconds": self.seconds}
+
+
+def jobArgv(request, indexCacheDir=None):
+    """Return pbalign arguments of a job request.
+    Input:
+        request      : a dict with input, reference and output paths,
+                       optional options (a list of pbalign options) and
+                       optional cwd, against which relative paths, also
+                       those of path options, are resolved.
+        indexCacheDir: the server's index cache dir, used unless the
+                       request specifies its own.
+    Output:
+        a tuple of (reference, argv)
+    """
+    for key in ("input", "reference", "output"):
+        if not isinstance(request.get(key), basestring):
+            raise ValueError("Job request must specify {0}.".format(key))
+    options = request.get("options", [])
+    if not isinstance(options, list) or \
+       not all(isinstance(o, basestring) for o in options):
+        raise ValueError("Job options must be a list of strings.")
+    cwd = request.get("cwd", os.getcwd())
+    paths = [path.abspath(path.join(cwd, request[key]))
+             for key in ("input", "reference", "output")]
+    options = _resolvePathOptions(options, cwd)
+    if indexCacheDir is not None and \
+       not any(o.startswith("--indexCacheDir") for o in options):
+        options += ["--indexCacheDir", indexCacheDir]
+    return paths[1], options + paths
+
+
+class PBAlignServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    """A daemon which runs pbalign jobs submitted on a Unix socket. Only
+    the maxFinishedJobs most recently finished jobs are kept, so that their
+    status can be asked for."""
+    daemon_threads = True
+
+    def __init__(self, socketPath, workers=1, indexCacheDir=None,
+                 maxReferences=5, jobTimeout=None, runJob=runPBAlignJob,
+                 maxFinishedJobs=1000, warmInterval=60):
+        if path.exists(socketPath):
+            # Remove a stale socket left behind by a dead server.
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socketPath)
+            except socket.error:
+                os.remove(socketPath)
+            else:
+                errMsg = "A server is already listening on {0}.".format(
+                    socketPath)
+                logging.error(errMsg)
+                raise RuntimeError(errMsg)
+            finally:
+                probe.close()
+        socketserver.UnixStreamServer.__init__(self, socketPath,
+                                               _RequestHandler)
+        self.socketPath = socketPath
+        self.indexCacheDir = indexCacheDir
+        self.jobTimeout = jobTimeout
+        self.runJob = runJob
+        self.warmer = ReferenceWarmer(maxReferences, warmInterval)
+        self.warmer.start()
+        self.queue = FairQueue()
+        self._jobs = {}
+        self._finished = deque()
+        self.maxFinishedJobs = int(maxFinishedJobs)
+        self._nextId = 1
+        self._lock = threading.Lock()
+        self._workers = []
+        for i in range(max(1, int(workers))):
+            worker = threading.Thread(target=self._work,
+                                      name="pbalign-worker-{0}".format(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def server_bind(self):
+        """Bind the socket, and only allow the daemon user to connect,
+        since jobs run with the daemon user's permissions."""
+        socketserver.UnixStreamServer.server_bind(self)
+        os.chmod(self.server_address, 0o600)
+
+    def submit(self, request):
+        """Queue a job request and return its Job."""
+        reference, argv = jobArgv(request, self.indexCacheDir)
+        client = str(request.get("client", "default"))
+        with self._lock:
+            job = Job(self._nextId, client, reference, argv)
+            self._jobs[job.jobId] = job
+            self._nextId += 1
+        self.queue.put(client, job)
+        logging.info("Queued job {i} of {c}: {a}".format(
+            i=job.jobId, c=client, a=" ".join(argv)))
+        return job
+
+    def job(self, jobId):
+        """Return a submitted Job by its id."""
+        with self._lock:
+            if jobId not in self._jobs:
+                raise ValueError("Unknown job {0}.".format(jobId))
+            return self._jobs[jobId]
+
+    def _work(self):
+        """Run queued jobs until the queue is closed."""
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.state = "running"
+            startTime = time.time()
+            try:
+                self.warmer.touch(job.reference,
+                                  _optionValue(job.argv, "--indexCacheDir"))
+                result = self.runJob(job.argv, timeout=self.jobTimeout)
+                job.exitCode = result.errCode
+                if result.errCode != 0:
+                    job.errMsg = result.errMsg
+            except Exception as e:
+                logging.exception("Job {0} failed.".format(job.jobId))
+                job.exitCode, job.errMsg = 1, str(e)
+            job.seconds = round(time.time() - startTime, 3)
+            job.state = "done" if job.exitCode == 0 else "failed"
+            logging.info("Job {i} {s} in {t} s.".format(
+                i=job.jobId, s=job.state, t=job.seconds))
+            job.done.set()
+            self._retire(job)
+
+    def _retire(self, job):
+        """Forget the oldest finished jobs once more than maxFinishedJobs
+        jobs have finished."""
+        with self._lock:
+            self._finished.append(job.jobId)
+            while len(self._finished) > self.maxFinishedJobs:
+                del self._jobs[self._finished.popleft()]
+
+    def server_close(self):
+        """Cancel queued jobs, stop workers once running jobs finish (or
+        time out after jobTimeout), and remove the socket."""
+        socketserver.UnixStreamServer.server_close(self)
+        for job in self.queue.drain():
+            job.state = "cancelled"
+            job.errMsg = "Server shut down before the job started."
+            logging.info("Job {i} cancelled.".format(i=job.jobId))
+            job.done.set()
+        for worker in self._workers:
+            worker.join()
+        self.warmer.stop()
+        if path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+    def handle(self, request):
+        """Handle a request dict and return a response dict."""
+        if not isinstance(request, dict):
+            raise ValueError("A request must be a JSON object.")
+        op = request.get("op", "submit")
+        if op == "submit":
+            job = self.submit(request)
+            if request.get("wait", False):
+                job.done.wait()
+            return job.toDict()
+        if op == "status":
+            return self.job(request.get("id")).toDict()
+        if op == "wait":
+            job = self.job(request.get("id"))
+            job.done.wait()
+            return job.toDict()
+        if op == "info":
+            return {"queued": len(self.queue),
+                    "references": self.warmer.references()}
+        if op == "shutdown":
+            threading.Thread(target=self.shutdown).start()
+            return {"state": "shutdown"}
+        raise ValueError("Unknown op {0}.".format(op))
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Handle lines of JSON requests of a connection."""
+    def handle(self):
+        while True:
+            line = self.rfile.readline(_MAX_REQUEST_BYTES)
+            if not line:
+                return
+            if not line.strip():
+                continue
+            try:
+                response = self.server.handle(json.loads(line))
+            except (ValueError, RuntimeError) as e:
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+def request(socketPath, req):
+    """Send a request dict to a server and return its response dict."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketPath)
+        stream = client.makefile('rwb')
+        stream.write(json.dumps(req) + "\n")
+        stream.flush()
+        line = stream.readline()
+    finally:
+        client.close()
+    if not line:
+        raise IOError("No response from {0}.".format(socketPath))
+    return json.loads(line)
+
+
+def main(argv=sys.argv[1:]):
+    """Main of `pbalign serve`."""
+    parser = argparse.ArgumentParser(
+        prog="pbalign serve",
+        description="Run pbalign jobs submitted on a Unix socket.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("socketPath", help="Path of the Unix socket.")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="Number of jobs to run concurrently.")
+    parser.add_argument("--indexCacheDir", default=None,
+                        help="Index cache dir shared by all jobs.")
+    parser.add_argument("--maxReferences", type=int, default=5,
+                        help="Number of recently used references to keep " +
+                             "page-cache warm.")
+    parser.add_argument("--warmInterval", type=float, default=60,
+                        help="Seconds between reading recently used " +
+                             "references through.")
+    parser.add_argument("--jobTimeout", type=float, default=None,
+                        help="Seconds after which a job is killed.")
+    parser.add_argument("--maxFinishedJobs", type=int, default=1000,
+                        help="Number of recently finished jobs whose " +
+                             "status is kept.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s [%(levelname)s] %(message)s")
+
+    server = PBAlignServer(args.socketPath, workers=args.workers,
+                           indexCacheDir=args.indexCacheDir,
+                           maxReferences=args.maxReferences,
+                           jobTimeout=args.jobTimeout,
+                           maxFinishedJobs=args.maxFinishedJobs,
+                           warmInterval=args.warmInterval)
+    logging.info("Listening on {0}.".format(args.socketPath))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
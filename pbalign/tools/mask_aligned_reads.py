@@ -8,7 +8,9 @@ import sys
 import logging
 import argparse
 import re
+from multiprocessing import Pool
 
+import numpy as np
 from pbcore.io import CmpH5Reader, EmptyCmpH5Error
 import traceback
 from pbalign.utils.RgnH5IO import RgnH5Reader, RgnH5Writer
@@ -16,26 +18,97 @@ from pbalign.utils.RgnH5IO import RgnH5Reader, RgnH5Writer
 __VERSION__ = "0.3.2"
 
 
+# Check for new format generated from bax files.
+# m130226_022844_...131362_s1_p0.3.rgn.h5
+_BAX_RGN_RX = re.compile(r'\.[0-9].rgn\.h5')
+
+
+# Aligned reads of the masker, shared by worker processes.
+_ALIGNED_READS = {}
+
+
+def _initWorker(alignedReads):
+    """Set aligned reads in a worker process."""
+    global _ALIGNED_READS
+    _ALIGNED_READS = alignedReads
+
+
+def _maskRgnH5(task):
+    """Mask aligned reads in a region table file, and return a tuple of
+    (input rgn.h5, output rgn.h5, error message or None).
+    Input: task - a tuple of (input rgn.h5 file, output directory)
+    """
+    rgnH5FN, outDir = task
+    outH5FN = None
+    try:
+        with RgnH5Reader(rgnH5FN) as rgnReader:
+            basename = os.path.basename(rgnH5FN)
+            # Default movie name
+            movieName = rgnReader.movieName
+
+            # 'movieId' is used to write the file compatible with bax style.
+            # m130226_022844_ethan_c100471672550000001823071906131362_s1_p0.3
+            if _BAX_RGN_RX.search(basename):
+                movieId = re.split(r'.rgn\.h5', basename)[0]
+            else:
+                # old format
+                # m130226_022844_....131362_s1_p0.rgn.h5
+                movieId = movieName
+
+            outH5FN = os.path.abspath(os.path.join(outDir,
+                                      movieId + ".rgn.h5"))
+            with RgnH5Writer(outH5FN) as rgnWriter:
+                rgnWriter.writeScanDataGroup(rgnReader.scanDataGroup)
+
+                logging.info("Processing {f}...".format(f=rgnH5FN))
+                columns = rgnReader.columns
+                if movieName in _ALIGNED_READS:
+                    holeNumbers = np.fromiter(
+                        _ALIGNED_READS[movieName], np.int32,
+                        len(_ALIGNED_READS[movieName]))
+                    rgnWriter.addRegions(
+                        columns.setHQRegions(holeNumbers, 0, 0))
+                else:
+                    rgnWriter.addRegions(columns)
+    except Exception as e:
+        logging.debug("Failed to process {f}.".format(f=rgnH5FN),
+                      exc_info=True)
+        # Do not leave a partial region table behind.
+        if outH5FN is not None and os.path.exists(outH5FN):
+            os.remove(outH5FN)
+        return rgnH5FN, None, str(e)
+    return rgnH5FN, outH5FN, None
+
+
 class AlignedReadsMasker(object):
     """Mask aligned reads in a region table.
     Input: inCmpFile - a cmp.h5 file with alignments.
            inRgnFofn - a input fofn of region table files.
+           nproc - number of processes masking region table files.
     Output: outRgnFofn - a output fofn of region table files.
     Generate new rgn.h5 files, which mask aligned reads in `inRgnFofn`
     by overwritting their corresponding HQ regions to (0, 0). The
     generated new rgn.h5 files have to be stored in the same directory
     as `outRgnFofn`.
     """
-    def __init__(self, inCmpFile, inRgnFofn, outRgnFofn):
+    def __init__(self, inCmpFile, inRgnFofn, outRgnFofn, nproc=1):
         self.inCmpFile = inCmpFile
         self.inRgnFofn = inRgnFofn
         self.outRgnFofn = outRgnFofn
+        self.nproc = int(nproc)
 
     def maskAlignedReads(self):
         """Mask aligned zmws in region tables."""
         logging.info("Log level set to INFO")
         logging.debug("Log Level set to DEBUG")
 
+        rgnH5FNs = [line.strip() for line in open(self.inRgnFofn, 'r')]
+        for rgnH5FN in rgnH5FNs:
+            if not rgnH5FN.endswith("rgn.h5"):
+                logging.error("Region table file " +
+                              "{0} should be a rgn.h5 file.".format(rgnH5FN))
+                return 1
+
         alignedReads = self._extractAlignedReads()
         nreads = sum([len(v) for v in alignedReads.values()])
         logging.info("Extracted {r} reads ({m} movies) from {f}".format(
@@ -46,49 +119,41 @@ class AlignedReadsMasker(object):
         if not os.path.exists(outDir):
             os.mkdir(outDir)
 
-        outRgnFofn = open(self.outRgnFofn, 'w')
-
-        # Check for new format generated from bax files.
-        # m130226_022844_...131362_s1_p0.3.rgn.h5
-        rx = re.compile(r'\.[0-9].rgn\.h5')
-
-        for rgnH5FN in [line.strip() for line in open(self.inRgnFofn, 'r')]:
-            if not rgnH5FN.endswith("rgn.h5"):
-                logging.error("Region table file " +
-                              "{0} should be a rgn.h5 file.".format(rgnH5FN))
-                return 1
-            rgnReader = RgnH5Reader(rgnH5FN)
-
-            basename = os.path.basename(rgnH5FN)
-            # Default movie name
-            movieName = rgnReader.movieName
-
-            # 'movieId' is used to write the file compatible with bax style.
-            # m130226_022844_ethan_c100471672550000001823071906131362_s1_p0.3
-            if rx.search(basename):
-                movieId = re.split(r'.rgn\.h5', basename)[0]
-            else:
-                # old format
-                # m130226_022844_....131362_s1_p0.rgn.h5
-                movieId = movieName
-
-            outH5FN = os.path.abspath(os.path.join(outDir,
-                                      movieId + ".rgn.h5"))
-            outRgnFofn.write("{o}\n".format(o=outH5FN))
-            rgnWriter = RgnH5Writer(outH5FN)
-            rgnWriter.writeScanDataGroup(rgnReader.scanDataGroup)
-
-            logging.info("Processing {f}...".format(f=rgnH5FN))
-            for rt in rgnReader:
-                if movieName in alignedReads and \
-                   rt.holeNumber in alignedReads[movieName]:
-                    rt.setHQRegion(0, 0)
-                rgnWriter.addRegionTable(rt)
-
-            rgnReader.close()
-            rgnWriter.close()
-
-        outRgnFofn.close()
+        tasks = [(rgnH5FN, outDir) for rgnH5FN in rgnH5FNs]
+        nproc = max(1, min(self.nproc, len(tasks)))
+        if nproc == 1:
+            _initWorker(alignedReads)
+            results = [_maskRgnH5(task) for task in tasks]
+        else:
+            pool = Pool(processes=nproc, initializer=_initWorker,
+                        initargs=(alignedReads,))
+            try:
+                results = pool.map(_maskRgnH5, tasks, chunksize=1)
+                pool.close()
+            except Exception:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        failed = [(rgnH5FN, errMsg) for rgnH5FN, _outH5FN, errMsg in results
+                  if errMsg is not None]
+        if len(failed) > 0:
+            # Do not leave outputs of a failed run behind, which would look
+            # like valid results.
+            for _rgnH5FN, outH5FN, _errMsg in results:
+                if outH5FN is not None and os.path.exists(outH5FN):
+                    os.remove(outH5FN)
+            errMsg = "Could not mask {n} region table files:\n{f}".format(
+                n=len(failed), f="\n".join("{f}: {e}".format(f=f, e=e)
+                                           for f, e in failed))
+            logging.error(errMsg)
+            raise IOError(errMsg)
+
+        # Keep the order of the input fofn.
+        with open(self.outRgnFofn, 'w') as outRgnFofn:
+            for _rgnH5FN, outH5FN, _errMsg in results:
+                outRgnFofn.write("{o}\n".format(o=outH5FN))
         return 0
 
     def _extractAlignedReads(self):
@@ -135,6 +200,9 @@ def getParser():
     parser.add_argument(
         "-i", "--info", default=False, action="store_true",
         help="Display informative log entries")
+    parser.add_argument(
+        "--nproc", type=int, default=1,
+        help="Number of processes masking region table files.")
     parser.add_argument(
         "inCmpFile", type=str,
         help="An input cmp.h5 file.")
@@ -166,17 +234,16 @@ def configLog(isInfo, isDebug, logFile):
                             format=logFormat)
 
 
-def run(inCmpFile, inRgnFofn, outRgnFofn):
+def run(inCmpFile, inRgnFofn, outRgnFofn, nproc=1):
     """Main function to run mask aligned reads()."""
 
-    masker = AlignedReadsMasker(inCmpFile, inRgnFofn, outRgnFofn)
+    masker = AlignedReadsMasker(inCmpFile, inRgnFofn, outRgnFofn, nproc)
     try:
-        masker.maskAlignedReads()
+        return masker.maskAlignedReads()
     except Exception as e:
         logging.error(e, exc_info=True)
         traceback.print_exc(file=sys.stderr)
         return 1
-    return 0
 
 
 def main():
@@ -185,7 +252,7 @@ def main():
     args = parser.parse_args()
     configLog(args.debug, args.info, args.logFile)
 
-    rcode = run(args.inCmpFile, args.inRgnFofn, args.outRgnFofn)
+    rcode = run(args.inCmpFile, args.inRgnFofn, args.outRgnFofn, args.nproc)
     logging.info("Exiting {f} {v} with rturn code {r}.".format(
                  r=rcode, f="mask_aligned_reads.py", v=__VERSION__))
     return rcode
@@ -4,13 +4,15 @@
 Region table reader and writer.
 """
 from __future__ import print_function
-__all__ = ["RgnH5Reader",
+__all__ = ["RegionColumns",
+           "RgnH5Reader",
            "RgnH5Writer"]
 import h5py
 import os.path as op
+from collections import OrderedDict
 import numpy as np
 from pbcore.io.BasH5IO import (ADAPTER_REGION, INSERT_REGION) #pylint: disable=no-name-in-module
-from pbcore.io.BasH5IO import (HQ_REGION, REGION_TABLE_DTYPE, toRecArray, _makeRegionTableIndex)
+from pbcore.io.BasH5IO import HQ_REGION #pylint: disable=no-name-in-module
 
 __version__ = "1.0"
 REGION_COLUMN_NAMES = (
@@ -142,11 +144,155 @@ class RegionTable(object):
         return [r.toTuple() for r in self.regions]
 
 
+def _zmwOffsets(holeNumber):
+    """Return (zmws, offsets) of a sorted hole number column, where rows
+    of ZMW zmws[i] are offsets[i] to offsets[i+1]."""
+    firstRows = np.flatnonzero(np.diff(holeNumber)) + 1
+    if len(holeNumber) > 0:
+        firstRows = np.concatenate(([0], firstRows))
+    return holeNumber[firstRows], \
+        np.append(firstRows, len(holeNumber)).astype(np.int64)
+
+
+def _indexOf(zmws, holeNumbers):
+    """Return indices in sorted zmws of holeNumbers, -1 for hole numbers
+    which are not in zmws."""
+    holeNumbers = np.asarray(holeNumbers, dtype=np.int32)
+    if len(zmws) == 0:
+        return np.full(len(holeNumbers), -1, dtype=np.int64)
+    index = np.minimum(np.searchsorted(zmws, holeNumbers), len(zmws) - 1)
+    return np.where(zmws[index] == holeNumbers, index, -1)
+
+
+class RegionColumns(object):
+    """
+    `RegionColumns` represents all rows of a region table as NumPy arrays,
+    so that bulk queries, such as HQ region lengths of all ZMWs, need no
+    per-row Python objects.
+
+    Rows are sorted by hole number, keeping the order of rows within a
+    ZMW. zmws is the array of unique hole numbers in ascending order, and
+    regions of ZMW zmws[i] are rows offsets[i] to offsets[i+1].
+    holeNumber, typeIndex, start, end and score are columns of the rows.
+    """
+
+    def __init__(self, regions):
+        regions = np.asarray(regions, dtype=np.int32).reshape(
+            -1, len(REGION_COLUMN_NAMES))
+        holeNumber = regions[:, 0]
+        if np.any(holeNumber[1:] < holeNumber[:-1]):
+            regions = regions[np.argsort(holeNumber, kind='mergesort')]
+        self.regions = regions
+        self.holeNumber = regions[:, 0]
+        self.typeIndex = regions[:, 1]
+        self.start = regions[:, 2]
+        self.end = regions[:, 3]
+        self.score = regions[:, 4]
+        self.zmws, self.offsets = _zmwOffsets(self.holeNumber)
+
+    def __len__(self):
+        return len(self.regions)
+
+    @property
+    def numZMWs(self):
+        """Return the number of ZMWs."""
+        return len(self.zmws)
+
+    @property
+    def zmwIndex(self):
+        """Return the index in zmws of the ZMW of each row."""
+        return np.repeat(np.arange(self.numZMWs), np.diff(self.offsets))
+
+    @property
+    def length(self):
+        """Return the length (end - start) of each row."""
+        return self.end - self.start
+
+    def indexOf(self, holeNumbers):
+        """Return indices in zmws of holeNumbers, -1 for hole numbers
+        which are not in the region table."""
+        return _indexOf(self.zmws, holeNumbers)
+
+    def rowsOf(self, holeNumber):
+        """Return (startRow, endRow) of regions of a ZMW."""
+        i = self.indexOf([holeNumber])[0]
+        if i < 0:
+            raise KeyError("ZMW %r is not in the region table." % holeNumber)
+        return self.offsets[i], self.offsets[i + 1]
+
+    def regionsOfType(self, typeIndex, default=(0, 0)):
+        """Return (start, end) arrays of the region of typeIndex of each
+        ZMW, default for ZMWs which have no such region, and the last one
+        for ZMWs which have more than one."""
+        isType = self.typeIndex == typeIndex
+        rowZmws = self.zmwIndex[isType]
+        starts = np.full(self.numZMWs, default[0], dtype=np.int32)
+        ends = np.full(self.numZMWs, default[1], dtype=np.int32)
+        starts[rowZmws] = self.start[isType]
+        ends[rowZmws] = self.end[isType]
+        return starts, ends
+
+    @property
+    def hqRegions(self):
+        """Return (start, end) arrays of the HQ region of each ZMW,
+        (0, 0) for ZMWs which have no HQ region."""
+        return self.regionsOfType(HQ_REGION)
+
+    @property
+    def hqRegionLengths(self):
+        """Return the HQ region length of each ZMW."""
+        starts, ends = self.hqRegions
+        return ends - starts
+
+    def setHQRegions(self, holeNumbers, newHQStart=0, newHQEnd=0):
+        """Return a copy of regions, in which HQ regions of ZMWs in
+        holeNumbers are reset to (newHQStart, newHQEnd), and a HQ region
+        is appended to those ZMWs which have none."""
+        selected = np.isin(self.holeNumber, holeNumbers)
+        regions = self.regions.copy()
+        isHQ = selected & (self.typeIndex == HQ_REGION)
+        regions[isHQ, 2] = newHQStart
+        regions[isHQ, 3] = newHQEnd
+
+        # Add HQ regions to selected ZMWs which have none, after their
+        # other regions.
+        hasHQ = np.zeros(self.numZMWs, dtype=bool)
+        hasHQ[self.zmwIndex[isHQ]] = True
+        missing = np.zeros(self.numZMWs, dtype=bool)
+        missing[self.zmwIndex[selected]] = True
+        missing &= ~hasHQ
+        if not np.any(missing):
+            return regions
+        added = np.zeros((np.count_nonzero(missing),
+                          len(REGION_COLUMN_NAMES)), dtype=np.int32)
+        added[:, 0] = self.zmws[missing]
+        added[:, 1] = HQ_REGION
+        added[:, 2] = newHQStart
+        added[:, 3] = newHQEnd
+        return np.insert(regions, self.offsets[1:][missing], added, axis=0)
+
+    def totalLengths(self, typeIndex):
+        """Return the total length of regions of typeIndex of each ZMW."""
+        isType = self.typeIndex == typeIndex
+        return np.bincount(self.zmwIndex[isType],
+                           weights=self.length[isType],
+                           minlength=self.numZMWs).astype(np.int64)
+
+
 class RgnH5Reader(object):
     """
     The `RgnH5Reader` class provides access to rgn.h5 files.
 
     Region tables are usually small (e.g. a few MB), so we can cache all data.
+    Bulk queries should use `columns`, a `RegionColumns` of the table,
+    while iterating the reader yields a `RegionTable` of each ZMW in
+    ascending order of hole numbers.
+
+    With lazy=True, only the HoleNumber column is read when the file is
+    opened, and regions of ZMWs requested by regionTable() or
+    regionColumns() are read in blocks of blockRows rows, of which the
+    cacheBlocks most recently used are cached. The whole table is read
+    only if `columns` is used or the reader is iterated.
 
     To use RgnH5Reader and RgnH5Writer:
         reader = RgnH5Reader(inFileName)
@@ -158,7 +304,7 @@ class RgnH5Reader(object):
         writer.close()
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, lazy=False, blockRows=4096, cacheBlocks=16):
         self.filename = op.abspath(op.expanduser(filename))
         self.file = h5py.File(self.filename, 'r')
         if "Regions" in self.file["/PulseData"]:
@@ -166,19 +312,78 @@ class RgnH5Reader(object):
         else:
             raise TypeError("Unsupported region table which does not " +
                             "contain /PulseData/Regions: %s " % self.filename)
-        self._regionsData = toRecArray(
-            REGION_TABLE_DTYPE, self._regionsGroup.value)
+        self.blockRows = int(blockRows)
+        self.cacheBlocks = int(cacheBlocks)
+        self._blocks = OrderedDict()
+        self._columns = None
+        if lazy:
+            holeNumber = self._regionsGroup[:, 0].astype(np.int32)
+            # Rows can only be read in blocks if they are sorted.
+            if np.any(holeNumber[1:] < holeNumber[:-1]):
+                lazy = False
+            else:
+                self._zmws, self._offsets = _zmwOffsets(holeNumber)
+        if not lazy:
+            self._zmws, self._offsets = self.columns.zmws, \
+                self.columns.offsets
 
-        self._regionTableIndex = _makeRegionTableIndex(
-            self._regionsData.holeNumber)
-        self.holeNumbers = set(self._regionsData.holeNumber)
+    @property
+    def columns(self):
+        """Return a RegionColumns of the whole region table."""
+        if self._columns is None:
+            self._columns = RegionColumns(self._regionsGroup[()])
+            self._blocks.clear()
+        return self._columns
+
+    def _block(self, blockIndex):
+        """Return a block of rows, reading it if it is not cached."""
+        block = self._blocks.pop(blockIndex, None)
+        if block is None:
+            startRow = blockIndex * self.blockRows
+            block = self._regionsGroup[startRow:startRow + self.blockRows]
+            block = block.astype(np.int32)
+        self._blocks[blockIndex] = block
+        while len(self._blocks) > self.cacheBlocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def _readRows(self, startRow, endRow):
+        """Return rows startRow to endRow as an (n, 5) int32 array."""
+        if self._columns is not None:
+            return self._columns.regions[startRow:endRow]
+        first = startRow // self.blockRows
+        last = max(startRow, endRow - 1) // self.blockRows
+        rows = np.concatenate([self._block(i) for i in range(first, last + 1)])
+        offset = first * self.blockRows
+        return rows[startRow - offset:endRow - offset]
+
+    def regionTable(self, holeNumber):
+        """Return a RegionTable of a ZMW, raise KeyError if the ZMW is not
+        in the region table."""
+        i = _indexOf(self._zmws, [holeNumber])[0]
+        if i < 0:
+            raise KeyError("ZMW %r is not in the region table." % holeNumber)
+        rows = self._readRows(self._offsets[i], self._offsets[i + 1])
+        return RegionTable(self._zmws[i], [Region(r) for r in rows])
+
+    def regionColumns(self, holeNumbers):
+        """Return a RegionColumns of regions of ZMWs in holeNumbers,
+        skipping hole numbers which are not in the region table."""
+        index = _indexOf(self._zmws, np.unique(holeNumbers))
+        index = index[index >= 0]
+        rows = [self._readRows(self._offsets[i], self._offsets[i + 1])
+                for i in index]
+        if len(rows) == 0:
+            return RegionColumns(np.zeros((0, len(REGION_COLUMN_NAMES))))
+        return RegionColumns(np.concatenate(rows))
 
     def __iter__(self):
-        for holeNumber in self.holeNumbers:
-            startRow, endRow = self._regionTableIndex[holeNumber]
+        columns = self.columns
+        for i, holeNumber in enumerate(columns.zmws):
+            startRow, endRow = columns.offsets[i], columns.offsets[i + 1]
             yield RegionTable(
                 holeNumber,
-                [Region(r) for r in self._regionsData[startRow:endRow]])
+                [Region(r) for r in columns.regions[startRow:endRow]])
 
     def __enter__(self):
         return self
@@ -205,10 +410,15 @@ class RgnH5Reader(object):
                                     t=type(movieNameString)))
         return movieNameString
 
+    @property
+    def holeNumbers(self):
+        """Return hole numbers of ZMWs in ascending order."""
+        return self._zmws
+
     @property
     def numZMWs(self):
         """Return the number of ZMWs in the region table."""
-        return len(self.holeNumbers)
+        return len(self._zmws)
 
     @property
     def scanDataGroup(self):
@@ -228,15 +438,29 @@ def addStrListAttr(obj, attrName, attrList):
 
 
 class RgnH5Writer(object):
-    """Region table writer."""
+    """Region table writer.
+
+    Regions are added as NumPy blocks (or region tables) into a growable
+    int32 array, which is sorted by hole number with a stable sort only if
+    needed, and written as a chunked and compressed dataset on close().
+    """
 
-    def __init__(self, filename):
+    def __init__(self, filename, compression="gzip", chunkRows=65536):
         self.filename = op.abspath(op.expanduser(filename))
         if not self.filename.endswith("rgn.h5"):
             raise TypeError("File extension of region table: " +
                             "%s should be rgn.h5" % self.filename)
         self.file = h5py.File(self.filename, 'w')
-        self.regions = []
+        self.compression = compression
+        self.chunkRows = int(chunkRows)
+        self._regions = np.empty((1024, len(REGION_COLUMN_NAMES)),
+                                 dtype=np.int32)
+        self._numRegions = 0
+
+    @property
+    def regions(self):
+        """Return regions added so far as an (n, 5) int32 array."""
+        return self._regions[:self._numRegions]
 
     def _addVersion(self):
         """Add version to file."""
@@ -246,14 +470,18 @@ class RgnH5Writer(object):
         """Add /PulseData/Regions dataset."""
         # Create /PulseData group.
         pulseDataGroup = self.file.create_group("PulseData")
-        # Get the total number of regions in region table.
-        numRegions = len(self.regions)
-        shape = (max(1, numRegions), len(REGION_COLUMN_NAMES))
+        regions = self.regions
+        if len(regions) == 0:
+            regions = np.zeros((1, len(REGION_COLUMN_NAMES)), dtype=np.int32)
         # Add /PulseData/Regions dataset.
         # The datatype is int32 instead of uint32 because scores can be -1.
         regionsDataset = pulseDataGroup.create_dataset(
-            "Regions", shape, np.int32,
-            maxshape=(None, len(REGION_COLUMN_NAMES)))
+            "Regions", data=regions, dtype=np.int32,
+            chunks=(min(len(regions), self.chunkRows),
+                    len(REGION_COLUMN_NAMES)),
+            maxshape=(None, len(REGION_COLUMN_NAMES)),
+            compression=self.compression,
+            shuffle=self.compression is not None)
         # Add attributes to Regions.
         addStrListAttr(regionsDataset, "ColumnNames", REGION_COLUMN_NAMES)
         addStrListAttr(regionsDataset, "RegionTypes", REGION_TYPES)
@@ -261,24 +489,38 @@ class RgnH5Writer(object):
                        REGION_DESCRIPTIONS)
         addStrListAttr(regionsDataset, "RegionSources", REGION_SOURCES)
 
-        # Fill Regions dataset.
-        if len(self.regions) == 0:
-            self.regions = [(0, 0, 0, 0, 0)]
-        regionsDataset[:] = np.array(self.regions)
-
     def writeScanDataGroup(self, scanDataGroup=None):
         """Copy /ScanData group if not None."""
         if scanDataGroup is not None:
             self.file.copy(scanDataGroup, "/ScanData")
 
+    def addRegions(self, regions):
+        """Add a block of regions, an (n, 5) array-like of HoleNumber,
+        TypeIndex, Start, End and Score, or a RegionColumns."""
+        if isinstance(regions, RegionColumns):
+            regions = regions.regions
+        regions = np.asarray(regions, dtype=np.int32).reshape(
+            -1, len(REGION_COLUMN_NAMES))
+        numRegions = self._numRegions + len(regions)
+        if numRegions > len(self._regions):
+            grown = np.empty((max(numRegions, 2 * len(self._regions)),
+                              len(REGION_COLUMN_NAMES)), dtype=np.int32)
+            grown[:self._numRegions] = self.regions
+            self._regions = grown
+        self._regions[self._numRegions:numRegions] = regions
+        self._numRegions = numRegions
+
     def addRegionTable(self, regionTable):
-        """Add a ZMW's region table to the writer's region table list."""
-        self.regions.extend(regionTable.toList())
+        """Add a ZMW's region table to the writer's regions."""
+        self.addRegions(regionTable.toList())
 
     def write(self):
-        """Write the region table list to file."""
+        """Write the regions to file."""
         # ensure the output is sorted by hole number, de facto "spec" for rgn.h5
-        self.regions.sort(key=lambda x:x[0])
+        holeNumber = self.regions[:, 0]
+        if np.any(holeNumber[1:] < holeNumber[:-1]):
+            self._regions = self.regions[
+                np.argsort(holeNumber, kind='mergesort')]
         self._addVersion()
         self._addRegionsDataset()
 
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class FileLock and class IndexCache for keeping
+aligner indexes (e.g., suffix arrays) of references in a persistent cache
+directory, so that they are built only once and shared between runs."""
+
+from __future__ import absolute_import, division
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from os import path
+
+# Environment variable that specifies the default index cache directory.
+INDEX_CACHE_DIR_ENV = "PBALIGN_CACHE_DIR"
+
+# Name of the file which memoizes content hashes of references.
+_HASHES_FILE = "hashes.json"
+
+
+class FileLock(object):
+    """An advisory fcntl.flock lock on a lock file, which is released
+    automatically by the kernel if its process dies."""
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._fd = None
+
+    def acquire(self, shared=False, blocking=True):
+        """Acquire a shared or an exclusive lock, or convert a held lock.
+        Return False if blocking is False and the lock is held by others,
+        otherwise return True."""
+        if self._fd is None:
+            self._fd = os.open(self.fileName, os.O_RDWR | os.O_CREAT, 0o666)
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._fd, flags)
+        except IOError as e:
+            if not blocking and e.errno in (errno.EAGAIN, errno.EACCES):
+                self.release()
+                return False
+            raise
+        return True
+
+    def release(self):
+        """Release the lock if it is held."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def _entrySize(entryPath):
+    """Return total size in bytes of a cache entry (a file or a dir)."""
+    if not path.isdir(entryPath):
+        return path.getsize(entryPath)
+    total = 0
+    for root, _dirs, files in os.walk(entryPath):
+        for f in files:
+            total += path.getsize(path.join(root, f))
+    return total
+
+
+def _removeEntry(entryPath):
+    """Remove a cache entry (a file or a dir)."""
+    if path.isdir(entryPath) and not path.islink(entryPath):
+        shutil.rmtree(entryPath)
+    else:
+        os.remove(entryPath)
+
+
+class IndexCache(object):
+    """A directory of aligner indexes keyed by names derived from
+    reference content hashes.
+
+        An entry is built once, under an exclusive lock on its lock file,
+        into a temporary path which is renamed into place when done.
+        Runs using an entry hold a shared lock on it until release(),
+        and entries are evicted in least recently used order, skipping
+        entries in use, once the cache exceeds maxBytes.
+    """
+    def __init__(self, rootDir, maxBytes):
+        self.rootDir = path.abspath(path.expanduser(rootDir))
+        self.maxBytes = int(maxBytes)
+        self._heldLocks = []
+        if not path.isdir(self.rootDir):
+            try:
+                os.makedirs(self.rootDir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def __repr__(self):
+        return "IndexCache({d}, maxBytes={n})".format(d=self.rootDir,
+                                                      n=self.maxBytes)
+
+    def _entryPath(self, key):
+        """Return path to the cache entry of key."""
+        return path.join(self.rootDir, key)
+
+    def _lockFor(self, key):
+        """Return a FileLock of the cache entry of key."""
+        return FileLock(self._entryPath(key) + ".lock")
+
+    def contentHash(self, fileName):
+        """Return the sha1 hex digest of the content of a file. Digests
+        are memoized in the cache by file path, size and mtime, so that
+        a large reference is read only once until it changes."""
+        fileName = path.realpath(fileName)
+        st = os.stat(fileName)
+        memoKey = "{p}:{s}:{m}".format(p=fileName, s=st.st_size,
+                                       m=int(st.st_mtime))
+        memoFile = path.join(self.rootDir, _HASHES_FILE)
+        with FileLock(memoFile + ".lock"):
+            memo = self._loadHashes(memoFile)
+            if memoKey in memo:
+                return memo[memoKey]
+
+            logging.info("Computing content hash of {f}.".format(f=fileName))
+            sha1 = hashlib.sha1()
+            with open(fileName, 'rb') as reader:
+                for block in iter(lambda: reader.read(1 << 20), b''):
+                    sha1.update(block)
+            memo[memoKey] = sha1.hexdigest()
+
+            fd, tmpName = tempfile.mkstemp(dir=self.rootDir,
+                                           prefix="." + _HASHES_FILE)
+            with os.fdopen(fd, 'w') as writer:
+                json.dump(memo, writer, indent=1, sort_keys=True)
+            os.rename(tmpName, memoFile)
+            return memo[memoKey]
+
+    @staticmethod
+    def _loadHashes(memoFile):
+        """Load memoized content hashes, ignore a corrupt memo file."""
+        if not path.exists(memoFile):
+            return {}
+        try:
+            with open(memoFile, 'r') as reader:
+                return json.load(reader)
+        except ValueError:
+            logging.warning("Ignore corrupt content hash file " + memoFile)
+            return {}
+
+    def fetch(self, key, builder):
+        """Return path to the cache entry of key, building it first by
+        calling builder(outPath) if it is not cached yet. The entry is
+        protected from eviction until release() is called.
+            Input:
+                key    : name of the entry, e.g. <sha1>.sa
+                builder: a function which creates a file or a directory
+                         at a given path, or raises an exception.
+            Output:
+                path to the cached file or directory.
+        """
+        entryPath = self._entryPath(key)
+        lock = self._lockFor(key)
+        while True:
+            lock.acquire(shared=True)
+            if path.exists(entryPath):
+                break
+            # Not cached yet, wait for or become the builder.
+            lock.acquire(shared=False)
+            if not path.exists(entryPath):
+                self._build(key, builder)
+            # Downgrade to shared, an evictor may remove the entry before
+            # that, in which case start over.
+            lock.acquire(shared=True)
+            if path.exists(entryPath):
+                break
+            lock.release()
+
+        # Mark the entry as recently used.
+        os.utime(entryPath, None)
+        self._heldLocks.append(lock)
+        self.evict()
+        return entryPath
+
+    def _build(self, key, builder):
+        """Build the entry of key under an exclusive lock."""
+        buildDir = path.join(self.rootDir, ".build." + key)
+        if path.exists(buildDir):
+            # Left over by a crashed build.
+            shutil.rmtree(buildDir)
+        os.mkdir(buildDir)
+        try:
+            logging.info("Building {k} in index cache {d}.".format(
+                k=key, d=self.rootDir))
+            outPath = path.join(buildDir, key)
+            builder(outPath)
+            if not path.exists(outPath):
+                errMsg = "Failed to build {k} in index cache {d}.".format(
+                    k=key, d=self.rootDir)
+                logging.error(errMsg)
+                raise RuntimeError(errMsg)
+            os.rename(outPath, self._entryPath(key))
+        finally:
+            shutil.rmtree(buildDir, ignore_errors=True)
+
+    def entries(self):
+        """Return keys of all cached entries."""
+        return [name for name in os.listdir(self.rootDir)
+                if not name.startswith(".") and not name.endswith(".lock")
+                and name != _HASHES_FILE]
+
+    def entriesOf(self, fileName):
+        """Return paths to cached entries of a file, i.e., entries whose
+        keys start with its content hash, such as <sha1>.blt8.sa, without
+        fetching them."""
+        prefix = self.contentHash(fileName) + "."
+        return [self._entryPath(key) for key in sorted(self.entries())
+                if key.startswith(prefix)]
+
+    def evict(self):
+        """Remove least recently used entries which are not in use until
+        the total size of the cache is no greater than maxBytes."""
+        sizes, mtimes = {}, {}
+        for key in self.entries():
+            entryPath = self._entryPath(key)
+            try:
+                mtimes[key] = os.stat(entryPath).st_mtime
+                sizes[key] = _entrySize(entryPath)
+            except OSError:
+                # Removed by another process.
+                continue
+        total = sum(sizes.values())
+        for key in sorted(mtimes, key=lambda k: mtimes[k]):
+            if total <= self.maxBytes:
+                break
+            lock = self._lockFor(key)
+            if not lock.acquire(shared=False, blocking=False):
+                # In use or being built.
+                continue
+            try:
+                if path.exists(self._entryPath(key)):
+                    logging.info("Evicting {k} from index cache {d}.".format(
+                        k=key, d=self.rootDir))
+                    _removeEntry(self._entryPath(key))
+                total -= sizes[key]
+            finally:
+                lock.release()
+
+    def release(self):
+        """Release entries fetched by this object, so that they can be
+        evicted."""
+        for lock in self._heldLocks:
+            lock.release()
+        self._heldLocks = []
+
+
+def openIndexCache(options):
+    """Return an IndexCache specified by options.indexCacheDir (or the
+    PBALIGN_CACHE_DIR environment variable) and options.indexCacheSize
+    in gigabytes, or None if the cache is not specified or disabled."""
+    rootDir = getattr(options, "indexCacheDir", None)
+    if rootDir is None or rootDir == "":
+        rootDir = os.environ.get(INDEX_CACHE_DIR_ENV)
+    sizeGB = getattr(options, "indexCacheSize", None)
+    if rootDir is None or rootDir == "" or sizeGB is None or \
+            float(sizeGB) <= 0:
+        return None
+    return IndexCache(rootDir, int(float(sizeGB) * (1 << 30)))
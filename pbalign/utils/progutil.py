@@ -34,37 +34,351 @@
 # Author: Yuan Li
 
 from __future__ import absolute_import
-from pbcore.util.Process import backticks
+from collections import deque
+from subprocess import Popen, PIPE
+from pbalign.utils.toolregistry import getToolRegistry
+import atexit
+import errno
 import logging
+import os
+import re
+import shlex
+import signal
+import threading
+import time
+
+# At most this many bytes of stdout, and the last this many bytes of
+# stderr, of a command are kept in memory.
+MAX_CAPTURED_BYTES = 1 << 20
+
+# Seconds to wait after SIGTERM before killing a process group.
+KILL_GRACE_SECONDS = 5
+
+# Commands with these characters are run by bash, others are split into
+# argv lists and run directly.
+_SHELL_CHARS = re.compile(r"[|&;<>()$`*?\[\]{}~!]|\n")
+
+# Process groups of running commands, killed on exit.
+_ACTIVE_GROUPS = set()
+_ACTIVE_LOCK = threading.Lock()
 
 
 def Availability(progName):
     """Return True if a program is available, otherwise false."""
-    return (backticks("which {0}".format(progName))[1] == 0)
+    return getToolRegistry().isAvailable(progName)
 
 
 def CheckAvailability(progName):
     """Raise a runtime error if a program is not available."""
-    if not Availability(progName):
-        raise RuntimeError("{0} is not available.".format(progName))
+    getToolRegistry().check(progName)
+
+
+def toArgv(cmd):
+    """Return an argv list of a command, which is either a list, or a
+    command-line string which is split unless it needs bash."""
+    if not isinstance(cmd, basestring):
+        return [str(arg) for arg in cmd]
+    if _SHELL_CHARS.search(cmd.replace("\\ ", "")) is not None:
+        return ["bash", "-c", cmd]
+    return shlex.split(cmd)
+
+
+def _trackGroup(pgid):
+    """Remember a process group, so that it is killed on exit."""
+    with _ACTIVE_LOCK:
+        _ACTIVE_GROUPS.add(pgid)
+
+
+def _untrackGroup(pgid):
+    """Forget a process group whose leader has been waited. It is safe to
+    call this more than once."""
+    with _ACTIVE_LOCK:
+        _ACTIVE_GROUPS.discard(pgid)
+
+
+def _killGroup(pgid, sig):
+    """Send sig to a process group unless it has been forgotten, in which
+    case its id may belong to another process group already. Return False
+    if no signal is sent."""
+    with _ACTIVE_LOCK:
+        if pgid not in _ACTIVE_GROUPS:
+            return False
+        try:
+            os.killpg(pgid, sig)
+        except OSError:
+            return False
+    return True
+
+
+def killActiveProcesses(sig=signal.SIGKILL):
+    """Send sig to process groups of all running commands."""
+    with _ACTIVE_LOCK:
+        groups = list(_ACTIVE_GROUPS)
+    for pgid in groups:
+        _killGroup(pgid, sig)
+
+atexit.register(killActiveProcesses)
+
+
+class ExecResult(object):
+    """Result of a command run by Run()."""
+    def __init__(self, output, errCode, errMsg, rusage, timedOut):
+        self.output = output        # captured stdout lines
+        self.errCode = errCode      # exit status, or -signal if killed
+        self.errMsg = errMsg        # the tail of stderr
+        self.rusage = rusage        # resource usage of the child, or None
+        self.timedOut = timedOut    # whether the command timed out
+
+
+def _readLines(pipe, name, output, tail, logLines):
+    """Read lines from pipe until EOF. Keep the first MAX_CAPTURED_BYTES
+    bytes of lines in output (if not None), the last MAX_CAPTURED_BYTES
+    bytes in tail (if not None), and log lines if logLines."""
+    outputBytes, tailBytes, truncated = 0, 0, False
+    for line in iter(pipe.readline, b''):
+        text = line.decode('utf-8', 'replace').rstrip('\n')
+        if logLines:
+            logging.debug(name + ": " + text)
+        if output is not None:
+            if outputBytes + len(line) <= MAX_CAPTURED_BYTES:
+                output.append(text)
+                outputBytes += len(line)
+            elif not truncated:
+                truncated = True
+                logging.warning(name + ": Output exceeds {0} bytes and is "
+                                "truncated.".format(MAX_CAPTURED_BYTES))
+        if tail is not None:
+            tail.append(text)
+            tailBytes += len(line)
+            while tailBytes > MAX_CAPTURED_BYTES and len(tail) > 1:
+                tailBytes -= len(tail.popleft()) + 1
+    pipe.close()
+
+
+def _terminate(pgid, finished):
+    """Terminate a process group, and kill it if it does not finish in
+    KILL_GRACE_SECONDS."""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        if not _killGroup(pgid, sig):
+            return
+        if finished.wait(KILL_GRACE_SECONDS):
+            return
+
+
+def _reap(process, seconds):
+    """Reap a process without blocking for more than seconds. Return True
+    if it has been reaped."""
+    deadline = time.time() + seconds
+    while True:
+        try:
+            pid, status = os.waitpid(process.pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            # Reaped already.
+            return e.errno == errno.ECHILD
+        if pid != 0:
+            process.returncode = -os.WTERMSIG(status) \
+                if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.05)
+
+
+def _terminateAndReap(process):
+    """Terminate the process group of a process, kill it if the process
+    does not finish in KILL_GRACE_SECONDS, and reap the process."""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        _killGroup(process.pid, sig)
+        if _reap(process, KILL_GRACE_SECONDS):
+            return
+
+
+def Run(name, cmd, timeout=None, logStderr=True):
+    """Run a command in its own process group without buffering all of its
+    output, streaming stderr line by line into the logger.
+    Input:
+        name     : name of the caller, used in logs
+        cmd      : an argv list or a command-line string
+        timeout  : seconds after which the process group is terminated,
+                   or None
+        logStderr: whether or not to log stderr lines at debug level
+    Output:
+        an ExecResult. If the caller is interrupted, e.g. by
+        KeyboardInterrupt, the process group is killed.
+    """
+    argv = toArgv(cmd)
+    process = Popen(argv, stdout=PIPE, stderr=PIPE, close_fds=True,
+                    preexec_fn=os.setsid)
+    pgid = process.pid
+    _trackGroup(pgid)
+    output, tail = [], deque()
+    readers = [threading.Thread(target=_readLines,
+                                args=(process.stdout, name, output, None,
+                                      False)),
+               threading.Thread(target=_readLines,
+                                args=(process.stderr, name, None, tail,
+                                      logStderr))]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    finished = threading.Event()
+    timedOut = []
+    timer = None
+    if timeout is not None:
+        def expire():
+            """Terminate the process group when it times out."""
+            timedOut.append(True)
+            logging.error(name + ": Timed out after {0} seconds.".format(
+                timeout))
+            _terminate(pgid, finished)
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+    try:
+        while True:
+            try:
+                _pid, status, rusage = os.wait4(process.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+    except BaseException:
+        logging.error(name + ": Interrupted, kill process group {0}.".
+                      format(pgid))
+        # wait4 is not called again, so poll for the process to finish.
+        _terminateAndReap(process)
+        raise
+    finally:
+        finished.set()
+        _untrackGroup(pgid)
+        if timer is not None:
+            # An expired timer returns at once as finished is set.
+            timer.cancel()
+            timer.join()
+    # Children of the process which still hold the pipes are not waited.
+    for reader in readers:
+        reader.join(1)
+    logging.debug(name + ": user {u:.2f}s, system {s:.2f}s, max RSS {m} KB".
+                  format(u=rusage.ru_utime, s=rusage.ru_stime,
+                         m=rusage.ru_maxrss))
+    return ExecResult(output, process.returncode, "\n".join(tail), rusage,
+                      len(timedOut) > 0)
+
+
+def Start(name, cmd, stdout=PIPE):
+    """Start a command-line string in bash in the background, e.g., to
+    stream its stdout, while its stderr is read and logged in a thread as
+    Run() does, so that a verbose command never blocks on a full stderr
+    pipe. The command runs in its own process group, which is killed on
+    exit or by Kill(). Call Wait() to wait for the returned Popen object
+    to finish."""
+    logging.info(name + ": Call \"{0}\" in the background.".format(cmd))
+    process = Popen(cmd, shell=True, stdout=stdout, stderr=PIPE,
+                    close_fds=True, preexec_fn=os.setsid)
+    _trackGroup(process.pid)
+    process.stderrTail = deque()
+    process.stderrReader = threading.Thread(
+        target=_readLines,
+        args=(process.stderr, name, None, process.stderrTail, True))
+    process.stderrReader.daemon = True
+    process.stderrReader.start()
+    return process
+
+
+def Wait(process):
+    """Wait for a process started by Start() to finish, and return a tuple
+    of (exit status, the tail of its stderr)."""
+    process.wait()
+    _untrackGroup(process.pid)
+    if process.stdout is not None:
+        # Children still writing to stdout get SIGPIPE instead of blocking.
+        process.stdout.close()
+    # Children of the process which still hold the pipe are not waited.
+    process.stderrReader.join(1)
+    return process.returncode, "\n".join(process.stderrTail)
+
+
+def Kill(process, sig=signal.SIGKILL):
+    """Send sig to the process group of a process started by Start(),
+    i.e., to bash and the commands it runs, unless it has been waited."""
+    _killGroup(process.pid, sig)
+
+
+def _unblockFifoWriter(reader, fifo, done):
+    """
+    If the reader process of a FIFO exits before the writer is done, keep
+    opening and closing the read end of the FIFO until done is set, so
+    that the writer fails on a broken pipe instead of blocking forever.
+    Input:
+        reader: a subprocess.Popen object reading the FIFO
+        fifo  : path to the FIFO
+        done  : a threading.Event set when the writer has finished
+    """
+    while reader.poll() is None:
+        if done.wait(1):
+            return
+    while not done.is_set():
+        try:
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+        done.wait(1)
+
+
+def FeedFifo(name, reader, fifo, write):
+    """Call write(), which writes into a FIFO read by reader, a process
+    started by Start(). write() fails on a broken pipe rather than blocking
+    if reader exits early. If write() fails or is interrupted, e.g., by
+    SystemExit on SIGTERM, the process group of reader is killed and
+    waited before the exception is raised again."""
+    done = threading.Event()
+    watcher = threading.Thread(target=_unblockFifoWriter,
+                               args=(reader, fifo, done))
+    watcher.daemon = True
+    watcher.start()
+    finished = False
+    try:
+        write()
+        finished = True
+    finally:
+        # Stop polling reader before it is waited.
+        done.set()
+        watcher.join()
+        if not finished:
+            logging.error(name + ": Writing {0} failed, kill process group "
+                          "{1}.".format(fifo, reader.pid))
+            Kill(reader)
+            Wait(reader)
 
 
-def Execute(name, cmd):
-    """Execute the sepcified command in bash.
+def Execute(name, cmd, timeout=None):
+    """Execute the sepcified command, in bash if it needs a shell.
     Raise a RuntimeError if execution of cmd fail.
 
     Input:
-        cmd: a command-line string to execute in bash
+        cmd    : a command-line string or an argv list to execute
+        timeout: seconds after which the command is killed, or None
     Output:
         output : the cmd output
         errCode: the error code (zero means normal exit)
         errMsg : the error message
     """
     logging.info(name + ": Call \"{0}\"".format(cmd))
-    output, errCode, errMsg = backticks(cmd, merge_stderr=False)
+    result = Run(name, cmd, timeout=timeout)
+    output, errCode, errMsg = result.output, result.errCode, result.errMsg
     if errCode != 0:
         errMsg = "%s returned a non-zero exit status %d\nCMD: '%s'\nERROR: %s\nOutput:%r" % \
                 (name, errCode, cmd, errMsg, output)
+        if result.timedOut:
+            errMsg = "%s timed out after %s seconds\n" % (name, timeout) + \
+                     errMsg
         logging.error(errMsg)
         raise RuntimeError(errMsg)
     return output, errCode, errMsg
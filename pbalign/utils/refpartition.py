@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines functions for partitioning a large reference into
+groups of contigs, each of which can be aligned to within a memory budget."""
+
+from __future__ import absolute_import, division
+import logging
+from os import path
+
+# Estimated aligner memory per reference base, i.e., the reference itself,
+# its suffix array (4 bytes per base) and lookup tables.
+BYTES_PER_REFERENCE_BASE = 8
+
+
+def maxBasesForMemory(maxMemoryGB,
+                      bytesPerBase=BYTES_PER_REFERENCE_BASE):
+    """Return the maximum number of reference bases an aligner can hold
+    within maxMemoryGB gigabytes."""
+    return int(float(maxMemoryGB) * (1 << 30) / bytesPerBase)
+
+
+def contigName(header):
+    """Return the contig name of a FASTA header line."""
+    return header[1:].strip().split()[0]
+
+
+def contigLengths(fastaFile):
+    """Return a list of (contig name, length) of a FASTA file, read from
+    its .fai index if it exists."""
+    faiFile = fastaFile + ".fai"
+    lengths = []
+    if path.exists(faiFile):
+        with open(faiFile, 'r') as reader:
+            for line in reader:
+                fields = line.split('\t')
+                lengths.append((fields[0], int(fields[1])))
+        return lengths
+
+    with open(fastaFile, 'r') as reader:
+        for line in reader:
+            if line.startswith('>'):
+                lengths.append([contigName(line), 0])
+            elif len(lengths) > 0:
+                lengths[-1][1] += len(line.strip())
+    return [tuple(item) for item in lengths]
+
+
+def planPartitions(lengths, maxBases):
+    """Group contigs into as few partitions of at most maxBases bases as
+    possible, using first fit decreasing. A contig longer than maxBases
+    gets a partition of its own.
+        Input:
+            lengths : a list of (contig name, length)
+            maxBases: maximum number of bases of a partition
+        Output:
+            a list of partitions, each is a list of contig names in the
+            order of the reference.
+    """
+    order = dict((name, i) for i, (name, _length) in enumerate(lengths))
+    partitions, totals = [], []
+    for name, length in sorted(lengths, key=lambda item: -item[1]):
+        if length > maxBases:
+            logging.warning("Contig {n} of {l} bases exceeds the reference "
+                            "memory budget of {m} bases.".format(
+                                n=name, l=length, m=maxBases))
+        for i, total in enumerate(totals):
+            if total + length <= maxBases:
+                partitions[i].append(name)
+                totals[i] += length
+                break
+        else:
+            partitions.append([name])
+            totals.append(length)
+    return [sorted(p, key=lambda name: order[name]) for p in partitions]
+
+
+def writePartitions(fastaFile, partitions, outDir):
+    """Write contigs of each partition to a FASTA file in outDir, and
+    return the list of partition FASTA files."""
+    outFiles = [path.join(outDir, "partition{i}.fasta".format(i=i))
+                for i in range(len(partitions))]
+    partitionOf = {}
+    for i, names in enumerate(partitions):
+        for name in names:
+            partitionOf[name] = i
+
+    writers = [open(outFile, 'w') for outFile in outFiles]
+    try:
+        writer = None
+        with open(fastaFile, 'r') as reader:
+            for line in reader:
+                if line.startswith('>'):
+                    writer = writers[partitionOf[contigName(line)]]
+                if writer is not None:
+                    writer.write(line)
+    finally:
+        for w in writers:
+            w.close()
+    return outFiles
+
+
+def partitionReference(fastaFile, maxMemoryGB, outDir):
+    """Partition a FASTA reference so that an aligner can hold each
+    partition within maxMemoryGB gigabytes, write partitions to outDir and
+    return their FASTA files, or [fastaFile] if no partition is needed."""
+    lengths = contigLengths(fastaFile)
+    maxBases = maxBasesForMemory(maxMemoryGB)
+    if sum(length for _name, length in lengths) <= maxBases:
+        return [fastaFile]
+
+    partitions = planPartitions(lengths, maxBases)
+    logging.info("Partition {n} contigs of {f} into {p} partitions of at "
+                 "most {m} bases.".format(n=len(lengths), f=fastaFile,
+                                          p=len(partitions), m=maxBases))
+    if len(partitions) == 1:
+        return [fastaFile]
+    return writePartitions(fastaFile, partitions, outDir)
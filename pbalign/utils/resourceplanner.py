@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script plans memory and processors of pbalign stages, in
+particular samtools sort, within the memory limit and CPU quota of the
+cgroup pbalign runs in, available memory of the host, and --maxMemory."""
+
+from __future__ import absolute_import, division
+import logging
+import multiprocessing
+import os
+from os import path
+
+from pbalign.utils.refpartition import BYTES_PER_REFERENCE_BASE
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_ROOT = "/proc"
+
+# cgroup v1 reports no memory limit as a huge number close to 2^63.
+_UNLIMITED_BYTES = 1 << 60
+
+# samtools sort memory per thread is kept within these bounds.
+MIN_SORT_MEMORY_PER_THREAD = 64 << 20
+MAX_SORT_MEMORY_PER_THREAD = 16 << 30
+# samtools sort memory per thread if the memory budget is unknown.
+DEFAULT_SORT_MEMORY_PER_THREAD = 768 << 20
+
+# samtools sort may use more memory than -m, only plan this fraction
+# of the budget.
+SORT_MEMORY_FRACTION = 0.75
+
+# Uncompressed BAM records take about this many times the size of the
+# compressed BAM file in memory.
+BAM_EXPANSION = 4
+
+# Estimated aligner memory per thread besides the reference index.
+ALIGNER_BYTES_PER_THREAD = 512 << 20
+
+
+def _readFirstLine(fileName):
+    """Return the stripped first line of a file, or None if it can not
+    be read."""
+    try:
+        with open(fileName, 'r') as reader:
+            return reader.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _cgroupDirs(cgroupRoot=CGROUP_ROOT, procRoot=PROC_ROOT,
+                controller=None):
+    """Return directories of the cgroup of this process, as listed in
+    /proc/self/cgroup, and of its ancestors up to the root, innermost
+    first. Directories are of cgroup v2 if controller is None, otherwise of
+    the cgroup v1 hierarchy of controller (e.g., memory or cpu)."""
+    baseDir = cgroupRoot if controller is None else \
+        path.join(cgroupRoot, controller)
+    cgroupPath = "/"
+    try:
+        with open(path.join(procRoot, "self", "cgroup"), 'r') as reader:
+            for line in reader:
+                fields = line.strip().split(":", 2)
+                if len(fields) != 3:
+                    continue
+                if (controller is None and fields[:2] == ["0", ""]) or \
+                        controller in fields[1].split(","):
+                    cgroupPath = fields[2]
+                    break
+    except (IOError, OSError):
+        pass
+    parts = [part for part in cgroupPath.split("/") if part != ""]
+    return [path.join(baseDir, *parts[0:i])
+            for i in range(len(parts), -1, -1)]
+
+
+def _readLimit(fileName):
+    """Return a cgroup limit read from a file as an integer, or None if
+    it can not be read or is unlimited."""
+    value = _readFirstLine(fileName)
+    if value is None or value == "max":
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        return None
+    return None if limit >= _UNLIMITED_BYTES else limit
+
+
+def cgroupMemoryLimit(cgroupRoot=CGROUP_ROOT, procRoot=PROC_ROOT):
+    """Return the memory limit in bytes of cgroup v2 or v1, or None if
+    memory is not limited. The limit of the cgroup of this process is the
+    smallest limit of it and its ancestors."""
+    limits = [_readLimit(path.join(dirName, "memory.max"))
+              for dirName in _cgroupDirs(cgroupRoot, procRoot)]
+    limits += [_readLimit(path.join(dirName, "memory.limit_in_bytes"))
+               for dirName in _cgroupDirs(cgroupRoot, procRoot, "memory")]
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if len(limits) > 0 else None
+
+
+def cgroupCpuQuota(cgroupRoot=CGROUP_ROOT, procRoot=PROC_ROOT):
+    """Return the CPU quota (number of CPUs, may be fractional) of cgroup
+    v2 or v1, or None if CPU is not limited. The quota of the cgroup of
+    this process is the smallest quota of it and its ancestors."""
+    quotas = []
+    for dirName in _cgroupDirs(cgroupRoot, procRoot):
+        value = _readFirstLine(path.join(dirName, "cpu.max"))
+        fields = value.split() if value is not None else []
+        if len(fields) == 2 and fields[0] != "max":
+            quotas.append(int(fields[0]) / int(fields[1]))
+    for dirName in _cgroupDirs(cgroupRoot, procRoot, "cpu"):
+        quota = _readLimit(path.join(dirName, "cpu.cfs_quota_us"))
+        period = _readLimit(path.join(dirName, "cpu.cfs_period_us"))
+        if quota is not None and quota > 0 and period:
+            quotas.append(quota / period)
+    return min(quotas) if len(quotas) > 0 else None
+
+
+def availableMemory(procRoot=PROC_ROOT):
+    """Return available memory in bytes of the host according to
+    meminfo, or None if it is unknown."""
+    fields = {}
+    try:
+        with open(path.join(procRoot, "meminfo"), 'r') as reader:
+            for line in reader:
+                name, _sep, value = line.partition(':')
+                fields[name] = int(value.split()[0]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    if 'MemAvailable' in fields:
+        return fields['MemAvailable']
+    if 'MemFree' in fields:
+        return fields['MemFree'] + fields.get('Cached', 0)
+    return None
+
+
+def memoryBudget(maxMemoryGB=None, cgroupRoot=CGROUP_ROOT,
+                 procRoot=PROC_ROOT):
+    """Return the memory budget in bytes of a pbalign run, the smallest of
+    maxMemoryGB, the cgroup memory limit and available memory, or None if
+    none of them is known."""
+    limits = [cgroupMemoryLimit(cgroupRoot, procRoot),
+              availableMemory(procRoot)]
+    if maxMemoryGB is not None:
+        limits.append(int(float(maxMemoryGB) * (1 << 30)))
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if len(limits) > 0 else None
+
+
+def cpuBudget(nproc, cgroupRoot=CGROUP_ROOT, procRoot=PROC_ROOT):
+    """Return the number of CPUs pbalign may use, at most nproc, the
+    cgroup CPU quota and the number of CPUs of the host."""
+    cpus = [int(nproc), multiprocessing.cpu_count()]
+    quota = cgroupCpuQuota(cgroupRoot, procRoot)
+    if quota is not None:
+        cpus.append(int(quota))
+    return max(1, min(cpus))
+
+
+def alignerFootprint(referenceFile, nproc):
+    """Return the expected memory in bytes of an aligner using nproc
+    threads, estimated from the size of the reference FASTA file."""
+    refBytes = path.getsize(referenceFile) \
+        if referenceFile is not None and path.isfile(referenceFile) else 0
+    return refBytes * BYTES_PER_REFERENCE_BASE + \
+        int(nproc) * ALIGNER_BYTES_PER_THREAD
+
+
+def freeSpace(dirName):
+    """Return free space in bytes of the file system of dirName."""
+    stat = os.statvfs(dirName)
+    return stat.f_bavail * stat.f_frsize
+
+
+def _spillDir(tmpDirs):
+    """Return the existing directory among tmpDirs with the most free
+    space, or None."""
+    candidates = [d for d in tmpDirs if d is not None and path.isdir(d)]
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=freeSpace)
+
+
+class SortPlan(object):
+    """Threads, memory per thread and temp file location of samtools sort.
+    """
+    def __init__(self, threads, memoryPerThread, tmpDir=None):
+        self.threads = threads
+        self.memoryPerThread = memoryPerThread
+        self.tmpDir = tmpDir
+
+    @property
+    def memoryOption(self):
+        """Memory per thread as the value of samtools sort -m."""
+        return "{0}M".format(self.memoryPerThread >> 20)
+
+    def __repr__(self):
+        return "SortPlan(threads={t}, memoryPerThread={m}, tmpDir={d})".\
+            format(t=self.threads, m=self.memoryOption, d=self.tmpDir)
+
+
+def planSort(nproc, maxMemoryGB=None, reservedBytes=0, dataBytes=None,
+             tmpDirs=(), nSorts=1, cgroupRoot=CGROUP_ROOT,
+             procRoot=PROC_ROOT):
+    """Plan samtools sort within the CPU and memory budgets.
+        Input:
+            nproc        : number of processors of the run.
+            maxMemoryGB  : memory budget in gigabytes (--maxMemory), or None.
+            reservedBytes: memory used by other processes (e.g., aligners)
+                           running at the same time as sorting.
+            dataBytes    : size of BAM files to sort, or None if unknown.
+            tmpDirs      : candidate directories for temp files of sort.
+            nSorts       : number of sorts running at the same time, which
+                           share the budgets.
+        Output:
+            a SortPlan. Memory is not planned beyond what sorting dataBytes
+            needs, temp files are written to the candidate directory with
+            the most free space.
+    """
+    nSorts = max(1, int(nSorts))
+    cpus = max(1, cpuBudget(nproc, cgroupRoot, procRoot) // nSorts)
+    budget = memoryBudget(maxMemoryGB, cgroupRoot, procRoot)
+    if budget is None:
+        memory = None
+    else:
+        memory = max(0, budget - int(reservedBytes)) // nSorts
+        memory = int(memory * SORT_MEMORY_FRACTION)
+    if dataBytes is not None:
+        needed = int(dataBytes) * BAM_EXPANSION
+        memory = needed if memory is None else min(memory, needed)
+    if memory is None:
+        plan = SortPlan(max(1, cpus // 4), DEFAULT_SORT_MEMORY_PER_THREAD,
+                        _spillDir(tmpDirs))
+    else:
+        # Use more threads as long as each has enough memory.
+        threads = max(1, min(max(1, cpus // 2),
+                             memory // MIN_SORT_MEMORY_PER_THREAD))
+        memoryPerThread = min(MAX_SORT_MEMORY_PER_THREAD,
+                              max(MIN_SORT_MEMORY_PER_THREAD,
+                                  memory // threads))
+        plan = SortPlan(threads, memoryPerThread, _spillDir(tmpDirs))
+    logging.debug("Plan samtools sort: {p}".format(p=plan))
+    return plan
+
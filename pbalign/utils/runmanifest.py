@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class RunManifest, which records finished stages of a
+pbalign run together with signatures of their input and output files and a
+hash of options, so that a rerun with --resume can skip stages whose outputs
+are still valid."""
+
+from __future__ import absolute_import, division
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from os import path
+
+# Options which do not change results of any stage.
+IRRELEVANT_OPTIONS = ('nproc', 'tmpDir', 'keepTmpFiles', 'resume',
+                      'stageStats', 'partitionWorkers', 'indexCacheDir',
+                      'indexCacheSize', 'maxMemory', 'verbosity', 'debug',
+                      'quiet', 'log_level', 'log_file', 'logFile', 'profile')
+
+# Number of bytes hashed at each end of a file for its signature.
+_SIGNATURE_BYTES = 1 << 20
+
+
+def fileSignature(fileName):
+    """Return a signature of a file, consisting of its size, mtime and a
+    sha1 of its first and last megabyte, or None if it does not exist."""
+    if not path.isfile(fileName):
+        return None
+    st = os.stat(fileName)
+    sha1 = hashlib.sha1()
+    with open(fileName, 'rb') as reader:
+        sha1.update(reader.read(_SIGNATURE_BYTES))
+        if st.st_size > _SIGNATURE_BYTES:
+            reader.seek(max(_SIGNATURE_BYTES, st.st_size - _SIGNATURE_BYTES))
+            sha1.update(reader.read(_SIGNATURE_BYTES))
+    return {'size': st.st_size, 'mtime': int(st.st_mtime),
+            'sha1': sha1.hexdigest()}
+
+
+def optionsHash(options):
+    """Return a sha1 of options which may change results of a run."""
+    items = dict((key, value) for key, value in vars(options).iteritems()
+                 if key not in IRRELEVANT_OPTIONS)
+    return hashlib.sha1(json.dumps(items, sort_keys=True,
+                                   default=str)).hexdigest()
+
+
+class RunManifest(object):
+    """A manifest.json in a work directory, which records finished stages
+    of a run. All stages are invalidated if options change. Stages may be
+    marked done by concurrent threads."""
+    def __init__(self, workDir, options):
+        self.workDir = workDir
+        self._lock = threading.RLock()
+        self.fileName = path.join(workDir, "manifest.json")
+        self.optionsHash = optionsHash(options)
+        self.stages = {}
+        if path.exists(self.fileName):
+            try:
+                with open(self.fileName, 'r') as reader:
+                    manifest = json.load(reader)
+            except ValueError:
+                logging.warning("Ignore corrupt run manifest " +
+                                self.fileName)
+                manifest = {}
+            if manifest.get('optionsHash') == self.optionsHash:
+                self.stages = manifest.get('stages', {})
+            elif len(manifest.get('stages', {})) > 0:
+                logging.info("Options have changed since the last run, " +
+                             "no stages can be resumed.")
+
+    def isDone(self, stage, inputs, outputs):
+        """Return True if stage has finished with the same input files,
+        and its output files have not changed since then."""
+        record = self.stages.get(stage)
+        if record is None:
+            return False
+        for key, files in (('inputs', inputs), ('outputs', outputs)):
+            expected = record.get(key, {})
+            if sorted(expected.keys()) != sorted(files):
+                return False
+            for fileName in files:
+                if fileSignature(fileName) != expected[fileName]:
+                    return False
+        return True
+
+    def markDone(self, stage, inputs, outputs):
+        """Record that stage has finished."""
+        record = {
+            'inputs': dict((f, fileSignature(f)) for f in inputs),
+            'outputs': dict((f, fileSignature(f)) for f in outputs),
+            'finished': time.strftime("%Y-%m-%d %H:%M:%S")}
+        with self._lock:
+            self.stages[stage] = record
+            self._write()
+
+    def invalidate(self, stage):
+        """Forget that stage has finished."""
+        with self._lock:
+            if self.stages.pop(stage, None) is not None:
+                self._write()
+
+    def _write(self):
+        """Write the manifest atomically."""
+        fd, tmpName = tempfile.mkstemp(dir=self.workDir,
+                                       prefix=".manifest")
+        with os.fdopen(fd, 'w') as writer:
+            json.dump({'optionsHash': self.optionsHash,
+                       'stages': self.stages}, writer, indent=2,
+                      sort_keys=True)
+        os.rename(tmpName, self.fileName)
+
+
+def runStage(manifest, stage, inputs, outputs, func):
+    """Call func() to run a stage unless manifest says the stage has
+    finished with the same inputs and its outputs are still valid, then
+    record the stage in manifest. manifest can be None.
+        Output:
+            True if the stage was run, False if it was skipped.
+    """
+    if manifest is not None:
+        if manifest.isDone(stage, inputs, outputs):
+            logging.info("Resume: skip stage {s}, outputs are valid.".format(
+                s=stage))
+            return False
+        manifest.invalidate(stage)
+    func()
+    if manifest is not None:
+        manifest.markDone(stage, inputs, outputs)
+    return True
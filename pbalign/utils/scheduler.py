@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class StageScheduler, which runs independent stages
+(e.g., building a reference index and converting reads) concurrently in
+threads, within a budget of processors."""
+
+from __future__ import absolute_import, division
+import logging
+import threading
+import traceback
+
+
+class StageScheduler(object):
+    """Run stages as soon as stages they depend on have finished. Stages
+    are callables which usually wait for external processes, so they run
+    in threads. The sum of processors of running stages never exceeds
+    nproc; a stage requiring more than nproc processors is capped to nproc
+    and thus runs alone. With nproc=1, stages run one by one in the order they are added.
+    """
+    def __init__(self, nproc=1):
+        self.nproc = max(1, int(nproc) if nproc else 1)
+        self._stages = []
+        self._funcs = {}
+        self._deps = {}
+        self._costs = {}
+
+    def add(self, name, func, deps=(), nproc=1):
+        """Add a stage.
+            Input:
+                name : a unique name of the stage.
+                func : a callable to run the stage, whose return value
+                       is reported by run().
+                deps : names of stages which must finish before this stage.
+                nproc: number of processors used by this stage.
+        """
+        if name in self._funcs:
+            raise ValueError("Stage {n} has been added.".format(n=name))
+        self._stages.append(name)
+        self._funcs[name] = func
+        self._deps[name] = tuple(deps)
+        self._costs[name] = min(self.nproc, max(1, int(nproc)))
+
+    def _checkDeps(self):
+        """Raise ValueError if a stage depends on an unknown stage or if
+        dependencies are cyclic."""
+        for name in self._stages:
+            for dep in self._deps[name]:
+                if dep not in self._funcs:
+                    raise ValueError("Stage {n} depends on an unknown " \
+                                     "stage {d}.".format(n=name, d=dep))
+        ordered = set()
+        remaining = list(self._stages)
+        while len(remaining) > 0:
+            ready = [name for name in remaining
+                     if all(dep in ordered for dep in self._deps[name])]
+            if len(ready) == 0:
+                raise ValueError("Stages {s} have cyclic dependencies.".
+                                 format(s=", ".join(remaining)))
+            ordered.update(ready)
+            remaining = [name for name in remaining if name not in ordered]
+
+    def run(self):
+        """Run all stages. If a stage fails, no more stages are started,
+        running stages are waited for, and the first error is raised.
+            Output:
+                a dict of return values of stages by name.
+        """
+        self._checkDeps()
+        cond = threading.Condition()
+        pending = list(self._stages)
+        running = set()
+        finished = set()
+        results = {}
+        errors = []
+        state = {'used': 0}
+
+        def work(name):
+            """Run a stage in a thread and report when it finishes."""
+            try:
+                results[name] = self._funcs[name]()
+            except BaseException as e:
+                # Also SystemExit or KeyboardInterrupt, which are raised
+                # by run() as any other error.
+                logging.error("Stage {n} failed.\n{t}".format(
+                    n=name, t=traceback.format_exc()))
+                with cond:
+                    errors.append(e)
+            finally:
+                with cond:
+                    running.discard(name)
+                    finished.add(name)
+                    state['used'] -= self._costs[name]
+                    cond.notify_all()
+
+        with cond:
+            while len(running) > 0 or (len(pending) > 0 and
+                                       len(errors) == 0):
+                if len(errors) == 0:
+                    for name in list(pending):
+                        if not all(dep in finished
+                                   for dep in self._deps[name]):
+                            continue
+                        cost = self._costs[name]
+                        if state['used'] + cost > self.nproc:
+                            continue
+                        pending.remove(name)
+                        running.add(name)
+                        state['used'] += cost
+                        logging.debug("Start stage {n}.".format(n=name))
+                        thread = threading.Thread(target=work, args=(name,),
+                                                  name=name)
+                        thread.daemon = True
+                        thread.start()
+                # Wait with a timeout so that KeyboardInterrupt works.
+                cond.wait(1)
+
+        if len(errors) > 0:
+            raise errors[0]
+        return results
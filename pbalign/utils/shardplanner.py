@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines functions for planning ZMW-range shards with
+roughly equal numbers of bases, using columns of a PacBio BAM index."""
+
+from __future__ import absolute_import, division
+import logging
+import math
+import numpy as np
+
+# A conservative estimation of how many bases an aligner thread can align
+# per second, used to convert a shard wall time limit to bases.
+BASES_PER_THREAD_SECOND = 20000
+
+
+def maxBasesForWallTime(maxMinutes, nproc,
+                        basesPerThreadSecond=BASES_PER_THREAD_SECOND):
+    """Return the maximum number of bases a shard aligned with nproc
+    threads can have in order to finish within maxMinutes, or None if
+    maxMinutes is None."""
+    if maxMinutes is None:
+        return None
+    return int(float(maxMinutes) * 60 * max(1, int(nproc)) *
+               basesPerThreadSecond)
+
+
+def basesPerZmw(movieIds, holeNumbers, qStarts, qEnds):
+    """Sum up read lengths of each ZMW.
+        Input:
+            movieIds, holeNumbers, qStarts, qEnds: columns of a .pbi index,
+            one row per read.
+        Output:
+            (movieIds, holeNumbers, bases), numpy arrays with one row per
+            ZMW, sorted by movie and hole number.
+    """
+    movieIds = np.asarray(movieIds)
+    holeNumbers = np.asarray(holeNumbers)
+    lengths = np.asarray(qEnds, dtype=np.int64) - \
+        np.asarray(qStarts, dtype=np.int64)
+    if len(lengths) == 0:
+        return movieIds[:0], holeNumbers[:0], lengths
+    order = np.lexsort((holeNumbers, movieIds))
+    movieIds, holeNumbers = movieIds[order], holeNumbers[order]
+    isFirst = np.ones(len(order), dtype=bool)
+    isFirst[1:] = (movieIds[1:] != movieIds[:-1]) | \
+                  (holeNumbers[1:] != holeNumbers[:-1])
+    firstRows = np.flatnonzero(isFirst)
+    bases = np.add.reduceat(lengths[order], firstRows)
+    return movieIds[firstRows], holeNumbers[firstRows], bases
+
+
+def planShards(movieIds, holeNumbers, qStarts, qEnds, nShards,
+               maxBasesPerShard=None):
+    """Plan ZMW-range shards with roughly equal numbers of bases.
+        Input:
+            movieIds, holeNumbers, qStarts, qEnds: columns of a .pbi index.
+            nShards         : the requested number of shards.
+            maxBasesPerShard: if not None, plan more shards than requested
+                              so that no shard has more bases than this,
+                              unless a single ZMW does.
+        Output:
+            a list of shards, each of which is a list of ZMW ranges
+            (movieId, firstHoleNumber, lastHoleNumber), inclusive.
+    """
+    zmwMovies, zmwHoles, zmwBases = basesPerZmw(movieIds, holeNumbers,
+                                                qStarts, qEnds)
+    if len(zmwBases) == 0:
+        return []
+    cumBases = np.cumsum(zmwBases)
+    totalBases = int(cumBases[-1])
+
+    nShards = max(1, int(nShards))
+    if maxBasesPerShard is not None and maxBasesPerShard > 0:
+        nShards = max(nShards,
+                      int(math.ceil(totalBases / float(maxBasesPerShard))))
+    nShards = min(nShards, len(zmwBases))
+
+    # Cut shards one by one, each of which gets an equal share of the
+    # remaining bases, so that rounding errors do not pile up in the
+    # last shard.
+    capped = maxBasesPerShard is not None and maxBasesPerShard > 0
+    bounds = [0]
+    while bounds[-1] < len(zmwBases):
+        begin = bounds[-1]
+        done = int(cumBases[begin - 1]) if begin > 0 else 0
+        share = (totalBases - done) / float(max(1, nShards - len(bounds) + 1))
+        if capped:
+            share = min(share, maxBasesPerShard)
+        target = done + share
+        end = int(np.searchsorted(cumBases, target, side='right'))
+        # Include the next ZMW if that gets closer to the share.
+        if (not capped and end < len(zmwBases) and end > begin and
+                cumBases[end] - target < target - cumBases[end - 1]):
+            end += 1
+        bounds.append(max(end, begin + 1))
+
+    shards = []
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        ranges = []
+        for movieId in np.unique(zmwMovies[begin:end]):
+            rows = np.flatnonzero(zmwMovies[begin:end] == movieId) + begin
+            ranges.append((movieId, int(zmwHoles[rows[0]]),
+                           int(zmwHoles[rows[-1]])))
+        shards.append(ranges)
+    shardBases = np.diff(np.concatenate(
+        ([0], cumBases[np.array(bounds[1:]) - 1])))
+    logging.debug("Planned {n} shards of {b} bases in total, the largest "
+                  "shard has {m} bases.".format(
+                      n=len(shards), b=totalBases, m=int(shardBases.max())))
+    return shards
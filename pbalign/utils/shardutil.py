@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines functions for splitting pbalign inputs into shards
+which can be aligned independently, and for merging the aligned shards."""
+
+from __future__ import absolute_import
+import logging
+from os import path
+
+from pbcore.io import openDataFile
+
+from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS, \
+    getFilesFromFOFN, real_ppath, real_upath
+from pbalign.utils.progutil import Execute
+from pbalign.utils.shardplanner import planShards
+
+
+def _splitFOFN(fofnFileName, nShards, outDir):
+    """Split files listed in a FOFN into at most nShards FOFN files,
+    and return a list of the new FOFN files."""
+    files = [real_ppath(f) for f in getFilesFromFOFN(fofnFileName)]
+    nShards = min(nShards, len(files))
+    shardFiles = []
+    for i in range(nShards):
+        shardFile = path.join(outDir, "shard{0}.fofn".format(i))
+        with open(shardFile, 'w') as writer:
+            writer.write("\n".join(files[i::nShards]) + "\n")
+        shardFiles.append(shardFile)
+    return shardFiles
+
+
+def _filterRequirements(ds):
+    """Return filters of a dataset as a list of dicts, which map property
+    names to lists of (operator, value) requirements, or [{}] if the
+    dataset has no filters."""
+    filters = []
+    for filt in ds.filters:
+        requirements = {}
+        for req in filt:
+            requirements.setdefault(req.name, []).append(
+                (req.operator, req.value))
+        filters.append(requirements)
+    return filters if len(filters) > 0 else [{}]
+
+
+def _planDataSetShards(ds, nShards, maxBasesPerShard):
+    """Split an indexed dataset into ZMW-range datasets with roughly equal
+    numbers of bases, planned from qStart/qEnd columns of its .pbi index,
+    and return a list of the new datasets. The index of a filtered dataset
+    only has rows passing its filters, and the filters are kept."""
+    index = ds.index
+    movieNames = dict(zip(ds.readGroupTable.ID, ds.readGroupTable.MovieName))
+    filters = _filterRequirements(ds)
+    chunks = []
+    for ranges in planShards(index.qId, index.holeNumber, index.qStart,
+                             index.qEnd, nShards, maxBasesPerShard):
+        chunk = ds.copy()
+        chunk.newUuid()
+        while len(chunk.filters) > 0:
+            chunk.filters.removeFilter(0)
+        # Filters are OR'ed, requirements within a filter are AND'ed, so
+        # each existing filter is combined with each ZMW range.
+        for requirements in filters:
+            for movieId, firstHole, lastHole in ranges:
+                filt = dict((name, list(reqs))
+                            for name, reqs in requirements.iteritems())
+                filt.setdefault('movie', []).append(
+                    ('=', movieNames[movieId]))
+                filt.setdefault('zm', []).extend(
+                    [('>=', firstHole), ('<=', lastHole)])
+                chunk.filters.addFilter(**filt)
+        chunk.updateCounts()
+        chunks.append(chunk)
+    return chunks
+
+
+def _splitDataSet(fileName, nShards, outDir, maxBasesPerShard=None):
+    """Split a dataset (or a BAM file) into ZMW-range datasets using its
+    .pbi index, and return a list of the new dataset XML files."""
+    ds = openDataFile(real_ppath(fileName))
+    if ds.isIndexed:
+        chunks = _planDataSetShards(ds, nShards, maxBasesPerShard)
+    else:
+        logging.warning("Input {f} is not indexed, split by files instead "
+                        "of ZMWs.".format(f=fileName))
+        chunks = ds.split(chunks=nShards)
+    shardFiles = []
+    for i, chunk in enumerate(chunks):
+        shardFile = path.join(outDir, "shard{0}.xml".format(i))
+        chunk.write(shardFile)
+        shardFiles.append(shardFile)
+    return shardFiles
+
+
+def splitInputFile(inputFileName, nShards, outDir, maxBasesPerShard=None):
+    """Split an input file into shards under outDir.
+        Input:
+            inputFileName: a SubreadSet/ConsensusReadSet XML, a BAM or a
+                           FOFN file.
+            nShards      : the number of shards.
+            outDir       : a directory for saving shard files.
+            maxBasesPerShard: if not None, an indexed dataset is split into
+                           more than nShards shards so that each shard
+                           has at most this many bases.
+        Output:
+            a list of shard files, which can be used as pbalign inputs.
+            If the input can not be split, return [inputFileName].
+    """
+    inFormat = getFileFormat(real_ppath(inputFileName))
+    shardFiles = []
+    if nShards > 1 or maxBasesPerShard is not None:
+        if inFormat in [FILE_FORMATS.XML, FILE_FORMATS.BAM]:
+            shardFiles = _splitDataSet(inputFileName, nShards, outDir,
+                                       maxBasesPerShard)
+        elif inFormat == FILE_FORMATS.FOFN:
+            shardFiles = _splitFOFN(inputFileName, nShards, outDir)
+        else:
+            logging.warning("Could not split {f} of format {fm} into "
+                            "shards.".format(f=inputFileName, fm=inFormat))
+    if len(shardFiles) == 0:
+        return [inputFileName]
+    logging.info("Split {f} into {n} shards.".format(f=inputFileName,
+                                                     n=len(shardFiles)))
+    return shardFiles
+
+
+def _mergeSams(inSamFiles, outSamFile):
+    """Concatenate SAM files, keeping unique header lines in order."""
+    headers, seen = [], set()
+    for inSamFile in inSamFiles:
+        with open(real_ppath(inSamFile), 'r') as reader:
+            for line in reader:
+                if not line.startswith('@'):
+                    break
+                if line not in seen:
+                    seen.add(line)
+                    headers.append(line)
+    with open(real_ppath(outSamFile), 'w') as writer:
+        writer.writelines(headers)
+        for inSamFile in inSamFiles:
+            with open(real_ppath(inSamFile), 'r') as reader:
+                for line in reader:
+                    if not line.startswith('@'):
+                        writer.write(line)
+
+
+def mergeShardOutputs(inFiles, outFile, nproc=1):
+    """Merge aligned SAM/BAM shards into outFile.
+        Input:
+            inFiles: a list of SAM or BAM files, one per shard.
+            outFile: the merged SAM or BAM file.
+            nproc  : number of threads samtools can use.
+    """
+    logging.info("Merge {n} aligned shards into {o}.".format(n=len(inFiles),
+                                                             o=outFile))
+    if getFileFormat(real_ppath(outFile)) == FILE_FORMATS.SAM:
+        _mergeSams(inFiles, outFile)
+    else:
+        # Combine @RG and @PG headers of all shards.
+        cmd = "samtools merge -f -c -p --threads {t} {o} {i}".format(
+            t=max(0, int(nproc) - 1), o=real_upath(outFile),
+            i=" ".join([real_upath(f) for f in inFiles]))
+        Execute("ShardMerge", cmd)
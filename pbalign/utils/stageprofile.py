@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class StageProfiler, which measures wall time, CPU
+time and peak memory of pbalign stages and writes them as a JSON report."""
+
+from __future__ import absolute_import, division
+import json
+import logging
+import resource
+import time
+from contextlib import contextmanager
+
+
+def _usage():
+    """Return resource usage of this process and its waited-for children."""
+    return (time.time(), resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+class StageProfiler(object):
+    """Record wall time, user/system CPU time of pbalign itself and of its
+    child processes (e.g., blasr, samtools), and peak RSS of children for
+    each stage.
+
+        Note that peak RSS of children (ru_maxrss of RUSAGE_CHILDREN) is
+        the largest RSS of any child terminated so far, so the peak of a
+        stage is only known if it exceeds peaks of earlier stages,
+        otherwise it is reported as null.
+    """
+    def __init__(self):
+        self.stages = []
+        self.inputBases = None
+        self.inputReads = None
+        self._start = _usage()
+
+    @contextmanager
+    def stage(self, name):
+        """Measure a stage within a with-statement."""
+        before = _usage()
+        try:
+            yield
+        finally:
+            after = _usage()
+            self.stages.append(self._delta(name, before, after))
+
+    @staticmethod
+    def _delta(name, before, after):
+        """Return a dict of resource usage between before and after."""
+        wall0, self0, child0 = before
+        wall1, self1, child1 = after
+        peak = child1.ru_maxrss if child1.ru_maxrss > child0.ru_maxrss \
+            else None
+        return {'stage': name,
+                'wallSeconds': round(wall1 - wall0, 3),
+                'userSeconds': round(self1.ru_utime - self0.ru_utime, 3),
+                'systemSeconds': round(self1.ru_stime - self0.ru_stime, 3),
+                'childUserSeconds': round(child1.ru_utime - child0.ru_utime,
+                                          3),
+                'childSystemSeconds': round(child1.ru_stime -
+                                            child0.ru_stime, 3),
+                'childPeakRssKB': peak}
+
+    def setInput(self, bases, reads):
+        """Record number of input bases and reads, either can be None if
+        it is unknown."""
+        self.inputBases = bases
+        self.inputReads = reads
+
+    def report(self):
+        """Return a dict of all recorded stages, totals and throughput."""
+        total = self._delta("total", self._start, _usage())
+        total['selfPeakRssKB'] = \
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        total['childPeakRssKB'] = \
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        for stage in self.stages + [total]:
+            if self.inputBases is not None and stage['wallSeconds'] > 0:
+                stage['basesPerSecond'] = round(
+                    self.inputBases / stage['wallSeconds'], 1)
+        return {'inputBases': self.inputBases,
+                'inputReads': self.inputReads,
+                'stages': self.stages,
+                'total': total}
+
+    def write(self, fileName):
+        """Write the report to a JSON file."""
+        with open(fileName, 'w') as writer:
+            json.dump(self.report(), writer, indent=2, sort_keys=True)
+        logging.info("Stage statistics written to {f}.".format(f=fileName))
+
+
+@contextmanager
+def profileStage(profiler, name):
+    """Measure a stage with profiler, or do nothing if profiler is None."""
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name):
+            yield
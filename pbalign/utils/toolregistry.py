@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class ToolRegistry, which resolves external tools
+(e.g., blasr, samtools) on PATH once per process, and probes their versions
+once per binary, persisting versions in a small JSON cache keyed by binary
+path, size and mtime, so that short pbalign runs do not spawn a shell for
+every availability or version check."""
+
+from __future__ import absolute_import, division
+import json
+import logging
+import os
+import re
+import tempfile
+from os import path
+from subprocess import Popen, PIPE, STDOUT
+
+try:
+    from shutil import which as _shutilWhich
+except ImportError:
+    _shutilWhich = None
+
+# External tools pbalign may call.
+KNOWN_TOOLS = ("blasr", "sawriter", "samtools", "pbindex", "pls2fasta",
+               "samFilter", "gmap", "gmap_build", "bowtie2", "bowtie2-build")
+
+# Environment variable of the version cache file, which defaults to
+# ~/.cache/pbalign/tools.json.
+TOOL_CACHE_ENV = "PBALIGN_TOOL_CACHE"
+
+_VERSION_PATTERN = re.compile(r"(\d+)\.(\d+)(?:\.(\d+))?")
+
+
+def which(progName, searchPath=None):
+    """Return the full path of an executable on searchPath (default is
+    PATH), or None if it is not found."""
+    if _shutilWhich is not None:
+        return _shutilWhich(progName, path=searchPath)
+    if path.dirname(progName) != "":
+        return progName if path.isfile(progName) and \
+            os.access(progName, os.X_OK) else None
+    if searchPath is None:
+        searchPath = os.environ.get("PATH", os.defpath)
+    for dirName in searchPath.split(os.pathsep):
+        fileName = path.join(dirName, progName)
+        if path.isfile(fileName) and os.access(fileName, os.X_OK):
+            return fileName
+    return None
+
+
+def parseVersion(versionString):
+    """Return the first version number in versionString as a tuple of
+    integers, e.g., (1, 9) for 'samtools 1.9', or None."""
+    if versionString is None:
+        return None
+    match = _VERSION_PATTERN.search(versionString)
+    if match is None:
+        return None
+    return tuple(int(n) for n in match.groups() if n is not None)
+
+
+def defaultCacheFile():
+    """Return the version cache file specified by PBALIGN_TOOL_CACHE, or
+    ~/.cache/pbalign/tools.json."""
+    cacheFile = os.environ.get(TOOL_CACHE_ENV)
+    if cacheFile:
+        return cacheFile
+    return path.join(path.expanduser("~"), ".cache", "pbalign", "tools.json")
+
+
+class ToolRegistry(object):
+    """Resolve external tools and probe their versions, once."""
+    def __init__(self, cacheFile=None, searchPath=None):
+        """Input:
+                cacheFile : a JSON file persisting versions of binaries,
+                            default is defaultCacheFile().
+                searchPath: directories to search tools, default is PATH.
+        """
+        self.cacheFile = defaultCacheFile() if cacheFile is None \
+            else cacheFile
+        self.searchPath = searchPath
+        self._paths = {}
+        self._versions = {}
+        self._cache = None
+
+    def path(self, progName):
+        """Return the full path of progName, or None if not found."""
+        searchPath = self.searchPath if self.searchPath is not None \
+            else os.environ.get("PATH", os.defpath)
+        key = (progName, searchPath)
+        if key not in self._paths:
+            self._paths[key] = which(progName, searchPath)
+        return self._paths[key]
+
+    def isAvailable(self, progName):
+        """Return True if progName is available, otherwise False."""
+        return self.path(progName) is not None
+
+    def check(self, progName):
+        """Raise a runtime error if progName is not available."""
+        if not self.isAvailable(progName):
+            errMsg = "{0} is not available.".format(progName)
+            logging.error(errMsg)
+            raise RuntimeError(errMsg)
+
+    def resolveAll(self, progNames=KNOWN_TOOLS):
+        """Return a dict of full paths (or None) of progNames."""
+        return dict((progName, self.path(progName))
+                    for progName in progNames)
+
+    def _loadCache(self):
+        """Return the persisted version cache."""
+        if self._cache is None:
+            self._cache = {}
+            try:
+                with open(self.cacheFile, 'r') as reader:
+                    self._cache = json.load(reader)
+            except (IOError, OSError, ValueError):
+                pass
+        return self._cache
+
+    def _saveCache(self):
+        """Persist the version cache atomically, ignoring failures, e.g.,
+        if the home directory is read-only."""
+        try:
+            cacheDir = path.dirname(path.abspath(self.cacheFile))
+            if not path.isdir(cacheDir):
+                os.makedirs(cacheDir)
+            fd, tmpName = tempfile.mkstemp(dir=cacheDir, prefix=".tools")
+            with os.fdopen(fd, 'w') as writer:
+                json.dump(self._cache, writer, indent=2, sort_keys=True)
+            os.rename(tmpName, self.cacheFile)
+        except (IOError, OSError) as e:
+            logging.debug("Could not save tool cache {f}: {e}".format(
+                f=self.cacheFile, e=e))
+
+    @staticmethod
+    def _probe(fileName, versionArg):
+        """Run fileName versionArg and return the first line of its output,
+        or None if it fails."""
+        try:
+            process = Popen([fileName, versionArg], stdout=PIPE,
+                            stderr=STDOUT)
+        except OSError:
+            return None
+        output = process.communicate()[0].decode('utf-8', 'replace')
+        if process.returncode != 0:
+            return None
+        lines = [line.strip() for line in output.splitlines()
+                 if line.strip() != ""]
+        return lines[0] if len(lines) > 0 else None
+
+    def version(self, progName, versionArg="--version"):
+        """Return the first line printed by progName versionArg, or None if
+        progName is not available or fails. It is only run once for each
+        binary, identified by its path, size and mtime."""
+        if progName in self._versions:
+            return self._versions[progName]
+        fileName = self.path(progName)
+        version = None
+        if fileName is not None:
+            fileName = path.realpath(fileName)
+            stat = os.stat(fileName)
+            cache = self._loadCache()
+            record = cache.get(fileName)
+            if record is not None and record.get('size') == stat.st_size \
+                    and record.get('mtime') == stat.st_mtime and \
+                    record.get('arg') == versionArg:
+                version = record.get('version')
+            else:
+                version = self._probe(fileName, versionArg)
+                cache[fileName] = {'size': stat.st_size,
+                                   'mtime': stat.st_mtime,
+                                   'arg': versionArg, 'version': version}
+                self._saveCache()
+        self._versions[progName] = version
+        return version
+
+    def versionTuple(self, progName, default=None, versionArg="--version"):
+        """Return the version of progName as a tuple of integers, or
+        default if it is unknown."""
+        version = parseVersion(self.version(progName, versionArg))
+        return default if version is None else version
+
+
+_REGISTRY = None
+
+
+def getToolRegistry():
+    """Return the ToolRegistry shared within this process."""
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = ToolRegistry()
+    return _REGISTRY
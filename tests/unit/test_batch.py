@@ -0,0 +1,132 @@
+"""Test pbalign.batch."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+from multiprocessing import Pool
+from os import path
+from pbalign.batch import readManifest, batchArgs, alignInProcesses, \
+    runBatch
+
+
+def _fakeAlign(args):
+    """Fake aligner which fails on inputs named bad.bam."""
+    bad = path.basename(args.inputFileName) == "bad.bam"
+    return {"input": args.inputFileName, "output": args.outputFileName,
+            "exitCode": 1 if bad else 0, "error": "bad" if bad else None,
+            "seconds": 0, "nproc": args.nproc,
+            "indexCacheDir": args.indexCacheDir}
+
+
+def _square(x):
+    """Return x * x."""
+    return x * x
+
+
+def _poolAlign(args):
+    """Fake aligner which starts processes of its own, like an input
+    aligned in --shards, and crashes on inputs named bad.bam."""
+    if path.basename(args.inputFileName) == "bad.bam":
+        os._exit(3)
+    pool = Pool(processes=2)
+    try:
+        squares = pool.map(_square, [1, 2, 3])
+    finally:
+        pool.close()
+        pool.join()
+    result = _fakeAlign(args)
+    result["squares"] = squares
+    return result
+
+
+class Test_batch(unittest.TestCase):
+    """Test readManifest, batchArgs and runBatch."""
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        self.manifest = path.join(self.rootDir, "manifest.tsv")
+        with open(self.manifest, 'w') as writer:
+            writer.write("# input\toutput\n\n" +
+                         "a.bam\ta.aligned.bam\n" +
+                         "/data/b.bam  /out/b.aligned.xml\n")
+        self.reference = path.join(self.rootDir, "ref.fasta")
+        with open(self.reference, 'w') as writer:
+            writer.write(">ref\nACGT\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def _args(self, nproc):
+        """Return pbalign options of a batch."""
+        return Namespace(inputFileName=self.manifest,
+                         referencePath=self.reference,
+                         outputFileName=path.join(self.rootDir, "sum.json"),
+                         nproc=nproc, tmpDir=self.rootDir,
+                         indexCacheDir=None, unaligned="unaligned.txt")
+
+    def test_readManifest(self):
+        """Relative paths are relative to the manifest."""
+        self.assertEqual(readManifest(self.manifest),
+                         [(path.join(self.rootDir, "a.bam"),
+                           path.join(self.rootDir, "a.aligned.bam")),
+                          ("/data/b.bam", "/out/b.aligned.xml")])
+        with open(self.manifest, 'a') as writer:
+            writer.write("c.bam /out/b.aligned.xml\n")
+        self.assertRaises(ValueError, readManifest, self.manifest)
+        with open(self.manifest, 'w') as writer:
+            writer.write("a.bam\n")
+        self.assertRaises(ValueError, readManifest, self.manifest)
+
+    def test_batchArgs(self):
+        """Workers share the nproc budget."""
+        pairs = readManifest(self.manifest)
+        jobArgs, nWorkers = batchArgs(self._args(5), pairs, "/ref", "/c")
+        self.assertEqual(nWorkers, 2)
+        self.assertEqual([a.nproc for a in jobArgs], [2, 2])
+        self.assertEqual(jobArgs[1].inputFileName, "/data/b.bam")
+        self.assertEqual(jobArgs[1].referencePath, "/ref")
+        self.assertEqual(jobArgs[1].indexCacheDir, "/c")
+        self.assertEqual(jobArgs[1].unaligned,
+                         "/out/b.aligned.unaligned.txt")
+        jobArgs, nWorkers = batchArgs(self._args(1), pairs, "/ref")
+        self.assertEqual((nWorkers, jobArgs[0].nproc), (1, 1))
+        self.assertEqual(jobArgs[0].indexCacheDir, None)
+
+    def test_runBatch(self):
+        """A summary of all inputs is written, and failures are counted."""
+        args = self._args(2)
+        self.assertEqual(runBatch(args, _fakeAlign), 0)
+        with open(args.outputFileName) as reader:
+            summary = json.load(reader)
+        self.assertEqual(summary["failed"], 0)
+        self.assertEqual(len(summary["inputs"]), 2)
+        # Inputs share a batch index cache, which is removed afterwards.
+        cacheDirs = set(r["indexCacheDir"] for r in summary["inputs"])
+        self.assertEqual(len(cacheDirs), 1)
+        self.assertFalse(path.exists(cacheDirs.pop()))
+
+        with open(self.manifest, 'a') as writer:
+            writer.write("bad.bam bad.aligned.bam\n")
+        self.assertEqual(runBatch(args, _fakeAlign), 1)
+        with open(args.outputFileName) as reader:
+            summary = json.load(reader)
+        self.assertEqual(summary["failed"], 1)
+        self.assertEqual(summary["inputs"][-1]["error"], "bad")
+
+    def test_alignInProcesses(self):
+        """Workers may start processes of their own, and a crashed worker
+        fails its input only."""
+        jobArgs, _nWorkers = batchArgs(self._args(2), [
+            ("a.bam", "a.aligned.bam"), ("bad.bam", "bad.aligned.bam"),
+            ("c.bam", "c.aligned.bam")], "/ref")
+        results = alignInProcesses(_poolAlign, jobArgs, 2)
+        self.assertEqual([r["input"] for r in results],
+                         ["a.bam", "bad.bam", "c.bam"])
+        self.assertEqual([r["exitCode"] for r in results], [0, 1, 0])
+        self.assertEqual(results[0]["squares"], [1, 4, 9])
+        self.assertIn("code 3", results[1]["error"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+"""Test building and caching bowtie2 index files."""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from argparse import Namespace
+from os import path
+
+from pbalign.alignservice.bowtie import BowtieService, BT2_CACHED_BASENAME, \
+    bt2IndexFiles
+from pbalign.utils.indexcache import IndexCache, INDEX_CACHE_DIR_ENV
+from pbalign.utils.tempfileutil import TempFileManager
+
+# A stub bowtie2-build, which logs its arguments and writes index files
+# named after its last argument.
+_BOWTIE2_BUILD = """#!/bin/sh
+echo "$@" >> {log}
+for arg; do base=$arg; done
+for ext in 1.bt2 2.bt2 3.bt2 4.bt2 rev.1.bt2 rev.2.bt2; do
+    echo index > $base.$ext
+done
+"""
+
+
+class Test_BowtieIndex(unittest.TestCase):
+    """Test building bowtie2 index files in and out of the index cache."""
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        binDir = path.join(self.rootDir, "bin")
+        os.mkdir(binDir)
+        self.buildLog = path.join(self.rootDir, "build.log")
+        buildCmd = path.join(binDir, "bowtie2-build")
+        with open(buildCmd, 'w') as writer:
+            writer.write(_BOWTIE2_BUILD.format(log=self.buildLog))
+        os.chmod(buildCmd, os.stat(buildCmd).st_mode | stat.S_IEXEC)
+        self.oldPath = os.environ["PATH"]
+        os.environ["PATH"] = binDir + os.pathsep + self.oldPath
+        self.oldCacheDir = os.environ.pop(INDEX_CACHE_DIR_ENV, None)
+
+        self.reads = path.join(self.rootDir, "reads.fasta")
+        self.reference = path.join(self.rootDir, "ref.fasta")
+        for fileName in (self.reads, self.reference):
+            with open(fileName, 'w') as writer:
+                writer.write(">r\nACGT\n")
+        self.cacheDir = path.join(self.rootDir, "cache")
+
+    def tearDown(self):
+        os.environ["PATH"] = self.oldPath
+        if self.oldCacheDir is not None:
+            os.environ[INDEX_CACHE_DIR_ENV] = self.oldCacheDir
+        shutil.rmtree(self.rootDir)
+
+    def _builds(self):
+        """Return arguments of bowtie2-build calls."""
+        if not path.exists(self.buildLog):
+            return []
+        return [line.split() for line in open(self.buildLog)]
+
+    def _preProcess(self, indexCacheDir):
+        """Prepare the reference with a new BowtieService, and return
+        (the service, temporary files it registered)."""
+        service = BowtieService.__new__(BowtieService)
+        service._options = Namespace(nproc=4, indexCacheDir=indexCacheDir,
+                                     indexCacheSize=1)
+        tempFileManager = TempFileManager(path.join(self.rootDir, "tmp"))
+        registered = []
+        tempFileManager.RegisterExistingTmpFile = \
+            lambda f, own=False, isDir=False: registered.append(f)
+        self.assertEqual(service._preProcess(
+            self.reads, self.reference, None, False, tempFileManager,
+            False), self.reads)
+        if service._indexCache is not None:
+            service._indexCache.release()
+        return service, registered
+
+    def test_cached(self):
+        """Index files are cached by reference content and reused."""
+        service, registered = self._preProcess(self.cacheDir)
+        key = "{h}.bt2".format(h=IndexCache(self.cacheDir, 1 << 30).
+                               contentHash(self.reference))
+        baseName = path.join(self.cacheDir, key, BT2_CACHED_BASENAME)
+        self.assertEqual(service._refBaseName, baseName)
+        self.assertTrue(all(path.exists(f) for f in bt2IndexFiles(baseName)))
+        self.assertEqual(registered, [])
+        # Reads are FASTA, so all threads build the index.
+        self.assertEqual(self._builds(), [
+            ["-q", "-f", "--threads", "4", self.reference,
+             path.join(self.cacheDir, ".build." + key, key,
+                       BT2_CACHED_BASENAME)]])
+
+        # A copy of the reference reuses the cached index.
+        shutil.copy(self.reference, path.join(self.rootDir, "copy.fasta"))
+        self.reference = path.join(self.rootDir, "copy.fasta")
+        service, _registered = self._preProcess(self.cacheDir)
+        self.assertEqual(service._refBaseName, baseName)
+        self.assertEqual(len(self._builds()), 1)
+
+    def test_uncached(self):
+        """Without an index cache, index files are temporary files."""
+        service, registered = self._preProcess(None)
+        baseName = path.join(self.rootDir, "tmp", "ref")
+        self.assertEqual(service._refBaseName, baseName)
+        self.assertEqual(registered, bt2IndexFiles(baseName))
+        self.assertEqual(len(self._builds()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
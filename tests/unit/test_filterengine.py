@@ -0,0 +1,129 @@
+"""Test pbalign.filterengine."""
+
+import unittest
+import tempfile
+import shutil
+from os import path
+
+import numpy as np
+import pysam
+
+from pbalign.filterengine import FilterEngine, alignmentMetrics, \
+    queryGroupedBatches
+
+HEADER = {'HD': {'VN': '1.5'},
+          'SQ': [{'SN': 'ref1', 'LN': 10000}, {'SN': 'ref2', 'LN': 10000}]}
+
+
+def makeRecord(name, tid, pos, cigar, nm, score, flag=0, sequence=None):
+    """Make a pysam.AlignedSegment, without an NM tag if nm is None."""
+    header = pysam.AlignmentHeader.from_dict(HEADER)
+    record = pysam.AlignedSegment(header)
+    record.query_name = name
+    record.flag = flag
+    record.reference_id = tid
+    record.reference_start = pos
+    record.mapping_quality = 254
+    record.cigarstring = cigar
+    length = record.infer_query_length()
+    record.query_sequence = "A" * length if sequence is None else sequence
+    if nm is not None:
+        record.set_tag("NM", nm)
+    record.set_tag("AS", score)
+    return record
+
+
+class Test_FilterEngine(unittest.TestCase):
+    """Test filtering alignments in-process."""
+
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def test_alignmentMetrics(self):
+        """Metrics are computed from CIGAR and NM."""
+        records = [makeRecord("q1", 0, 0, "5S90M5I5D", 15, -100),
+                   makeRecord("q2", 0, 0, "80=10X10I", 20, -100)]
+        metrics = alignmentMetrics(records)
+        # q1: 5 mismatches within M, q2: 10 mismatches.
+        self.assertEqual(list(metrics['matches']), [85, 80])
+        self.assertEqual(list(metrics['mismatches']), [5, 10])
+        self.assertEqual(list(metrics['alignedLength']), [95, 100])
+        self.assertTrue(np.allclose(metrics['similarity'],
+                                    [100.0 * 85 / 100, 100.0 * 80 / 100]))
+        self.assertTrue(np.allclose(metrics['accuracy'],
+                                    [100.0 * (1 - 15 / 95.0), 80.0]))
+
+    def test_queryGroupedBatches(self):
+        """Hits of a query are never split between batches."""
+        records = [makeRecord(name, 0, 0, "10M", 0, 0)
+                   for name in ["a", "a", "a", "b", "c", "c"]]
+        batches = list(queryGroupedBatches(records, 2))
+        self.assertEqual([[r.query_name for r in batch]
+                          for batch in batches],
+                         [["a", "a", "a"], ["b", "c", "c"]])
+
+    def test_run(self):
+        """Filter a SAM file and write a BAM file."""
+        inSam = path.join(self.outDir, "in.sam")
+        outBam = path.join(self.outDir, "out.bam")
+        records = [makeRecord("q1", 0, 100, "100M", 2, 190),
+                   makeRecord("q1", 1, 100, "100M", 1, 195, flag=256),
+                   makeRecord("q2", 0, 100, "50M50I", 50, 20),
+                   makeRecord("q3", 0, 500, "30M", 0, 60)]
+        writer = pysam.AlignmentFile(inSam, "w", header=HEADER)
+        for record in records:
+            writer.write(record)
+        writer.close()
+
+        engine = FilterEngine(minPctAccuracy=70, minLength=50, scoreSign=1,
+                              hitPolicy="randombest", seed=1)
+        self.assertEqual(engine.run(inSam, outBam), (4, 1))
+        out = list(pysam.AlignmentFile(outBam, "rb", check_sq=False))
+        self.assertEqual(len(out), 1)
+        self.assertEqual((out[0].query_name, out[0].reference_id), ("q1", 1))
+        self.assertFalse(out[0].is_secondary)
+
+    def test_withoutNM(self):
+        """Mismatches of M operations without NM are counted against the
+        reference, or the hit fails accuracy criteria without one."""
+        reference = path.join(self.outDir, "ref.fasta")
+        with open(reference, 'w') as writer:
+            writer.write(">ref1 first\n" + "ACGT" * 25 + "\n>ref2\nACGT\n")
+        # 3 mismatches within the last 4 of 20 bases.
+        query = "ACGT" * 4 + "TTTT"
+        records = [makeRecord("q1", 0, 0, "20M", None, 0, sequence=query),
+                   makeRecord("q2", 0, 0, "20=", None, 0)]
+        metrics = alignmentMetrics(records)
+        self.assertEqual(list(metrics['unknown']), [True, False])
+        self.assertTrue(np.isnan(metrics['accuracy'][0]))
+        self.assertEqual(metrics['accuracy'][1], 100.0)
+
+        fasta = pysam.FastaFile(reference)
+        metrics = alignmentMetrics(records, fasta)
+        fasta.close()
+        self.assertEqual(list(metrics['unknown']), [False, False])
+        self.assertEqual(list(metrics['mismatches']), [3, 0])
+        self.assertEqual(metrics['accuracy'][0], 85.0)
+
+        inSam = path.join(self.outDir, "in.sam")
+        writer = pysam.AlignmentFile(inSam, "w", header=HEADER)
+        writer.write(records[0])
+        writer.close()
+        engine = FilterEngine(minPctAccuracy=90, scoreSign=1)
+        self.assertEqual(engine.run(inSam, path.join(self.outDir, "a.sam")),
+                         (1, 0))
+        engine = FilterEngine(minPctAccuracy=80, scoreSign=1,
+                              referenceFile=reference)
+        self.assertEqual(engine.run(inSam, path.join(self.outDir, "b.sam")),
+                         (1, 1))
+        engine = FilterEngine(minPctAccuracy=90, scoreSign=1,
+                              referenceFile=reference)
+        self.assertEqual(engine.run(inSam, path.join(self.outDir, "c.sam")),
+                         (1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
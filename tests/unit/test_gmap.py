@@ -0,0 +1,101 @@
+"""Test creating GMAP databases in reference repositories."""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from os import path
+
+from pbalign.alignservice.gmap import GMAPService
+
+
+class _GMAPService(GMAPService):
+    """A GMAPService whose gmap_build only makes a DB dir, and records
+    each build in builds.log under the DB root."""
+    def __init__(self):
+        pass
+
+    def _gmapBuild(self, dbRoot, dbName, referenceFile):
+        with open(path.join(dbRoot, "builds.log"), 'a') as writer:
+            writer.write(referenceFile + "\n")
+        os.mkdir(path.join(dbRoot, dbName))
+        time.sleep(0.5)
+        open(path.join(dbRoot, dbName, "ref.idx"), 'w').close()
+
+
+def _createDB(rootDir):
+    """Create the DB in a separate process."""
+    _GMAPService()._gmapCreateRepositoryDB(rootDir, "gmap_db", "ref.fasta")
+
+
+class Test_GMAPRepositoryDB(unittest.TestCase):
+    """Test the gmap_db.done marker of finished builds."""
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        self.dbPath = path.join(self.rootDir, "gmap_db")
+        self.dbDone = self.dbPath + ".done"
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def _oldDB(self, done):
+        """Make a DB built earlier, marked done or not, with an empty lock
+        file left behind."""
+        os.mkdir(self.dbPath)
+        open(path.join(self.dbPath, "old"), 'w').close()
+        open(self.dbPath + ".lock", 'w').close()
+        if done:
+            open(self.dbDone, 'w').close()
+
+    def _builds(self):
+        """Return the number of builds."""
+        logFile = path.join(self.rootDir, "builds.log")
+        if not path.exists(logFile):
+            return 0
+        with open(logFile, 'r') as reader:
+            return len(reader.readlines())
+
+    def _create(self):
+        """Create the DB, return whether the old DB is kept."""
+        _createDB(self.rootDir)
+        self.assertTrue(path.exists(self.dbDone))
+        return path.exists(path.join(self.dbPath, "old"))
+
+    def test_new(self):
+        """A missing DB is built."""
+        self._create()
+        self.assertEqual(self._builds(), 1)
+
+    def test_done(self):
+        """A DB marked done is used."""
+        self._oldDB(done=True)
+        self.assertTrue(self._create())
+        self.assertEqual(self._builds(), 0)
+
+    def test_notDone(self):
+        """A DB without the marker, whose build crashed or was made by an
+        earlier version, is built again."""
+        self._oldDB(done=False)
+        self.assertFalse(self._create())
+        self.assertEqual(self._builds(), 1)
+
+    def test_concurrent(self):
+        """Concurrent builders in separate processes build the DB once,
+        and none of them returns before the DB is complete."""
+        builders = [multiprocessing.Process(target=_createDB,
+                                            args=(self.rootDir,))
+                    for _ in range(2)]
+        for builder in builders:
+            builder.start()
+        # Create the DB while the other builders are running.
+        self._create()
+        self.assertTrue(path.exists(path.join(self.dbPath, "ref.idx")))
+        for builder in builders:
+            builder.join()
+            self.assertEqual(builder.exitcode, 0)
+        self.assertEqual(self._builds(), 1)
+
+if __name__ == "__main__":
+    unittest.main()
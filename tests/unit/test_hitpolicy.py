@@ -0,0 +1,157 @@
+"""Test pbalign.hitpolicy."""
+
+import unittest
+import tempfile
+import shutil
+from os import path
+
+import numpy as np
+import pysam
+
+from pbalign.hitpolicy import selectHits, queryRandom, pickHits, \
+    strnumCmp, mergeQueryGroups, mergeHeaders, mergedMapQVs, mergeHits
+
+HEADER1 = {'HD': {'VN': '1.5'}, 'SQ': [{'SN': 'ref1', 'LN': 10000}],
+           'RG': [{'ID': 'rg1'}]}
+HEADER2 = {'HD': {'VN': '1.5'}, 'SQ': [{'SN': 'ref2', 'LN': 10000}],
+           'RG': [{'ID': 'rg1'}]}
+
+
+def makeRecord(header, name, pos, score, flag=0, mapQV=254):
+    """Make a pysam.AlignedSegment aligned to the first reference."""
+    record = pysam.AlignedSegment(pysam.AlignmentHeader.from_dict(header))
+    record.query_name = name
+    record.flag = flag
+    record.mapping_quality = mapQV
+    record.reference_id = 0
+    record.reference_start = pos
+    record.cigarstring = "10M"
+    record.query_sequence = "A" * 10
+    record.set_tag("AS", score)
+    return record
+
+
+class Test_HitPolicy(unittest.TestCase):
+    """Test applying hit policies and merging hits by query."""
+
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def test_selectHits(self):
+        """Hit policies select hits by scores."""
+        scores = np.array([5, 9, 9, 1])
+        positions = [(1, 10), (1, 50), (0, 70), (0, 0)]
+        rng = queryRandom("q", 1)
+        self.assertEqual(list(selectHits(scores, positions, "all", rng)),
+                         [0, 1, 2, 3])
+        self.assertEqual(selectHits(scores, positions, "allbest", rng),
+                         [1, 2])
+        self.assertEqual(selectHits(scores, positions, "leftmost", rng), [2])
+        # Policies which are not random need no random number generator.
+        self.assertEqual(selectHits(scores, positions, "leftmost", None),
+                         [2])
+        self.assertIn(selectHits(scores, positions, "randombest", rng)[0],
+                      [1, 2])
+        # The same query and seed always make the same selection.
+        self.assertEqual(
+            selectHits(scores, positions, "random", queryRandom("q", 7)),
+            selectHits(scores, positions, "random", queryRandom("q", 7)))
+
+    def test_pickHits(self):
+        """The best of at most maxHits selected hits is primary."""
+        records = [makeRecord(HEADER1, "q", pos, score)
+                   for pos, score in [(0, -50), (10, -90), (20, -70)]]
+        picked = pickHits(records, [-50, -90, -70], "all", -1, 1, maxHits=2)
+        self.assertEqual([r.reference_start for r in picked], [10, 20])
+        self.assertEqual([r.is_secondary for r in picked], [False, True])
+
+    def test_strnumCmp(self):
+        """Query names are ordered as by samtools sort -n."""
+        names = ["m/10/0_5", "m/2/10_20", "m/2/0_10", "m/02/0_10", "m",
+                 "m/2/0_9", "n/1"]
+        ordered = sorted(names, cmp=strnumCmp)
+        self.assertEqual(ordered, ["m", "m/02/0_10", "m/2/0_9", "m/2/0_10",
+                                   "m/2/10_20", "m/10/0_5", "n/1"])
+
+    def test_mergeQueryGroups(self):
+        """Hits of a query from all streams are merged."""
+        s1 = [makeRecord(HEADER1, n, 0, 0) for n in ["a/2", "a/2", "a/10"]]
+        s2 = [makeRecord(HEADER2, n, 0, 0) for n in ["a/1", "a/10"]]
+        merged = [(name, [index for index, _r in hits])
+                  for name, hits in mergeQueryGroups([s1, s2])]
+        self.assertEqual(merged, [("a/1", [1]), ("a/2", [0, 0]),
+                                  ("a/10", [0, 1])])
+
+        unsorted = [makeRecord(HEADER1, n, 0, 0) for n in ["a/10", "a/2"]]
+        with self.assertRaises(ValueError):
+            list(mergeQueryGroups([unsorted]))
+
+    def test_mergeHeaders(self):
+        """References, read groups and programs are merged."""
+        header, tidMaps = mergeHeaders([HEADER1, HEADER2, HEADER1])
+        self.assertEqual([sq['SN'] for sq in header['SQ']], ["ref1", "ref2"])
+        self.assertEqual(header['RG'], [{'ID': 'rg1'}])
+        self.assertEqual(tidMaps, [{0: 0}, {0: 1}, {0: 0}])
+
+    def test_mergeHeaders_refNames(self):
+        """@SQ lines follow the original order of references."""
+        header, tidMaps = mergeHeaders([HEADER2, HEADER1],
+                                       ["ref1", "ref2"])
+        self.assertEqual([sq['SN'] for sq in header['SQ']], ["ref1", "ref2"])
+        self.assertEqual(tidMaps, [{0: 1}, {0: 0}])
+
+    def test_mergedMapQVs(self):
+        """Hits tied for the best score are ambiguous, worse hits get 0."""
+        self.assertEqual(mergedMapQVs([254, 254], [-60, -50], -1), [254, 0])
+        self.assertEqual(mergedMapQVs([254, 254, 20], [-50, -50, -40], -1),
+                         [3, 3, 0])
+        self.assertEqual(mergedMapQVs([1, 254], [100, 100], 1), [1, 3])
+
+    def test_mergeHits(self):
+        """Apply a hit policy to hits merged from two files."""
+        inFiles = []
+        for i, (header, hits) in enumerate([
+                (HEADER1, [("q1", 100, -50), ("q2", 0, -80)]),
+                (HEADER2, [("q1", 5, -60), ("q2", 9, -90)])]):
+            inFiles.append(path.join(self.outDir, "p%d.sam" % i))
+            writer = pysam.AlignmentFile(inFiles[-1], "w", header=header)
+            for name, pos, score in hits:
+                writer.write(makeRecord(header, name, pos, score))
+            writer.close()
+
+        outBam = path.join(self.outDir, "out.bam")
+        self.assertEqual(mergeHits(inFiles, outBam, "randombest", -1, 1),
+                         (2, 2))
+        out = [(r.query_name, r.reference_name, r.reference_start)
+               for r in pysam.AlignmentFile(outBam, "rb")]
+        self.assertEqual(out, [("q1", "ref2", 5), ("q2", "ref2", 9)])
+
+    def test_mergeHits_mapQV(self):
+        """Mapping qualities are recomputed over hits of all files, and
+        @SQ lines follow the original order of references."""
+        inFiles = []
+        for i, (header, hits) in enumerate([
+                (HEADER2, [("q1", 5, -60), ("q2", 9, -90)]),
+                (HEADER1, [("q1", 100, -60)])]):
+            inFiles.append(path.join(self.outDir, "p%d.sam" % i))
+            writer = pysam.AlignmentFile(inFiles[-1], "w", header=header)
+            for name, pos, score in hits:
+                writer.write(makeRecord(header, name, pos, score))
+            writer.close()
+
+        outBam = path.join(self.outDir, "out.bam")
+        self.assertEqual(mergeHits(inFiles, outBam, "all", -1, 1,
+                                   refNames=["ref1", "ref2"]), (2, 3))
+        reader = pysam.AlignmentFile(outBam, "rb")
+        self.assertEqual(reader.references, ("ref1", "ref2"))
+        out = sorted((r.query_name, r.reference_name, r.mapping_quality)
+                     for r in reader)
+        self.assertEqual(out, [("q1", "ref1", 3), ("q1", "ref2", 3),
+                               ("q2", "ref2", 254)])
+
+
+if __name__ == "__main__":
+    unittest.main()
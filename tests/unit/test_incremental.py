@@ -0,0 +1,64 @@
+"""Test pbalign.incremental."""
+
+import shutil
+import tempfile
+import unittest
+from os import path
+
+import pysam
+from pbalign.incremental import bamMovieNames, datasetBams, \
+    checkReference, planIncrement
+
+
+def makeBam(fileName, movies):
+    """Make an empty BAM file with a read group of each movie."""
+    header = {'HD': {'VN': '1.5', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'ref', 'LN': 1000}],
+              'RG': [{'ID': "rg{0}".format(i), 'PU': movie, 'PL': 'PACBIO'}
+                     for i, movie in enumerate(movies)]}
+    pysam.AlignmentFile(fileName, 'wb', header=header).close()
+    return fileName
+
+
+class Test_incremental(unittest.TestCase):
+    """Test bamMovieNames and planIncrement."""
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def _bam(self, name, movies):
+        """Make a BAM file under the root dir."""
+        return makeBam(path.join(self.rootDir, name), movies)
+
+    def test_bamMovieNames(self):
+        """Movie names are read from @RG PU."""
+        bam = self._bam("a.bam", ["m1", "m2"])
+        self.assertEqual(bamMovieNames(bam), set(["m1", "m2"]))
+        self.assertEqual(datasetBams(bam), [bam])
+        self.assertRaises(ValueError, bamMovieNames, self._bam("b.bam", []))
+
+    def test_planIncrement(self):
+        """Only BAM files of new movies are aligned."""
+        existing = [self._bam("aligned1.bam", ["m1"]),
+                    self._bam("aligned2.bam", ["m2", "m3"])]
+        old = self._bam("old.bam", ["m2", "m3"])
+        new = self._bam("new.bam", ["m4"])
+        self.assertEqual(planIncrement(existing, [old, new]), [new])
+        self.assertEqual(planIncrement(existing, [old]), [])
+        self.assertEqual(planIncrement([], [old, new]), [old, new])
+        mixed = self._bam("mixed.bam", ["m1", "m5"])
+        self.assertRaises(ValueError, planIncrement, existing, [mixed])
+
+    def test_checkReference(self):
+        """Existing alignments must be aligned to the same reference."""
+        existing = [self._bam("aligned1.bam", ["m1"])]
+        checkReference(existing, [("ref", 1000)])
+        self.assertRaises(ValueError, checkReference, existing,
+                          [("ref", 999)])
+        self.assertRaises(ValueError, checkReference, existing,
+                          [("ref", 1000), ("chr2", 10)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Test pbalign.utils.indexcache."""
+
+import unittest
+import tempfile
+import shutil
+import os
+from os import path
+
+from pbalign.utils.indexcache import IndexCache, FileLock
+
+
+def _writer(content):
+    """Return a builder which writes content to its output file."""
+    calls = []
+    def build(outFile):
+        calls.append(outFile)
+        with open(outFile, 'w') as writer:
+            writer.write(content)
+    build.calls = calls
+    return build
+
+
+class Test_IndexCache(unittest.TestCase):
+    """Test building, sharing and evicting cached indexes."""
+
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        self.cache = IndexCache(path.join(self.rootDir, "cache"), 100)
+
+    def tearDown(self):
+        self.cache.release()
+        shutil.rmtree(self.rootDir)
+
+    def test_contentHash(self):
+        """Identical content gets the same hash, memoized in the cache."""
+        fa1 = path.join(self.rootDir, "a.fasta")
+        fa2 = path.join(self.rootDir, "b.fasta")
+        for fn in (fa1, fa2):
+            with open(fn, 'w') as writer:
+                writer.write(">r\nACGT\n")
+        h = self.cache.contentHash(fa1)
+        self.assertEqual(len(h), 40)
+        self.assertEqual(h, self.cache.contentHash(fa2))
+        self.assertTrue(path.exists(path.join(self.cache.rootDir,
+                                              "hashes.json")))
+
+    def test_fetch(self):
+        """An entry is built once, then reused."""
+        build = _writer("x" * 10)
+        entry = self.cache.fetch("ref.sa", build)
+        self.assertEqual(entry, path.join(self.cache.rootDir, "ref.sa"))
+        self.assertEqual(open(entry).read(), "x" * 10)
+        self.assertEqual(self.cache.fetch("ref.sa", build), entry)
+        self.assertEqual(len(build.calls), 1)
+        self.assertEqual(self.cache.entries(), ["ref.sa"])
+
+    def test_failed_build(self):
+        """A failed build leaves nothing behind."""
+        def build(outFile):
+            raise RuntimeError("sawriter failed")
+        with self.assertRaises(RuntimeError):
+            self.cache.fetch("ref.sa", build)
+        self.assertEqual(self.cache.entries(), [])
+        self.assertEqual([f for f in os.listdir(self.cache.rootDir)
+                          if f.startswith(".build.")], [])
+
+    def test_evict(self):
+        """Least recently used entries not in use are evicted."""
+        self.cache.fetch("a.sa", _writer("a" * 60))
+        self.cache.release()
+        os.utime(path.join(self.cache.rootDir, "a.sa"), (1, 1))
+        self.cache.fetch("b.sa", _writer("b" * 60))
+        self.assertEqual(self.cache.entries(), ["b.sa"])
+
+        # c.sa does not fit either, but b.sa is in use.
+        self.cache.fetch("c.sa", _writer("c" * 60))
+        self.assertEqual(sorted(self.cache.entries()), ["b.sa", "c.sa"])
+
+    def test_lock(self):
+        """An exclusive lock can not be taken while a shared one is held."""
+        lockFile = path.join(self.rootDir, "x.lock")
+        shared = FileLock(lockFile)
+        self.assertTrue(shared.acquire(shared=True))
+        self.assertFalse(FileLock(lockFile).acquire(blocking=False))
+        self.assertTrue(FileLock(lockFile).acquire(shared=True,
+                                                   blocking=False))
+        shared.release()
+        self.assertTrue(FileLock(lockFile).acquire(blocking=False))
+
+
+if __name__ == "__main__":
+    unittest.main()
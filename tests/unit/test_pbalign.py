@@ -2,12 +2,55 @@
 import unittest
 import tempfile
 import shutil
-from os import path
+import time
+from os import path, mkdir
 
-from pbalign.pbalignrunner import PBAlignRunner
+import pysam
+from pbalign.pbalignrunner import PBAlignRunner, _sortShard
+from pbalign.bampostservice import BamPostService
+from pbalign.utils.runmanifest import RunManifest
+from pbalign.utils.stageprofile import StageProfiler
 
 from test_setpath import ROOT_DIR, DATA_DIR
 
+def _fakeAlignShard(shard):
+    """Fake aligner which copies SAM records of a shard input after a
+    header, fails on records named bad and sleeps on records named slow."""
+    args = shard[0]
+    with open(args.inputFileName, 'r') as reader:
+        records = reader.read()
+    if records.startswith("bad"):
+        raise RuntimeError("Failed to align " + args.inputFileName)
+    if records.startswith("slow"):
+        time.sleep(30)
+    with open(args.outputFileName, 'w') as writer:
+        writer.write("@HD\tVN:1.5\tSO:unknown\n" + records)
+    return args.outputFileName
+
+
+def _fakeAlignSortShard(shard):
+    """Fake aligner which writes hits of a shard input, given as lines of
+    read names and positions, into an unsorted BAM file, and then sorts
+    it like _alignShard."""
+    args, _sa, _rgn, sortedBamFile, sortPlan = shard
+    header = {'HD': {'VN': '1.5', 'SO': 'unknown'},
+              'SQ': [{'SN': 'ref', 'LN': 100000}]}
+    with pysam.AlignmentFile(args.outputFileName, 'wb',
+                             header=header) as writer:
+        with open(args.inputFileName, 'r') as reader:
+            for line in reader:
+                name, position = line.split()
+                record = pysam.AlignedSegment()
+                record.query_name = name
+                record.reference_id = 0
+                record.reference_start = int(position)
+                record.mapping_quality = 254
+                record.cigarstring = "4M"
+                record.query_sequence = "ACGT"
+                writer.write(record)
+    return _sortShard(args, args.outputFileName, sortedBamFile, sortPlan)
+
+
 class Test_PBAlignRunner(unittest.TestCase):
     def setUp(self):
         self.rootDir = ROOT_DIR
@@ -59,5 +102,134 @@ class Test_PBAlignRunner(unittest.TestCase):
             pbobj.start()
 
 
+
+class Test_alignShards(unittest.TestCase):
+    """Test PBAlignRunner._alignShards() with a fake aligner."""
+    def setUp(self):
+        self.OUT_DIR = tempfile.mkdtemp()
+        self.shardsDir = path.join(self.OUT_DIR, "shards")
+        mkdir(self.shardsDir)
+        self.samOut = path.join(self.OUT_DIR, "filtered.sam")
+        self.runner = PBAlignRunner(argumentList=[
+            '--nproc', '3', '--shards', '3',
+            path.join(ROOT_DIR, "data/lambda_query.fasta"),
+            path.join(ROOT_DIR, "data/reference_lambda.xml"),
+            path.join(self.OUT_DIR, "out.sam")])
+        self.runner._profiler = StageProfiler()
+        self.runner.fileNames.filteredSam = self.samOut
+
+    def tearDown(self):
+        shutil.rmtree(self.OUT_DIR)
+
+    def _shardInputs(self, records):
+        """Make a shard input file of each record."""
+        shardInputs = []
+        for i, record in enumerate(records):
+            shardInputs.append(path.join(self.shardsDir,
+                                         "shard{0}.txt".format(i)))
+            with open(shardInputs[-1], 'w') as writer:
+                writer.write(record + "\t4\t*\t0\t255\t*\t*\t0\t0\t*\t*\n")
+        return shardInputs
+
+    def test_alignShards(self):
+        """Filtered shards are merged in order."""
+        self.runner._alignShards(self._shardInputs(["r1", "r2", "r3"]),
+                                 ".sam", alignFunc=_fakeAlignShard)
+        with open(self.samOut, 'r') as reader:
+            lines = reader.readlines()
+        self.assertEqual([line.split("\t")[0] for line in lines],
+                         ["@HD", "r1", "r2", "r3"])
+
+    def test_alignShards_error(self):
+        """If a shard fails, the error is raised at once and other workers
+        are terminated."""
+        shardInputs = self._shardInputs(["r1", "bad", "slow"])
+        start = time.time()
+        with self.assertRaises(RuntimeError):
+            self.runner._alignShards(shardInputs, ".sam",
+                                     alignFunc=_fakeAlignShard)
+        self.assertTrue(time.time() - start < 20)
+        # The slow shard was terminated before writing its output.
+        self.assertFalse(path.exists(path.join(self.shardsDir, "shard2",
+                                               "filtered.sam")))
+        self.assertFalse(path.exists(self.samOut))
+
+    def test_alignShards_sorted(self):
+        """Shards are sorted in their workers, and merged by samtools merge
+        into a coordinate-sorted BAM file with reads of all shards."""
+        positions = [[500, 10, 300], [20, 400], [600, 5, 250, 30]]
+        shardInputs, sortedShards = [], []
+        for i, shardPositions in enumerate(positions):
+            shardInputs.append(path.join(self.shardsDir,
+                                         "shard{0}.txt".format(i)))
+            with open(shardInputs[-1], 'w') as writer:
+                for j, position in enumerate(shardPositions):
+                    writer.write("r{i}_{j} {p}\n".format(i=i, j=j,
+                                                        p=position))
+            sortedShards.append(path.join(self.shardsDir,
+                                          "sorted{0}.bam".format(i)))
+        fileNames = self.runner.fileNames
+        fileNames.outBamFileName = path.join(self.OUT_DIR, "out.bam")
+        fileNames.outBaiFileName = fileNames.outBamFileName + ".bai"
+        self.runner._alignShards(shardInputs, ".bam", sortedShards,
+                                 alignFunc=_fakeAlignSortShard)
+        for sortedShard, shardPositions in zip(sortedShards, positions):
+            self.assertEqual([r.reference_start for r in
+                              pysam.AlignmentFile(sortedShard)],
+                             sorted(shardPositions))
+
+        BamPostService(filenames=fileNames, nproc=2, makePbi=False,
+                       sortedShards=sortedShards).run()
+        merged = pysam.AlignmentFile(fileNames.outBamFileName)
+        self.assertEqual(merged.header['HD']['SO'], 'coordinate')
+        starts = [r.reference_start for r in merged]
+        self.assertEqual(starts, sorted(sum(positions, [])))
+        self.assertEqual(len(starts), sum(len(p) for p in positions))
+        self.assertTrue(path.exists(fileNames.outBaiFileName))
+
+
+class Test_splitInput(unittest.TestCase):
+    """Test PBAlignRunner._splitInput() with --resume."""
+    def setUp(self):
+        self.OUT_DIR = tempfile.mkdtemp()
+        self.fofn = path.join(self.OUT_DIR, "in.fofn")
+        self._writeFofn(4)
+        self.runner = PBAlignRunner(argumentList=[
+            '--shards', '2', '--resume', self.fofn,
+            path.join(ROOT_DIR, "data/reference_lambda.xml"),
+            path.join(self.OUT_DIR, "out.bam")])
+        self.runner._manifest = RunManifest(self.runner._workDir(),
+                                            self.runner.args)
+        self.shardDir = path.join(self.runner._workDir(), "shards")
+
+    def tearDown(self):
+        shutil.rmtree(self.OUT_DIR)
+
+    def _writeFofn(self, nFiles):
+        """Write a FOFN of nFiles BAM file names."""
+        with open(self.fofn, 'w') as writer:
+            for i in range(nFiles):
+                writer.write("/data/movie{0}.bam\n".format(i))
+
+    def test_resume(self):
+        """Shards in the work dir are reused until the input changes."""
+        shards = self.runner._splitInput(2, None, [self.fofn])
+        self.assertEqual(shards, [path.join(self.shardDir, "shard0.fofn"),
+                                  path.join(self.shardDir, "shard1.fofn")])
+        # A file which would be removed if the input were split again.
+        marker = path.join(self.shardDir, "marker")
+        open(marker, 'w').close()
+        self.assertEqual(self.runner._splitInput(2, None, [self.fofn]),
+                         shards)
+        self.assertTrue(path.exists(marker))
+
+        self._writeFofn(3)
+        self.assertEqual(self.runner._splitInput(2, None, [self.fofn]),
+                         shards)
+        self.assertFalse(path.exists(marker))
+        with open(shards[0], 'r') as reader:
+            self.assertEqual(reader.read().split(),
+                             ["/data/movie0.bam", "/data/movie2.bam"])
+
 if __name__ == "__main__":
     unittest.main()
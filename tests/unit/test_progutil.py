@@ -1,5 +1,11 @@
 import unittest
+import os
+import shutil
+import signal
+import tempfile
+import time
 from os import path
+from pbalign.utils import progutil
 from pbalign.utils.progutil import *
 
 class Test_progutil(unittest.TestCase):
@@ -15,5 +21,135 @@ class Test_progutil(unittest.TestCase):
     def testExecute(self):
         Execute("ls", "ls")
 
+    def testToArgv(self):
+        self.assertEqual(toArgv("ls -l a\\ b 'c d'"),
+                         ["ls", "-l", "a b", "c d"])
+        self.assertEqual(toArgv("samtools --version || true"),
+                         ["bash", "-c", "samtools --version || true"])
+        self.assertEqual(toArgv(["echo", 1]), ["echo", "1"])
+
+    def testRun(self):
+        result = Run("echo", "bash -c 'echo out; echo err >&2; exit 3'")
+        self.assertEqual(result.output, ["out"])
+        self.assertEqual(result.errMsg, "err")
+        self.assertEqual(result.errCode, 3)
+        self.assertFalse(result.timedOut)
+        self.assertTrue(result.rusage.ru_maxrss > 0)
+        with self.assertRaises(RuntimeError):
+            Execute("false", "false")
+
+    def testBoundedCapture(self):
+        maxBytes = progutil.MAX_CAPTURED_BYTES
+        progutil.MAX_CAPTURED_BYTES = 1000
+        try:
+            result = Run("seq", "seq 1 100000")
+        finally:
+            progutil.MAX_CAPTURED_BYTES = maxBytes
+        self.assertEqual(result.output[0], "1")
+        self.assertTrue(sum(len(line) + 1 for line in result.output)
+                        <= 1000)
+
+    def testTimeout(self):
+        # The child of bash is killed together with bash.
+        start = time.time()
+        result = Run("sleep", "sleep 30 & sleep 30; wait", timeout=0.5)
+        self.assertTrue(result.timedOut)
+        self.assertTrue(result.errCode < 0)
+        self.assertTrue(time.time() - start < 10)
+        with self.assertRaises(RuntimeError):
+            Execute("sleep", "sleep 30", timeout=0.5)
+
+    def testInterrupt(self):
+        # An interrupted command is killed and reaped without waiting
+        # KILL_GRACE_SECONDS.
+        tmpDir = tempfile.mkdtemp()
+
+        def interrupt(_signum, _frame):
+            raise KeyboardInterrupt()
+        handler = signal.signal(signal.SIGALRM, interrupt)
+        try:
+            pidFile = path.join(tmpDir, "pid")
+            signal.alarm(1)
+            start = time.time()
+            with self.assertRaises(KeyboardInterrupt):
+                Run("sleep", "echo $$ > {0}; exec sleep 30".format(pidFile))
+            self.assertTrue(time.time() - start < progutil.KILL_GRACE_SECONDS)
+            with open(pidFile, 'r') as reader:
+                pid = int(reader.read())
+            # Not even a zombie is left behind.
+            self.assertRaises(OSError, os.kill, pid, 0)
+            self.assertEqual(progutil._ACTIVE_GROUPS, set())
+        finally:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, handler)
+            shutil.rmtree(tmpDir)
+
+    def testStart(self):
+        # stderr larger than a pipe buffer does not block stdout.
+        process = Start("seq", "seq 1 200000 >&2; echo out; exit 3")
+        self.assertEqual(process.stdout.read(), "out\n")
+        errCode, errMsg = Wait(process)
+        self.assertEqual(errCode, 3)
+        self.assertEqual(errMsg.split("\n")[-1], "200000")
+        self.assertEqual(progutil._ACTIVE_GROUPS, set())
+
+    def testKill(self):
+        # Children of bash are in its process group, which is killed.
+        start = time.time()
+        process = Start("sleep", "sleep 30 & sleep 30; wait")
+        self.assertTrue(process.pid in progutil._ACTIVE_GROUPS)
+        Kill(process)
+        errCode, _errMsg = Wait(process)
+        self.assertEqual(errCode, -9)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(progutil._ACTIVE_GROUPS, set())
+        # A waited process group is never signalled again.
+        Kill(process)
+
+    def testFeedFifo(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fifo = path.join(tmpDir, "aligned.sam")
+            os.mkfifo(fifo)
+            out = path.join(tmpDir, "sorted.sam")
+            sortCmd = "sort -n -o {o} {i}".format(o=out, i=fifo)
+
+            def align():
+                """A fake aligner writing hits into the FIFO."""
+                with open(fifo, 'w') as writer:
+                    writer.write("3\n1\n2\n")
+            process = Start("sort", sortCmd, stdout=None)
+            FeedFifo("sort", process, fifo, align)
+            self.assertEqual(Wait(process)[0], 0)
+            with open(out, 'r') as reader:
+                self.assertEqual(reader.read(), "1\n2\n3\n")
+
+            # The sorter is killed and waited if the aligner fails.
+            def failingAlign():
+                """A fake aligner failing after writing some hits."""
+                with open(fifo, 'w') as writer:
+                    writer.write("3\n")
+                raise RuntimeError("aligner failed")
+            process = Start("sort", sortCmd + "; sleep 30", stdout=None)
+            with self.assertRaises(RuntimeError):
+                FeedFifo("sort", process, fifo, failingAlign)
+            self.assertEqual(process.returncode, -9)
+            self.assertEqual(progutil._ACTIVE_GROUPS, set())
+
+            # The aligner does not block if the sorter exits early.
+            def longAlign():
+                """A fake aligner writing more than a pipe buffer."""
+                with open(fifo, 'w') as writer:
+                    for _i in range(100000):
+                        writer.write("1234567890\n")
+            start = time.time()
+            process = Start("true", "true", stdout=None)
+            with self.assertRaises(IOError):
+                FeedFifo("true", process, fifo, longAlign)
+            self.assertTrue(time.time() - start < 10)
+            self.assertEqual(progutil._ACTIVE_GROUPS, set())
+        finally:
+            shutil.rmtree(tmpDir)
+
 if __name__ == "__main__":
     unittest.main()
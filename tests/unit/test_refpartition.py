@@ -0,0 +1,57 @@
+"""Test pbalign.utils.refpartition."""
+
+import unittest
+import tempfile
+import shutil
+from os import path
+
+from pbalign.utils.refpartition import contigLengths, planPartitions, \
+    partitionReference, maxBasesForMemory
+
+
+class Test_RefPartition(unittest.TestCase):
+    """Test partitioning a reference by a memory budget."""
+
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.fasta = path.join(self.outDir, "ref.fasta")
+        with open(self.fasta, 'w') as writer:
+            for name, length in [("c1", 30), ("c2", 70), ("c3", 50),
+                                 ("c4", 40)]:
+                writer.write(">{n} contig {n}\n".format(n=name))
+                seq = "A" * length
+                for i in range(0, length, 20):
+                    writer.write(seq[i:i+20] + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def test_contigLengths(self):
+        """Contig lengths are read from FASTA."""
+        self.assertEqual(contigLengths(self.fasta),
+                         [("c1", 30), ("c2", 70), ("c3", 50), ("c4", 40)])
+
+    def test_planPartitions(self):
+        """Contigs are packed first fit decreasing."""
+        lengths = [("c1", 30), ("c2", 70), ("c3", 50), ("c4", 40)]
+        self.assertEqual(planPartitions(lengths, 100),
+                         [["c1", "c2"], ["c3", "c4"]])
+        self.assertEqual(planPartitions(lengths, 60),
+                         [["c2"], ["c3"], ["c4"], ["c1"]])
+        self.assertEqual(planPartitions(lengths, 1000),
+                         [["c1", "c2", "c3", "c4"]])
+
+    def test_partitionReference(self):
+        """Partition FASTA files are written only when needed."""
+        self.assertEqual(partitionReference(self.fasta, 1, self.outDir),
+                         [self.fasta])
+        maxMemoryGB = 100.0 * 8 / (1 << 30)
+        self.assertEqual(maxBasesForMemory(maxMemoryGB), 100)
+        parts = partitionReference(self.fasta, maxMemoryGB, self.outDir)
+        self.assertEqual(len(parts), 2)
+        self.assertEqual([contigLengths(p) for p in parts],
+                         [[("c1", 30), ("c2", 70)], [("c3", 50), ("c4", 40)]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+"""Test pbalign.utils.resourceplanner."""
+
+import unittest
+import tempfile
+import shutil
+import os
+import multiprocessing
+from os import path
+
+from pbalign.utils.resourceplanner import cgroupMemoryLimit, \
+    cgroupCpuQuota, availableMemory, memoryBudget, cpuBudget, planSort, \
+    MIN_SORT_MEMORY_PER_THREAD
+
+GB = 1 << 30
+
+
+class Test_ResourcePlanner(unittest.TestCase):
+    """Test reading cgroup and meminfo limits and planning sort."""
+
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        self.cgroupRoot = path.join(self.rootDir, "cgroup")
+        self.procRoot = path.join(self.rootDir, "proc")
+        os.makedirs(self.cgroupRoot)
+        os.makedirs(self.procRoot)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def _write(self, fileName, content):
+        """Write content to fileName, creating its directory."""
+        if not path.isdir(path.dirname(fileName)):
+            os.makedirs(path.dirname(fileName))
+        with open(fileName, 'w') as writer:
+            writer.write(content)
+
+    def _meminfo(self, availableKB):
+        """Write a meminfo file."""
+        self._write(path.join(self.procRoot, "meminfo"),
+                    "MemTotal:       {0} kB\nMemAvailable:   {1} kB\n".
+                    format(availableKB * 2, availableKB))
+
+    def test_cgroup_v2(self):
+        """Read memory.max and cpu.max of cgroup v2."""
+        self.assertIsNone(cgroupMemoryLimit(self.cgroupRoot, self.procRoot))
+        self.assertIsNone(cgroupCpuQuota(self.cgroupRoot, self.procRoot))
+        self._write(path.join(self.cgroupRoot, "memory.max"), "max\n")
+        self._write(path.join(self.cgroupRoot, "cpu.max"), "max 100000\n")
+        self.assertIsNone(cgroupMemoryLimit(self.cgroupRoot, self.procRoot))
+        self.assertIsNone(cgroupCpuQuota(self.cgroupRoot, self.procRoot))
+        self._write(path.join(self.cgroupRoot, "memory.max"),
+                    "{0}\n".format(4 * GB))
+        self._write(path.join(self.cgroupRoot, "cpu.max"),
+                    "250000 100000\n")
+        self.assertEqual(cgroupMemoryLimit(self.cgroupRoot, self.procRoot),
+                         4 * GB)
+        self.assertEqual(cgroupCpuQuota(self.cgroupRoot, self.procRoot), 2.5)
+
+    def test_cgroup_v1(self):
+        """Read memory.limit_in_bytes and cfs quota of cgroup v1."""
+        self._write(path.join(self.cgroupRoot, "memory",
+                              "memory.limit_in_bytes"),
+                    "9223372036854771712\n")
+        self._write(path.join(self.cgroupRoot, "cpu", "cpu.cfs_quota_us"),
+                    "-1\n")
+        self._write(path.join(self.cgroupRoot, "cpu", "cpu.cfs_period_us"),
+                    "100000\n")
+        self.assertIsNone(cgroupMemoryLimit(self.cgroupRoot, self.procRoot))
+        self.assertIsNone(cgroupCpuQuota(self.cgroupRoot, self.procRoot))
+        self._write(path.join(self.cgroupRoot, "memory",
+                              "memory.limit_in_bytes"), "2147483648\n")
+        self._write(path.join(self.cgroupRoot, "cpu", "cpu.cfs_quota_us"),
+                    "400000\n")
+        self.assertEqual(cgroupMemoryLimit(self.cgroupRoot, self.procRoot),
+                         2 * GB)
+        self.assertEqual(cgroupCpuQuota(self.cgroupRoot, self.procRoot), 4)
+
+    def test_cgroup_nested(self):
+        """Limits of the cgroup of this process and of its ancestors are
+        read, the smallest one wins."""
+        self._write(path.join(self.procRoot, "self", "cgroup"),
+                    "0::/system.slice/slurm/job42\n")
+        jobDir = path.join(self.cgroupRoot, "system.slice", "slurm", "job42")
+        self._write(path.join(jobDir, "memory.max"), str(2 * GB) + "\n")
+        self._write(path.join(jobDir, "cpu.max"), "max 100000\n")
+        self._write(path.join(self.cgroupRoot, "system.slice", "slurm",
+                              "cpu.max"), "300000 100000\n")
+        self.assertEqual(cgroupMemoryLimit(self.cgroupRoot, self.procRoot),
+                         2 * GB)
+        self.assertEqual(cgroupCpuQuota(self.cgroupRoot, self.procRoot), 3)
+        self._write(path.join(self.cgroupRoot, "system.slice",
+                              "memory.max"), str(GB) + "\n")
+        self.assertEqual(cgroupMemoryLimit(self.cgroupRoot, self.procRoot),
+                         GB)
+
+    def test_cgroup_v1_nested(self):
+        """Limits of cgroup v1 are read from the hierarchy of each
+        controller."""
+        self._write(path.join(self.procRoot, "self", "cgroup"),
+                    "5:memory:/batch/job7\n4:cpu,cpuacct:/batch/job7\n")
+        jobDir = path.join("batch", "job7")
+        self._write(path.join(self.cgroupRoot, "memory", jobDir,
+                              "memory.limit_in_bytes"), str(3 * GB))
+        self._write(path.join(self.cgroupRoot, "memory",
+                              "memory.limit_in_bytes"), str(1 << 62))
+        self._write(path.join(self.cgroupRoot, "cpu", jobDir,
+                              "cpu.cfs_quota_us"), "200000")
+        self._write(path.join(self.cgroupRoot, "cpu", jobDir,
+                              "cpu.cfs_period_us"), "100000")
+        self.assertEqual(cgroupMemoryLimit(self.cgroupRoot, self.procRoot),
+                         3 * GB)
+        self.assertEqual(cgroupCpuQuota(self.cgroupRoot, self.procRoot), 2)
+
+    def test_memoryBudget(self):
+        """The budget is the smallest of all limits."""
+        self.assertIsNone(availableMemory(self.procRoot))
+        self.assertIsNone(memoryBudget(None, self.cgroupRoot,
+                                       self.procRoot))
+        self._meminfo(16 * 1024 * 1024)
+        self.assertEqual(availableMemory(self.procRoot), 16 * GB)
+        self.assertEqual(memoryBudget(None, self.cgroupRoot, self.procRoot),
+                         16 * GB)
+        self.assertEqual(memoryBudget(8, self.cgroupRoot, self.procRoot),
+                         8 * GB)
+        self._write(path.join(self.cgroupRoot, "memory.max"),
+                    "{0}\n".format(2 * GB))
+        self.assertEqual(memoryBudget(8, self.cgroupRoot, self.procRoot),
+                         2 * GB)
+
+    def test_planSort(self):
+        """Sort threads and memory fit the budgets."""
+        self._write(path.join(self.cgroupRoot, "cpu.max"),
+                    "800000 100000\n")
+        cpus = cpuBudget(16, self.cgroupRoot, self.procRoot)
+        self.assertEqual(cpus, min(8, multiprocessing.cpu_count()))
+
+        # Small container.
+        self._meminfo(1024 * 1024)
+        plan = planSort(16, cgroupRoot=self.cgroupRoot,
+                        procRoot=self.procRoot)
+        self.assertEqual(plan.threads, max(1, cpus // 2))
+        self.assertTrue(plan.threads * plan.memoryPerThread <= GB)
+        self.assertTrue(plan.memoryPerThread >= MIN_SORT_MEMORY_PER_THREAD)
+
+        # Large node, memory is limited by the data to sort.
+        self._meminfo(256 * 1024 * 1024)
+        plan = planSort(16, dataBytes=GB, cgroupRoot=self.cgroupRoot,
+                        procRoot=self.procRoot)
+        self.assertEqual(plan.threads, max(1, cpus // 2))
+        self.assertEqual(plan.memoryPerThread, 4 * GB // plan.threads)
+        self.assertEqual(plan.memoryOption, "{0}M".format(
+            plan.memoryPerThread >> 20))
+
+        # Memory reserved for aligners and shared by concurrent sorts.
+        plan = planSort(16, maxMemoryGB=10, reservedBytes=2 * GB, nSorts=2,
+                        cgroupRoot=self.cgroupRoot, procRoot=self.procRoot)
+        self.assertEqual(plan.threads, max(1, cpus // 2 // 2))
+        self.assertEqual(plan.memoryPerThread, 3 * GB // plan.threads)
+
+        # Temp files go to the candidate directory which exists.
+        plan = planSort(1, tmpDirs=[path.join(self.rootDir, "missing"),
+                                    self.rootDir],
+                        cgroupRoot=self.cgroupRoot, procRoot=self.procRoot)
+        self.assertEqual(plan.tmpDir, self.rootDir)
+        self.assertEqual(plan.threads, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Test pbalign.utils.runmanifest."""
+
+import unittest
+import tempfile
+import shutil
+import argparse
+from os import path
+
+from pbalign.utils.runmanifest import RunManifest, runStage, optionsHash
+
+
+class Test_RunManifest(unittest.TestCase):
+    """Test recording and resuming stages."""
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.options = argparse.Namespace(hitPolicy="randombest", nproc=8)
+        self.inFile = path.join(self.workDir, "in.fasta")
+        self.outFile = path.join(self.workDir, "out.sam")
+        with open(self.inFile, 'w') as writer:
+            writer.write(">r\nACGT\n")
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def _align(self):
+        """A fake stage which writes outFile."""
+        self.calls.append(1)
+        with open(self.outFile, 'w') as writer:
+            writer.write("aligned\n")
+
+    def _runAlign(self, options=None):
+        """Run the fake stage with a new manifest."""
+        manifest = RunManifest(self.workDir, options or self.options)
+        return runStage(manifest, "align", [self.inFile], [self.outFile],
+                        self._align)
+
+    def test_resume(self):
+        """A finished stage is skipped while its outputs are valid."""
+        self.assertTrue(self._runAlign())
+        self.assertFalse(self._runAlign())
+        self.assertEqual(len(self.calls), 1)
+
+        # nproc does not change results.
+        self.assertFalse(self._runAlign(
+            argparse.Namespace(hitPolicy="randombest", nproc=1)))
+
+        # Changed output.
+        with open(self.outFile, 'a') as writer:
+            writer.write("truncated")
+        self.assertTrue(self._runAlign())
+
+        # Changed options.
+        self.assertTrue(self._runAlign(
+            argparse.Namespace(hitPolicy="allbest", nproc=8)))
+        self.assertEqual(len(self.calls), 3)
+
+    def test_failed_stage(self):
+        """A failed stage is not recorded."""
+        def fail():
+            raise RuntimeError("disk full")
+        manifest = RunManifest(self.workDir, self.options)
+        with self.assertRaises(RuntimeError):
+            runStage(manifest, "sort", [self.inFile], [self.outFile], fail)
+        self.assertFalse(RunManifest(self.workDir, self.options).isDone(
+            "sort", [self.inFile], [self.outFile]))
+
+    def test_optionsHash(self):
+        """Irrelevant options are ignored."""
+        self.assertEqual(
+            optionsHash(argparse.Namespace(minLength=50, tmpDir="/a")),
+            optionsHash(argparse.Namespace(minLength=50, tmpDir="/b")))
+        self.assertNotEqual(
+            optionsHash(argparse.Namespace(minLength=50)),
+            optionsHash(argparse.Namespace(minLength=60)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+"""Test pbalign.utils.scheduler."""
+
+import threading
+import time
+import unittest
+from pbalign.utils.scheduler import StageScheduler
+
+
+class Test_StageScheduler(unittest.TestCase):
+    """Test StageScheduler."""
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.running = 0
+        self.maxRunning = 0
+
+    def _stage(self, name, seconds=0.05, result=None):
+        """Return a fake stage which records when it starts and ends."""
+        def func():
+            """Sleep for a while."""
+            with self.lock:
+                self.events.append(("start", name))
+                self.running += 1
+                self.maxRunning = max(self.maxRunning, self.running)
+            time.sleep(seconds)
+            with self.lock:
+                self.events.append(("end", name))
+                self.running -= 1
+            return result
+        return func
+
+    def test_concurrent(self):
+        """Independent stages run concurrently within nproc."""
+        scheduler = StageScheduler(nproc=2)
+        scheduler.add("index", self._stage("index", 0.2, "idx"))
+        scheduler.add("convert", self._stage("convert", 0.2, "fasta"))
+        scheduler.add("align", self._stage("align", result="sam"),
+                      deps=["index", "convert"])
+        results = scheduler.run()
+        self.assertEqual(results, {"index": "idx", "convert": "fasta",
+                                   "align": "sam"})
+        self.assertEqual(self.maxRunning, 2)
+        self.assertEqual(self.events[-2:], [("start", "align"),
+                                            ("end", "align")])
+
+    def test_sequential(self):
+        """With nproc=1, stages run in the order they are added."""
+        scheduler = StageScheduler(nproc=1)
+        for name in ["a", "b", "c"]:
+            scheduler.add(name, self._stage(name, 0.01))
+        scheduler.run()
+        self.assertEqual(self.maxRunning, 1)
+        self.assertEqual([name for event, name in self.events
+                          if event == "start"], ["a", "b", "c"])
+
+    def test_budget(self):
+        """A stage using all processors runs alone."""
+        scheduler = StageScheduler(nproc=2)
+        scheduler.add("build", self._stage("build", 0.1), nproc=4)
+        scheduler.add("convert", self._stage("convert", 0.1))
+        scheduler.run()
+        self.assertEqual(self.maxRunning, 1)
+
+    def test_failure(self):
+        """A failed stage stops dependent stages and raises its error."""
+        def fail():
+            """A failed stage."""
+            raise RuntimeError("failed")
+        scheduler = StageScheduler(nproc=2)
+        scheduler.add("fail", fail)
+        scheduler.add("other", self._stage("other", 0.1))
+        scheduler.add("after", self._stage("after"), deps=["fail"])
+        with self.assertRaises(RuntimeError):
+            scheduler.run()
+        self.assertIn(("end", "other"), self.events)
+        self.assertNotIn(("start", "after"), self.events)
+
+    def test_exit(self):
+        """A stage raising SystemExit finishes, and run() raises it."""
+        def exitStage():
+            """A stage exiting."""
+            raise SystemExit(2)
+        scheduler = StageScheduler(nproc=1)
+        scheduler.add("exit", exitStage)
+        scheduler.add("after", self._stage("after"), deps=["exit"])
+        with self.assertRaises(SystemExit):
+            scheduler.run()
+        self.assertEqual(self.events, [])
+
+    def test_bad_deps(self):
+        """Unknown and cyclic dependencies are rejected."""
+        scheduler = StageScheduler(nproc=2)
+        scheduler.add("a", self._stage("a"), deps=["b"])
+        with self.assertRaises(ValueError):
+            scheduler.run()
+        scheduler.add("b", self._stage("b"), deps=["a"])
+        with self.assertRaises(ValueError):
+            scheduler.run()
+        with self.assertRaises(ValueError):
+            scheduler.add("a", self._stage("a"))
+        self.assertEqual(self.events, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
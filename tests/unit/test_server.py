@@ -0,0 +1,250 @@
+"""Test pbalign.server."""
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from os import path
+from pbalign.server import (FairQueue, ReferenceWarmer, PBAlignServer,
+                            jobArgv, request, _referenceFiles)
+from pbalign.utils.indexcache import IndexCache
+from pbalign.utils.progutil import ExecResult
+
+
+def _acquire(semaphore, timeout):
+    """Acquire a semaphore within timeout seconds, return whether it was
+    acquired."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if semaphore.acquire(False):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class Test_FairQueue(unittest.TestCase):
+    """Test FairQueue."""
+    def test_round_robin(self):
+        """Clients are served round robin, each in FIFO order."""
+        q = FairQueue()
+        for i in range(3):
+            q.put("a", "a%d" % i)
+        q.put("b", "b0")
+        q.put("c", "c0")
+        q.close()
+        items = []
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            items.append(item)
+        self.assertEqual(items, ["a0", "b0", "c0", "a1", "a2"])
+        self.assertRaises(RuntimeError, q.put, "a", "a3")
+
+
+class Test_PBAlignServer(unittest.TestCase):
+    """Test ReferenceWarmer and PBAlignServer."""
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        self.refs = []
+        for name in ("amp1", "amp2", "amp3"):
+            fasta = path.join(self.rootDir, name + ".fasta")
+            with open(fasta, 'w') as writer:
+                writer.write(">%s\nACGT\n" % name)
+            with open(fasta + ".fai", 'w') as writer:
+                writer.write("%s\t4\t6\t4\t5\n" % name)
+            self.refs.append(fasta)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def test_warmer(self):
+        """References are marked used in LRU order and warmed in a
+        thread."""
+        warmer = ReferenceWarmer(2, interval=3600)
+        self.assertTrue(warmer.touch(self.refs[0]))
+        self.assertFalse(warmer.touch(self.refs[0]))
+        self.assertTrue(warmer.touch(self.refs[1]))
+        self.assertTrue(warmer.touch(self.refs[2]))
+        self.assertEqual(warmer.references(), self.refs[1:])
+        self.assertTrue(warmer.touch(self.refs[0]))
+        self.assertEqual(warmer.references(), [self.refs[2], self.refs[0]])
+        # Files of all recently used references are read each time.
+        nBytes = sum(path.getsize(fn) for fn in
+                     _referenceFiles(self.refs[2]) +
+                     _referenceFiles(self.refs[0]))
+        self.assertEqual(warmer.warm(), nBytes)
+        self.assertEqual(warmer.warm(), nBytes)
+
+        # Indexes of the reference in the index cache are warmed too.
+        cacheDir = path.join(self.rootDir, "cache")
+        cache = IndexCache(cacheDir, 1 << 30)
+        saFile = path.join(cacheDir, "{h}.blt8.sa".format(
+            h=cache.contentHash(self.refs[2])))
+        with open(saFile, 'w') as writer:
+            writer.write("sa")
+        open(path.join(cacheDir, "{h}.bt2".format(
+            h=cache.contentHash(self.refs[0]))), 'w').close()
+        self.assertEqual(_referenceFiles(self.refs[2], cacheDir),
+                         [self.refs[2], self.refs[2] + ".fai", saFile])
+        self.assertFalse(warmer.touch(self.refs[2], cacheDir))
+        self.assertEqual(warmer.warm(), nBytes + 2)
+
+        # A removed reference is skipped.
+        os.remove(self.refs[0])
+        self.assertEqual(warmer.warm(),
+                         sum(path.getsize(fn) for fn in
+                             _referenceFiles(self.refs[2], cacheDir)))
+
+    def test_warmerThread(self):
+        """The thread warms references when a new one is used and on a
+        timer, until stopped."""
+        warmed = threading.Semaphore(0)
+
+        class _Warmer(ReferenceWarmer):
+            """A ReferenceWarmer which counts warmings."""
+            def warm(self):
+                warmed.release()
+                return 0
+
+        warmer = _Warmer(2, interval=0.1)
+        warmer.start()
+        try:
+            warmer.touch(self.refs[0])
+            for _ in range(3):
+                self.assertTrue(_acquire(warmed, 10))
+        finally:
+            warmer.stop()
+        self.assertFalse(warmer._thread.is_alive())
+
+    def test_referenceFiles(self):
+        """Index files of a reference are included, other references
+        sharing its prefix are not."""
+        for name in ("amp1.fasta.sa", "amp10.fasta", "amp1.fa"):
+            open(path.join(self.rootDir, name), 'w').close()
+        self.assertEqual(_referenceFiles(self.refs[0]),
+                         [self.refs[0], self.refs[0] + ".fai",
+                          self.refs[0] + ".sa"])
+
+    def test_jobArgv(self):
+        """Paths are resolved against cwd and the index cache is shared."""
+        ref, argv = jobArgv({"input": "in.bam", "reference": "r.fasta",
+                             "output": "out.bam", "cwd": "/data",
+                             "options": ["--nproc", "2"]}, "/cache")
+        self.assertEqual(ref, "/data/r.fasta")
+        self.assertEqual(argv, ["--nproc", "2", "--indexCacheDir", "/cache",
+                                "/data/in.bam", "/data/r.fasta",
+                                "/data/out.bam"])
+        self.assertRaises(ValueError, jobArgv, {"input": "in.bam"})
+
+        # Relative paths of path options are resolved against cwd too.
+        _ref, argv = jobArgv({"input": "in.bam", "reference": "r.fasta",
+                              "output": "out.bam", "cwd": "/data",
+                              "options": ["--regionTable", "rgn.fofn",
+                                          "--tmpDir=tmp", "--nproc", "2",
+                                          "--unaligned", "/abs/un.txt"]})
+        self.assertEqual(argv[:6], ["--regionTable", "/data/rgn.fofn",
+                                    "--tmpDir=/data/tmp", "--nproc", "2",
+                                    "--unaligned"])
+        self.assertEqual(argv[6], "/abs/un.txt")
+
+    def test_serve(self):
+        """Jobs submitted on the socket are run by workers."""
+        ran = []
+        lock = threading.Lock()
+
+        def runJob(argv, timeout=None):
+            """Fake pbalign which fails on outputs named bad.bam."""
+            with lock:
+                ran.append(argv)
+            bad = argv[-1].endswith("bad.bam")
+            return ExecResult([], 1 if bad else 0, "bad" if bad else "",
+                              None, False)
+
+        socketPath = path.join(self.rootDir, "pbalign.sock")
+        server = PBAlignServer(socketPath, workers=2, runJob=runJob)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            # Only the daemon user may connect.
+            self.assertEqual(stat.S_IMODE(os.stat(socketPath).st_mode),
+                             0o600)
+            ok = request(socketPath, {"input": "in.bam", "wait": True,
+                                      "reference": self.refs[0],
+                                      "output": "ok.bam", "client": "lims"})
+            self.assertEqual((ok["state"], ok["exitCode"]), ("done", 0))
+            bad = request(socketPath, {"input": "in.bam",
+                                       "reference": self.refs[1],
+                                       "output": "bad.bam"})
+            bad = request(socketPath, {"op": "wait", "id": bad["id"]})
+            self.assertEqual((bad["state"], bad["exitCode"], bad["errMsg"]),
+                             ("failed", 1, "bad"))
+            info = request(socketPath, {"op": "info"})
+            self.assertEqual(set(info["references"]), set(self.refs[:2]))
+            self.assertTrue("error" in request(socketPath, {"op": "bogus"}))
+            for bogus in ([], "x", 1):
+                self.assertTrue("error" in request(socketPath, bogus))
+            request(socketPath, {"op": "shutdown"})
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        finally:
+            if thread.is_alive():
+                server.shutdown()
+            server.server_close()
+        self.assertEqual(len(ran), 2)
+        self.assertFalse(path.exists(socketPath))
+
+    def test_maxFinishedJobs(self):
+        """Only the most recently finished jobs are kept."""
+        def runJob(argv, timeout=None):
+            """Fake pbalign which succeeds."""
+            return ExecResult([], 0, "", None, False)
+
+        server = PBAlignServer(path.join(self.rootDir, "pbalign.sock"),
+                               workers=1, runJob=runJob, maxFinishedJobs=2)
+        try:
+            jobs = [server.submit({"input": "in.bam",
+                                   "reference": self.refs[0],
+                                   "output": "out%d.bam" % i})
+                    for i in range(4)]
+            for job in jobs:
+                self.assertTrue(job.done.wait(10))
+        finally:
+            server.server_close()
+        self.assertRaises(ValueError, server.job, jobs[1].jobId)
+        self.assertEqual(server.job(jobs[3].jobId).state, "done")
+
+    def test_server_close(self):
+        """Queued jobs are cancelled, running jobs finish."""
+        started, release = threading.Event(), threading.Event()
+
+        def runJob(argv, timeout=None):
+            """Fake pbalign which blocks until released."""
+            started.set()
+            release.wait(10)
+            return ExecResult([], 0, "", None, False)
+
+        server = PBAlignServer(path.join(self.rootDir, "pbalign.sock"),
+                               workers=1, runJob=runJob)
+        jobs = [server.submit({"input": "in.bam", "reference": self.refs[0],
+                               "output": "out%d.bam" % i})
+                for i in range(3)]
+        self.assertTrue(started.wait(10))
+        closer = threading.Thread(target=server.server_close)
+        closer.start()
+        try:
+            for job in jobs[1:]:
+                self.assertTrue(job.done.wait(10))
+                self.assertEqual(job.state, "cancelled")
+            self.assertEqual(jobs[0].state, "running")
+        finally:
+            release.set()
+            closer.join(10)
+        self.assertFalse(closer.is_alive())
+        self.assertEqual((jobs[0].state, jobs[0].exitCode), ("done", 0))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""Test pbalign.utils.shardplanner."""
+
+import unittest
+import numpy as np
+
+from pbalign.utils.shardplanner import basesPerZmw, planShards, \
+    maxBasesForWallTime
+
+
+class Test_ShardPlanner(unittest.TestCase):
+    """Test planning base-balanced shards."""
+
+    def setUp(self):
+        # Two movies, reads are not sorted by ZMW.
+        self.movieIds = np.array([1, 0, 0, 0, 1, 0], dtype=np.int32)
+        self.holeNumbers = np.array([7, 3, 1, 3, 5, 2], dtype=np.int32)
+        self.qStarts = np.array([0, 0, 0, 100, 0, 0], dtype=np.int32)
+        self.qEnds = np.array([1000, 100, 50, 300, 10, 5000],
+                              dtype=np.int32)
+
+    def test_basesPerZmw(self):
+        """Test basesPerZmw()."""
+        movieIds, holeNumbers, bases = basesPerZmw(
+            self.movieIds, self.holeNumbers, self.qStarts, self.qEnds)
+        self.assertEqual(movieIds.tolist(), [0, 0, 0, 1, 1])
+        self.assertEqual(holeNumbers.tolist(), [1, 2, 3, 5, 7])
+        self.assertEqual(bases.tolist(), [50, 5000, 300, 10, 1000])
+
+    def test_planShards(self):
+        """Test planShards() balances bases instead of reads."""
+        shards = planShards(self.movieIds, self.holeNumbers,
+                            self.qStarts, self.qEnds, 2)
+        self.assertEqual(shards, [[(0, 1, 2)], [(0, 3, 3), (1, 5, 7)]])
+
+    def test_planShards_maxBases(self):
+        """Test planShards() adds shards to fit maxBasesPerShard."""
+        shards = planShards(self.movieIds, self.holeNumbers,
+                            self.qStarts, self.qEnds, 1,
+                            maxBasesPerShard=2000)
+        # ZMW 2 alone has more than 2000 bases.
+        self.assertEqual(shards, [[(0, 1, 1)], [(0, 2, 2)],
+                                  [(0, 3, 3), (1, 5, 5)], [(1, 7, 7)]])
+
+    def test_planShards_empty(self):
+        """Test planShards() with an empty index."""
+        empty = np.array([], dtype=np.int32)
+        self.assertEqual(planShards(empty, empty, empty, empty, 4), [])
+
+    def test_maxBasesForWallTime(self):
+        """Test maxBasesForWallTime()."""
+        self.assertIsNone(maxBasesForWallTime(None, 8))
+        self.assertEqual(maxBasesForWallTime(1, 2, basesPerThreadSecond=10),
+                         1200)
+
+
+if __name__ == "__main__":
+    unittest.main()
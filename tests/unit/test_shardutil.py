@@ -0,0 +1,175 @@
+"""Test pbalign.utils.shardutil."""
+
+import shutil
+import tempfile
+import unittest
+from os import path
+
+import pysam
+from pbcore.io import openDataFile
+
+from pbalign.utils.shardplanner import basesPerZmw
+from pbalign.utils.shardutil import splitInputFile, mergeShardOutputs
+
+from test_setpath import ROOT_DIR
+
+
+def zmwBases(ds):
+    """Return a dict mapping (qId, holeNumber) of each ZMW of an indexed
+    dataset to its number of bases."""
+    index = ds.index
+    movieIds, holeNumbers, bases = basesPerZmw(index.qId, index.holeNumber,
+                                               index.qStart, index.qEnd)
+    return dict(zip(zip(movieIds.tolist(), holeNumbers.tolist()),
+                    bases.tolist()))
+
+
+class Test_splitInputFile(unittest.TestCase):
+    """Test splitting FOFNs and datasets into shards."""
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        self.dataset = path.join(ROOT_DIR, "data/subreads_dataset1.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def _fofn(self, nFiles):
+        """Make a FOFN of nFiles BAM file names."""
+        fofn = path.join(self.rootDir, "in.fofn")
+        with open(fofn, 'w') as writer:
+            for i in range(nFiles):
+                writer.write("/data/movie{0}.bam\n".format(i))
+        return fofn
+
+    def _shardFiles(self, shards):
+        """Return file names listed in each shard FOFN."""
+        result = []
+        for shard in shards:
+            with open(shard, 'r') as reader:
+                result.append([line.strip() for line in reader])
+        return result
+
+    def test_splitFOFN(self):
+        """Files of a FOFN are split into shards differing by at most one
+        file."""
+        shards = splitInputFile(self._fofn(5), 2, self.rootDir)
+        self.assertEqual(self._shardFiles(shards),
+                         [["/data/movie0.bam", "/data/movie2.bam",
+                           "/data/movie4.bam"],
+                          ["/data/movie1.bam", "/data/movie3.bam"]])
+
+    def test_splitFOFN_moreShardsThanFiles(self):
+        """A FOFN is split into at most one shard per file."""
+        shards = splitInputFile(self._fofn(3), 8, self.rootDir)
+        self.assertEqual(self._shardFiles(shards),
+                         [["/data/movie0.bam"], ["/data/movie1.bam"],
+                          ["/data/movie2.bam"]])
+
+    def test_noSplit(self):
+        """A single shard or an input which can not be split is kept."""
+        fofn = self._fofn(3)
+        self.assertEqual(splitInputFile(fofn, 1, self.rootDir), [fofn])
+        fasta = path.join(ROOT_DIR, "data/lambda_query.fasta")
+        self.assertEqual(splitInputFile(fasta, 4, self.rootDir), [fasta])
+
+    def _checkShards(self, ds, shards):
+        """Check that shards of ds have disjoint ZMWs, which together are
+        the ZMWs of ds, and return bases of each shard."""
+        allZmws = zmwBases(ds)
+        shardZmws = [zmwBases(openDataFile(shard)) for shard in shards]
+        seen = set()
+        for zmws in shardZmws:
+            self.assertEqual(seen & set(zmws), set())
+            seen.update(zmws)
+        self.assertEqual(seen, set(allZmws))
+        self.assertEqual(sum(len(openDataFile(shard).index)
+                             for shard in shards), len(ds.index))
+        return [sum(zmws.values()) for zmws in shardZmws], \
+            max(allZmws.values())
+
+    def test_splitDataSet(self):
+        """A dataset is split into ZMW ranges with balanced bases."""
+        ds = openDataFile(self.dataset)
+        shards = splitInputFile(self.dataset, 3, self.rootDir)
+        self.assertEqual(len(shards), 3)
+        shardBases, maxZmwBases = self._checkShards(ds, shards)
+        # Shards are cut at ZMW boundaries.
+        self.assertTrue(max(shardBases) - min(shardBases) <= 2 * maxZmwBases)
+
+    def test_splitFilteredDataSet(self):
+        """Filters of a dataset are kept in its shards, and a dataset is
+        split into at most one shard per ZMW."""
+        ds = openDataFile(self.dataset)
+        holeNumbers = sorted(set(ds.index.holeNumber.tolist()))
+        ds.filters.addRequirement(zm=[('<=', holeNumbers[2])])
+        filtered = path.join(self.rootDir, "filtered.xml")
+        ds.write(filtered)
+        ds = openDataFile(filtered)
+        nZmws = len(zmwBases(ds))
+        self.assertTrue(0 < nZmws < len(holeNumbers))
+
+        shards = splitInputFile(filtered, nZmws + 10, self.rootDir)
+        self.assertEqual(len(shards), nZmws)
+        self._checkShards(ds, shards)
+        for shard in shards:
+            self.assertTrue(all(openDataFile(shard).index.holeNumber <=
+                                holeNumbers[2]))
+
+
+class Test_mergeShardOutputs(unittest.TestCase):
+    """Test merging aligned shards."""
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        self.header = "@HD\tVN:1.5\tSO:unknown\n" + \
+                      "@SQ\tSN:ref\tLN:1000\n"
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def _sam(self, name, header, reads):
+        """Make a SAM file of unaligned reads."""
+        fileName = path.join(self.rootDir, name)
+        with open(fileName, 'w') as writer:
+            writer.write(header)
+            for read in reads:
+                writer.write("{r}\t4\t*\t0\t255\t*\t*\t0\t0\tACGT\t*\n".
+                             format(r=read))
+        return fileName
+
+    def _reads(self, fileName):
+        """Return names of reads in a SAM/BAM file."""
+        return [r.query_name for r in
+                pysam.AlignmentFile(fileName, check_sq=False)]
+
+    def test_mergeSams(self):
+        """SAM shards are concatenated in order, keeping unique header
+        lines of all shards."""
+        shards = [self._sam("shard0.sam", self.header, ["r3", "r1"]),
+                  self._sam("shard1.sam",
+                            self.header + "@RG\tID:rg1\tPU:m1\n", ["r2"])]
+        outSam = path.join(self.rootDir, "merged.sam")
+        mergeShardOutputs(shards, outSam)
+        with open(outSam, 'r') as reader:
+            lines = reader.readlines()
+        self.assertEqual("".join(lines[0:3]),
+                         self.header + "@RG\tID:rg1\tPU:m1\n")
+        self.assertEqual(self._reads(outSam), ["r3", "r1", "r2"])
+
+    def test_mergeBams(self):
+        """BAM shards are merged by samtools, keeping all reads."""
+        shards = []
+        for i, reads in enumerate([["r1", "r2"], ["r3"]]):
+            sam = pysam.AlignmentFile(
+                self._sam("shard{0}.sam".format(i), self.header, reads),
+                check_sq=False)
+            shards.append(path.join(self.rootDir, "shard{0}.bam".format(i)))
+            with pysam.AlignmentFile(shards[-1], 'wb',
+                                     template=sam) as writer:
+                for record in sam:
+                    writer.write(record)
+        outBam = path.join(self.rootDir, "merged.bam")
+        mergeShardOutputs(shards, outBam, nproc=2)
+        self.assertEqual(sorted(self._reads(outBam)), ["r1", "r2", "r3"])
+
+if __name__ == "__main__":
+    unittest.main()
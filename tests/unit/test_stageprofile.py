@@ -0,0 +1,58 @@
+"""Test pbalign.utils.stageprofile."""
+
+import unittest
+import tempfile
+import shutil
+import json
+import subprocess
+from os import path
+
+from pbalign.utils.stageprofile import StageProfiler, profileStage
+
+
+class Test_StageProfiler(unittest.TestCase):
+    """Test measuring stages."""
+
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def test_stages(self):
+        """Stages are recorded in order with child CPU time."""
+        profiler = StageProfiler()
+        with profiler.stage("align"):
+            subprocess.check_call(
+                "python -c 'sum(range(3000000))'", shell=True)
+        with profileStage(profiler, "sort"):
+            pass
+        with profileStage(None, "ignored"):
+            pass
+        profiler.setInput(1000, 10)
+
+        report = profiler.report()
+        self.assertEqual([s['stage'] for s in report['stages']],
+                         ["align", "sort"])
+        align = report['stages'][0]
+        self.assertGreater(align['childUserSeconds'] +
+                           align['childSystemSeconds'], 0)
+        self.assertIn('basesPerSecond', align)
+        self.assertEqual(report['inputBases'], 1000)
+        self.assertGreater(report['total']['childPeakRssKB'], 0)
+
+    def test_write(self):
+        """The report is written as JSON."""
+        profiler = StageProfiler()
+        with profiler.stage("output"):
+            pass
+        outFile = path.join(self.outDir, "out.stats.json")
+        profiler.write(outFile)
+        with open(outFile) as reader:
+            report = json.load(reader)
+        self.assertEqual(report['stages'][0]['stage'], "output")
+        self.assertIsNone(report['inputBases'])
+
+
+if __name__ == "__main__":
+    unittest.main()
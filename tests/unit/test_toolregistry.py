@@ -0,0 +1,89 @@
+"""Test pbalign.utils.toolregistry."""
+
+import unittest
+import tempfile
+import shutil
+import os
+import time
+from os import path
+
+from pbalign.utils.toolregistry import ToolRegistry, parseVersion, which
+
+
+class Test_ToolRegistry(unittest.TestCase):
+    """Test resolving tools and caching their versions."""
+
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        self.binDir = path.join(self.rootDir, "bin")
+        os.mkdir(self.binDir)
+        self.cacheFile = path.join(self.rootDir, "cache", "tools.json")
+        self.countFile = path.join(self.rootDir, "count")
+        self.tool = path.join(self.binDir, "faketool")
+        self._writeTool("2.7.1")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def _writeTool(self, version):
+        """Write a fake tool which counts how many times it is run."""
+        with open(self.tool, 'w') as writer:
+            writer.write("#!/bin/sh\necho x >> {c}\n"
+                         "echo 'faketool {v}'\n".format(c=self.countFile,
+                                                       v=version))
+        os.chmod(self.tool, 0o755)
+
+    def _count(self):
+        """Return how many times the fake tool has been run."""
+        if not path.exists(self.countFile):
+            return 0
+        with open(self.countFile, 'r') as reader:
+            return len(reader.readlines())
+
+    def test_which(self):
+        """Resolve executables on a search path."""
+        self.assertEqual(which("faketool", self.binDir), self.tool)
+        self.assertIsNone(which("missingtool", self.binDir))
+        registry = ToolRegistry(self.cacheFile, self.binDir)
+        self.assertTrue(registry.isAvailable("faketool"))
+        self.assertFalse(registry.isAvailable("missingtool"))
+        with self.assertRaises(RuntimeError):
+            registry.check("missingtool")
+        self.assertEqual(registry.resolveAll(["faketool", "missingtool"]),
+                         {"faketool": self.tool, "missingtool": None})
+
+    def test_version(self):
+        """Versions are probed once per binary and persisted."""
+        registry = ToolRegistry(self.cacheFile, self.binDir)
+        self.assertEqual(registry.version("faketool"), "faketool 2.7.1")
+        self.assertEqual(registry.versionTuple("faketool"), (2, 7, 1))
+        self.assertEqual(self._count(), 1)
+        self.assertIsNone(registry.version("missingtool"))
+        self.assertEqual(registry.versionTuple("missingtool", (0, 1, 19)),
+                         (0, 1, 19))
+
+        # Another process reads the persisted version.
+        registry = ToolRegistry(self.cacheFile, self.binDir)
+        self.assertEqual(registry.versionTuple("faketool"), (2, 7, 1))
+        self.assertEqual(self._count(), 1)
+
+        # An updated binary is probed again.
+        self._writeTool("3.0")
+        stat = os.stat(self.tool)
+        os.utime(self.tool, (stat.st_atime, time.time() + 10))
+        registry = ToolRegistry(self.cacheFile, self.binDir)
+        self.assertEqual(registry.versionTuple("faketool"), (3, 0))
+        self.assertEqual(self._count(), 2)
+
+    def test_parseVersion(self):
+        """Parse version numbers."""
+        self.assertEqual(parseVersion("samtools 1.9"), (1, 9))
+        self.assertEqual(parseVersion("samtools 1.10 (using htslib 1.10)"),
+                         (1, 10))
+        self.assertEqual(parseVersion("blasr\t5.3.2"), (5, 3, 2))
+        self.assertIsNone(parseVersion("unknown"))
+        self.assertIsNone(parseVersion(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
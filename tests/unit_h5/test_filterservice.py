@@ -34,10 +34,10 @@ class Test_FilterService(unittest.TestCase):
                             self.filteredSam, "BlasrService", -1,
                             options)
 
-        self.assertTrue(obj.availability) # samFilter should be available
-        self.assertIn("-minPctSimilarity 70", obj.cmd)
-        self.assertIn("-minAccuracy 70", obj.cmd)
-        self.assertIn("-scoreSign -1", obj.cmd)
+        self.assertTrue(obj.availability) # FilterEngine is always available
+        self.assertEqual(obj.engine.minPctSimilarity, 70)
+        self.assertEqual(obj.engine.minPctAccuracy, 70)
+        self.assertEqual(obj.engine.scoreSign, -1)
 
     def test_run(self):
         """Test FilterService.run()."""
@@ -59,9 +59,9 @@ class Test_FilterService(unittest.TestCase):
                              self.filteredSam, "BowtieService", 1,
                              options2)
 
-        self.assertNotIn("-seed", obj2.cmd)
-        self.assertNotIn("-scoreCutoff", obj2.cmd)
-        self.assertIn("-scoreSign 1", obj2.cmd)
+        self.assertIsNone(obj2.engine.seed)
+        self.assertIsNone(obj2.engine.scoreCutoff)
+        self.assertEqual(obj2.engine.scoreSign, 1)
 
         _output, errCode, _errMsg = obj2.run()
 
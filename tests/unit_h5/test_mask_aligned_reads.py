@@ -0,0 +1,105 @@
+"""Test pbalign.tools.mask_aligned_reads."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+
+import h5py
+import numpy as np
+from pbcore.io.BasH5IO import INSERT_REGION, HQ_REGION
+from pbalign.tools.mask_aligned_reads import AlignedReadsMasker, \
+    _maskRgnH5
+from pbalign.utils.RgnH5IO import RgnH5Reader, RgnH5Writer
+
+
+class _Masker(AlignedReadsMasker):
+    """A masker of fixed aligned reads instead of reads in a cmp.h5."""
+    def _extractAlignedReads(self):
+        return {"m1": set([1, 3]), "m2": set([2])}
+
+
+class Test_AlignedReadsMasker(unittest.TestCase):
+    """Test AlignedReadsMasker."""
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        self.inRgnFofn = path.join(self.rootDir, "in_rgn.fofn")
+        self.outRgnFofn = path.join(self.rootDir, "out_rgn.fofn")
+        rgnH5FNs = []
+        for i, movie in enumerate(["m1", "m2", "m3"]):
+            rgnH5FN = path.join(self.rootDir, "{m}.{i}.rgn.h5".format(
+                m=movie, i=i + 1))
+            with RgnH5Writer(rgnH5FN) as writer:
+                runInfo = writer.file.create_group("ScanData/RunInfo")
+                runInfo.attrs["MovieName"] = movie
+                for holeNumber in range(4):
+                    writer.addRegions([(holeNumber, INSERT_REGION, 0, 90, -1),
+                                       (holeNumber, HQ_REGION, 5, 80, 900)])
+            rgnH5FNs.append(rgnH5FN)
+        with open(self.inRgnFofn, 'w') as writer:
+            writer.write("\n".join(rgnH5FNs) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def _hqRegionLengths(self, rgnH5FN):
+        """Return HQ region lengths of a region table."""
+        reader = RgnH5Reader(rgnH5FN)
+        try:
+            return reader.columns.hqRegionLengths.tolist()
+        finally:
+            reader.close()
+
+    def _check(self, nproc):
+        """Mask region tables using nproc processes."""
+        masker = _Masker(None, self.inRgnFofn, self.outRgnFofn, nproc)
+        self.assertEqual(masker.maskAlignedReads(), 0)
+        outRgnH5FNs = [line.strip() for line in open(self.outRgnFofn)]
+        self.assertEqual([path.basename(f) for f in outRgnH5FNs],
+                         ["m1.1.rgn.h5", "m2.2.rgn.h5", "m3.3.rgn.h5"])
+        self.assertEqual([self._hqRegionLengths(f) for f in outRgnH5FNs],
+                         [[75, 0, 75, 0], [75, 75, 0, 75], [75] * 4])
+
+    def test_serial(self):
+        """Test masking region tables one after another."""
+        self._check(1)
+
+    def test_parallel(self):
+        """Test masking region tables in a process pool."""
+        self._check(3)
+
+    def test_failure(self):
+        """Region tables which can not be read are all reported, and no
+        output is left behind."""
+        with open(self.inRgnFofn, 'a') as writer:
+            for name in ("missing1.rgn.h5", "missing2.rgn.h5"):
+                writer.write(path.join(self.rootDir, name) + "\n")
+        for nproc in (1, 2):
+            masker = _Masker(None, self.inRgnFofn, self.outRgnFofn, nproc)
+            with self.assertRaises(IOError) as cm:
+                masker.maskAlignedReads()
+            self.assertIn("missing1.rgn.h5", str(cm.exception))
+            self.assertIn("missing2.rgn.h5", str(cm.exception))
+            self.assertFalse(path.exists(self.outRgnFofn))
+            self.assertEqual(os.listdir(path.join(self.rootDir, "out_rgn")),
+                             [])
+
+    def test_failure_removesOutput(self):
+        """A region table which fails after its output is created does not
+        leave a partial output behind."""
+        rgnH5FN = path.join(self.rootDir, "m4.4.rgn.h5")
+        with h5py.File(rgnH5FN, 'w') as h5File:
+            runInfo = h5File.create_group("ScanData/RunInfo")
+            runInfo.attrs["MovieName"] = "m4"
+            h5File.create_dataset("PulseData/Regions",
+                                  data=np.zeros((2, 3), dtype=np.int32))
+        outDir = path.join(self.rootDir, "out")
+        os.mkdir(outDir)
+        _inFN, outH5FN, errMsg = _maskRgnH5((rgnH5FN, outDir))
+        self.assertEqual(outH5FN, None)
+        self.assertNotEqual(errMsg, None)
+        self.assertFalse(path.exists(path.join(outDir, "m4.4.rgn.h5")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,14 @@
 """Test pbalign.utils.RgnH5IO.py."""
 
+import shutil
+import tempfile
 import unittest
 from pbcore.io.BasH5IO import ADAPTER_REGION, INSERT_REGION, HQ_REGION
 from pbalign.utils.RgnH5IO import Region, RegionTable, RgnH5Reader, \
-    RgnH5Writer, addStrListAttr
+    RgnH5Writer, RegionColumns, addStrListAttr
 from os import path
 import h5py
+import numpy as np
 from test_setpath import ROOT_DIR, DATA_DIR, OUT_DIR
 
 
@@ -100,6 +103,135 @@ class Test_RgnH5IO(unittest.TestCase):
             if rt1.holeNumber == 1000:
                 break
 
+    def test_RegionColumns(self):
+        """Test class RegionColumns."""
+        c = RegionColumns([(30, 1, 14046, 17047, -1),
+                           (11, 1, 1634, 7207, -1),
+                           (30, 2, 14046, 19610, 890),
+                           (11, 2, 1634, 7207, 882),
+                           (5, 0, 10, 50, 955)])
+        self.assertEqual(c.zmws.tolist(), [5, 11, 30])
+        self.assertEqual(c.offsets.tolist(), [0, 1, 3, 5])
+        # Rows within a ZMW keep their order.
+        self.assertEqual(c.typeIndex.tolist(), [0, 1, 2, 1, 2])
+        self.assertEqual(c.zmwIndex.tolist(), [0, 1, 1, 2, 2])
+        self.assertEqual(c.indexOf([30, 6, 5, 31]).tolist(), [2, -1, 0, -1])
+        self.assertEqual(c.rowsOf(11), (1, 3))
+        self.assertRaises(KeyError, c.rowsOf, 12)
+        self.assertEqual(c.hqRegionLengths.tolist(), [0, 5573, 5564])
+        self.assertEqual(c.totalLengths(INSERT_REGION).tolist(),
+                         [0, 5573, 3001])
+        empty = RegionColumns(np.zeros((0, 5), dtype=np.int32))
+        self.assertEqual((len(empty), empty.numZMWs), (0, 0))
+        self.assertEqual(empty.indexOf([1]).tolist(), [-1])
+
+    def test_writer_bulk(self):
+        """Test RgnH5Writer.addRegions() with unsorted blocks."""
+        tmpDir = tempfile.mkdtemp()
+        try:
+            outFN = path.join(tmpDir, "bulk.rgn.h5")
+            rng = np.random.RandomState(0)
+            holeNumbers = rng.permutation(3000)
+            blocks = []
+            for typeIndex in (INSERT_REGION, HQ_REGION):
+                blocks.append(np.column_stack((
+                    holeNumbers, np.full(3000, typeIndex),
+                    rng.randint(0, 100, 3000), rng.randint(100, 900, 3000),
+                    np.full(3000, -1))))
+            with RgnH5Writer(outFN, chunkRows=1000) as writer:
+                for block in blocks:
+                    for i in range(0, 3000, 700):
+                        writer.addRegions(block[i:i + 700])
+                writer.addRegionTable(RegionTable(
+                    5000, [Region([5000, HQ_REGION, 0, 10, 900])]))
+
+            f = h5py.File(outFN, 'r')
+            dataset = f["/PulseData/Regions"]
+            self.assertEqual(dataset.chunks, (1000, 5))
+            self.assertEqual(dataset.compression, "gzip")
+            f.close()
+
+            reader = RgnH5Reader(outFN)
+            columns = reader.columns
+            self.assertEqual(columns.zmws.tolist(),
+                             range(3000) + [5000])
+            # Rows of a ZMW keep the order in which they were added.
+            self.assertEqual(columns.typeIndex[:4].tolist(),
+                             [INSERT_REGION, HQ_REGION] * 2)
+            order = np.argsort(holeNumbers)
+            self.assertTrue(np.array_equal(
+                columns.hqRegionLengths[:3000],
+                (blocks[1][:, 3] - blocks[1][:, 2])[order]))
+            reader.close()
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_setHQRegions(self):
+        """Test RegionColumns.setHQRegions()."""
+        c = RegionColumns([(5, 0, 10, 50, 955),
+                           (11, 1, 1634, 7207, -1),
+                           (11, 2, 1634, 7207, 882),
+                           (30, 1, 14046, 17047, -1),
+                           (30, 2, 14046, 19610, 890),
+                           (42, 2, 5, 10, 800)])
+        self.assertEqual(c.setHQRegions([5, 11, 30, 99]).tolist(),
+                         [[5, 0, 10, 50, 955],
+                          [5, 2, 0, 0, 0],
+                          [11, 1, 1634, 7207, -1],
+                          [11, 2, 0, 0, 882],
+                          [30, 1, 14046, 17047, -1],
+                          [30, 2, 0, 0, 890],
+                          [42, 2, 5, 10, 800]])
+        # The same as RegionTable.setHQRegion() of each ZMW.
+        expected = []
+        for i, holeNumber in enumerate(c.zmws):
+            rt = RegionTable(holeNumber, [Region(r) for r in
+                                          c.regions[c.offsets[i]:
+                                                    c.offsets[i + 1]]])
+            if holeNumber in (11, 42):
+                rt.setHQRegion(3, 4)
+            expected.extend(rt.toList())
+        self.assertEqual([tuple(r) for r in
+                          c.setHQRegions([11, 42], 3, 4).tolist()],
+                         expected)
+        self.assertEqual(c.setHQRegions([]).tolist(), c.regions.tolist())
+
+    def test_lazy_reader(self):
+        """Test RgnH5Reader(lazy=True)."""
+        tmpDir = tempfile.mkdtemp()
+        try:
+            outFN = path.join(tmpDir, "lazy.rgn.h5")
+            holeNumbers = np.repeat(np.arange(0, 20000, 2), 3)
+            regions = np.column_stack((
+                holeNumbers, np.tile([INSERT_REGION, ADAPTER_REGION,
+                                      HQ_REGION], 10000),
+                holeNumbers % 97, holeNumbers % 97 + 100,
+                np.full(30000, 850)))
+            with RgnH5Writer(outFN) as writer:
+                writer.addRegions(regions)
+
+            eager = RgnH5Reader(outFN)
+            lazy = RgnH5Reader(outFN, lazy=True, blockRows=1000,
+                               cacheBlocks=2)
+            self.assertEqual(lazy.numZMWs, 10000)
+            for holeNumber in (0, 666, 998, 19998, 1000, 668):
+                self.assertEqual(lazy.regionTable(holeNumber).toList(),
+                                 eager.regionTable(holeNumber).toList())
+            self.assertRaises(KeyError, lazy.regionTable, 1)
+            # Only a few blocks are read and cached.
+            self.assertTrue(lazy._columns is None)
+            self.assertEqual(len(lazy._blocks), 2)
+
+            columns = lazy.regionColumns([19998, 4, 3, 4])
+            self.assertEqual(columns.zmws.tolist(), [4, 19998])
+            self.assertEqual(columns.regions.tolist(),
+                             regions[[6, 7, 8, 29997, 29998, 29999]].tolist())
+            self.assertEqual(len(lazy.regionColumns([1, 3])), 0)
+            eager.close()
+            lazy.close()
+        finally:
+            shutil.rmtree(tmpDir)
+
     def test_addStrListAttr(self):
         """Test function addStrListAttr(obj, name, strlist)."""
         f = h5py.File(self.outTmpFN, 'w')